@@ -32,6 +32,7 @@ class FChangeDetector(FlawFilter):
                     if len(unchanged):
                         # for each unchanged page, check whether the page was changed in other languages on that day.
                         for row in unchanged:
+                            self.checkCancelled()
                             #~ dprint(1, 'unchanged: %s' % str(row))
                             cur.execute('SELECT identifier,language FROM changed_article WHERE identifier=%s AND day=%s AND only_major!=0 AND non_bot!=0 AND many_user!=0 GROUP BY language', (row['identifier'], date))
                             res= cur.fetchall()
@@ -43,7 +44,11 @@ class FChangeDetector(FlawFilter):
                                 for s in map(lambda x: x['language'], res):
                                     info+= ' '
                                     info+= s
-                                resultQueue.put(TlgResult(self.wiki, getPageByID(self.wiki, row['page_id'])[0], self.parent, infotext= 'changed in: %s' % info))
+                                page= self.getPageRow(row['page_id'])
+                                if page==None: continue     # deleted since it was noticed
+                                resultQueue.put(TlgResult(self.wiki, page, self.parent, infotext= 'changed in: %s' % info))
+            except QueryCancelled:
+                raise
             except Exception as ex:
                 dprint(0, "ChangeDetector filter exception: %s" % str(ex))
     def getPreferredPagesPerAction(self):
@@ -8,6 +8,7 @@ class FSortByCreationTimestamp(FlawFilter):
     label= _('Creation Timestamp')                # Label, das im Frontend neben der Checkbox angezeigt wird
     description= _('Sort Pages by their creation timestamp.')   # Längerer Beschreibungstext für Tooltip
     group= _('Currentness')                      # Gruppe, in die der Filter eingeordnet wird
+    usesPageStore= True                          # Seiten-Zeilen werden vorab für alle Filter geladen
 
     # Die Action-Klasse für diesen Filter
     class Action(TlgAction):
@@ -17,16 +18,17 @@ class FSortByCreationTimestamp(FlawFilter):
             cur= getCursors()[self.wiki]
             # Formatstrings für mehrere Seiten generieren.
             format_strings = ','.join(['%s'] * len(self.pageIDs))
-            # Beginn des heutigen Tages im Format der Wikipedia-Datenbank
             params= []
             params.extend(self.pageIDs)
             
-            cur.execute('SELECT page.*,revision.rev_timestamp FROM page INNER JOIN revision ON page_id=rev_page AND rev_parent_id=0 WHERE page_id IN (%s)' % format_strings, params)
+            # Nur die erste Revision jeder Seite abfragen, die Seiten-Zeilen kommen aus dem Page Store
+            cur.execute('SELECT rev_page, rev_timestamp FROM revision WHERE rev_page IN (%s) AND rev_parent_id=0' % format_strings, params)
             res= cur.fetchall()
-            for row in res:
-                timestamp= row['rev_timestamp']
-                del row['rev_timestamp']
-                resultQueue.put(TlgResult(self.wiki, row, self.parent, '%s' % timestamp, sortkey= timestamp))
+            rows= self.getPageRows([ rev['rev_page'] for rev in res ])
+            for rev in res:
+                if rev['rev_page'] in rows:
+                    timestamp= rev['rev_timestamp']
+                    resultQueue.put(TlgResult(self.wiki, rows[rev['rev_page']], self.parent, '%s' % timestamp, sortkey= timestamp))
             
             # Subset der Seiten finden, die heute geändert wurden
             #~ cur.execute('SELECT * FROM page WHERE page_id IN (%s) AND page_touched >= %%s' % format_strings, params)
@@ -51,6 +51,8 @@ FlawFilters.register(FLinkedImages)
 
 licounter= itertools.count()
 class FLinkedFiles_Base(FlawFilter):
+    resultsForOtherPages= True
+    
     class Action(TlgAction):
         def execute(self, resultQueue):
             cur= getCursors()[self.wiki]
@@ -64,6 +66,7 @@ class FLinkedFiles_Base(FlawFilter):
             titlerows= cur.fetchall()
             
             if len(titlerows):
+                self.checkCancelled()
                 titles= [ row['il_to'].replace(' ', '_') for row in titlerows ]     # xxx remove?
                 format_strings= ' OR '.join(['page_title=%s'] * len(titles))
                 params= []
@@ -1,7 +1,14 @@
 #!/usr/bin/python
 # -*- coding:utf-8 -*-
 import time
+import array
 from tlgflaws import *
+from tlglinkindex import getInDegreeIndex
+from tlgtemplateimages import getTemplateImageCache
+try:
+    import numpy
+except ImportError:
+    numpy= None
 
 ## 
 class FAll(FlawFilter):
@@ -9,19 +16,14 @@ class FAll(FlawFilter):
     label= _('All Pages')
     description= _('Show all articles without filtering.')
     
+    usesPageStore= True
+    
     # our action class
     class Action(TlgAction):
         def execute(self, resultQueue):
-            cur= getCursors()[self.wiki]
-            #~ format_strings = ','.join(['%s'] * len(self.pageIDs))
-            #~ cur.execute('SELECT * FROM page WHERE page_id IN (%s)' % format_strings, self.pageIDs)
-            format_strings = ' OR '.join(['page_id=%s'] * len(self.pageIDs))
-            cur.execute("""SELECT page_id, page_namespace, page_title, page_restrictions, page_counter, page_is_redirect, 
-page_is_new, page_random, page_touched, page_latest, page_len 
-FROM page WHERE (page_namespace=0 OR page_namespace=6) AND page_is_redirect=0 AND (%s)""" % format_strings, self.pageIDs)
-            result= cur.fetchall()
-            for row in result:
-                resultQueue.put(TlgResult(self.wiki, row, self.parent))
+            for row in self.getPageRows(self.pageIDs).itervalues():
+                if (row['page_namespace']==0 or row['page_namespace']==6) and row['page_is_redirect']==0:
+                    resultQueue.put(TlgResult(self.wiki, row, self.parent))
     
     def getPreferredPagesPerAction(self):
         return 500
@@ -37,17 +39,14 @@ class FAllCategories(FlawFilter):
     label= _('All Categories')
     description= _('Show all categories without filtering.')
     
+    usesPageStore= True
+    
     # our action class
     class Action(TlgAction):
         def execute(self, resultQueue):
-            cur= getCursors()[self.wiki]
-            format_strings = ' OR '.join(['page_id=%s'] * len(self.pageIDs))
-            cur.execute("""SELECT page_id, page_namespace, page_title, page_restrictions, page_counter, page_is_redirect, 
-page_is_new, page_random, page_touched, page_latest, page_len 
-FROM page WHERE page_namespace=14 AND page_is_redirect=0 AND (%s)""" % format_strings, self.pageIDs)
-            result= cur.fetchall()
-            for row in result:
-                resultQueue.put(TlgResult(self.wiki, row, self.parent))
+            for row in self.getPageRows(self.pageIDs).itervalues():
+                if row['page_namespace']==14 and row['page_is_redirect']==0:
+                    resultQueue.put(TlgResult(self.wiki, row, self.parent))
     
     def getPreferredPagesPerAction(self):
         return 500
@@ -58,8 +57,13 @@ FROM page WHERE page_namespace=14 AND page_is_redirect=0 AND (%s)""" % format_st
 FlawFilters.register(FAllCategories)
 
 ##  base class for filters which check for lists of templates.
+# the template filters selected in one query are evaluated together: the first of them looks up the templates 
+# of all of them with one query per batch of pages, and puts the results for each filter. the others create no actions.
 # todo: add entries for more languages (?)
 class FTemplatesBase(FlawFilter):
+    # the actions put results for the other template filters of the query, which only exist in this process
+    processSafe= False
+    
     def __init__(self, tlg, templateNames):
         FlawFilter.__init__(self, tlg)
         self.templateNamesForWikis= templateNames
@@ -68,29 +72,41 @@ class FTemplatesBase(FlawFilter):
                 #~ dprint(0, "%s %s: %s" % (wikidb, template, getCategoryID(wikidb, 'Wikipedia:'+template)))
     
     class Action(TlgAction):
+        def __init__(self, parent, language, pages, filters):
+            TlgAction.__init__(self, parent, language, pages)
+            self.filters= filters
+        
         def execute(self, resultQueue):
+            # template title => filters looking for it
+            filtersForTemplates= {}
+            for flaw in self.filters:
+                for template in flaw.templateNamesForWikis.get(self.wiki, ()):
+                    if template: filtersForTemplates.setdefault(template, []).append(flaw)
+            if not filtersForTemplates or not len(self.pageIDs):
+                return
+            
             cur= getCursors()[self.wiki]
-            format_strings = ','.join(['%s'] * len(self.pageIDs))
-            cur.execute('SELECT tl_title, tl_from FROM templatelinks WHERE tl_from IN (%s)' % format_strings, self.pageIDs)
-            sqlres= cur.fetchall()
-
-            # todo: put this into the sql query.
-            for templatelink in sqlres:
-                tl_title= templatelink['tl_title']
-                try:
-                    if tl_title in self.parent.templateNamesForWikis[self.wiki]:
-                        rows= getPageByID(self.wiki, templatelink['tl_from'])
-                        if len(rows):
-                            resultQueue.put(TlgResult(self.wiki, rows[0], self.parent))
-                except KeyError:
-                    # we have no template names for this language version.
-                    pass
+            sqlstr= 'SELECT tl_title, page.* FROM templatelinks JOIN page ON page_id=tl_from ' \
+                'WHERE tl_from IN (%s) AND tl_namespace=10 AND tl_title IN (%s)' % \
+                (','.join(['%s'] * len(self.pageIDs)), ','.join(['%s'] * len(filtersForTemplates)))
+            cur.execute(sqlstr, list(self.pageIDs) + filtersForTemplates.keys())
+            
+            found= set()    # (shortname, page ID)
+            for row in cur.fetchall():
+                tl_title= row.pop('tl_title')
+                for flaw in filtersForTemplates.get(tl_title, ()):
+                    # pages using several templates of a filter are only reported once
+                    if not (flaw.shortname, row['page_id']) in found:
+                        found.add((flaw.shortname, row['page_id']))
+                        resultQueue.put(TlgResult(self.wiki, row, flaw))
 
     def getPreferredPagesPerAction(self):
         return 200
 
     def createActions(self, language, pages, actionQueue):
-        actionQueue.put(self.Action(self, language, pages))
+        filters= self.getQueryFilters(FTemplatesBase)
+        if filters[0] is self:
+            actionQueue.put(self.Action(self, language, pages, filters))
 
 
 ## create a class that filters for templates
@@ -154,57 +170,110 @@ registerTemplateFilter('TemplateGlobalize', _('Template: Globalize'), _('Page ha
 # es gibt auch die möglichkeit, nach '+Wikipedia:Wartungskategorie' mit filter 'All' zu suchen.
 
 
-## 
-# todo: make results usable by both small + large filter
+## the lengths of the tested pages, collected once for all page size filters of a query, with running statistics.
+class PageLengths:
+    def __init__(self):
+        self.lock= threading.Lock()
+        self.pageIDs= array.array('I')
+        self.lengths= array.array('I')
+        self.mean= 0.0
+        self.m2= 0.0            # sum of squared deviations from the mean
+        self.actions= []        # the actions collecting the lengths
+    
+    ## add the lengths of a batch of pages. 
+    # the statistics of the batch are computed outside of the lock and merged into the running statistics (Welford/Chan).
+    def add(self, pageIDs, lengths):
+        n= len(lengths)
+        if not n: return
+        mean= sum(lengths) / float(n)
+        m2= sum([ (length-mean)**2 for length in lengths ])
+        with self.lock:
+            count= len(self.lengths)
+            self.pageIDs.extend(pageIDs)
+            self.lengths.extend(lengths)
+            delta= mean-self.mean
+            self.mean+= delta*n/(count+n)
+            self.m2+= m2 + delta*delta*count*n/(count+n)
+    
+    def getStddev(self):
+        if not len(self.lengths): return 0.0
+        return math.sqrt(self.m2/len(self.lengths))
+    
+    ## get (page ID, length) of the pages shorter than minLength or longer than maxLength.
+    def select(self, minLength= None, maxLength= None):
+        if not len(self.lengths):
+            return []
+        if numpy:
+            lengths= numpy.frombuffer(self.lengths, dtype= numpy.uint32)
+            mask= numpy.zeros(len(lengths), dtype= bool)
+            if minLength!=None: mask|= lengths < minLength
+            if maxLength!=None: mask|= lengths > maxLength
+            indexes= numpy.nonzero(mask)[0].tolist()
+        else:
+            indexes= [ i for (i, length) in enumerate(self.lengths) 
+                if (minLength!=None and length < minLength) or (maxLength!=None and length > maxLength) ]
+        return [ (self.pageIDs[i], self.lengths[i]) for i in indexes ]
+
+## base class for filters which find pages of unusual size, relative to the other pages in the result set.
+# the first page size filter of a query collects the page lengths, the final actions of all of them use them.
 class FPageSizeBase(FlawFilter):
+    # page lengths are collected in the filter object
+    processSafe= False
+    usesPageStore= True
     
     class Action(TlgAction):
-        def execute(self, resultQueue):            
-            cur= getCursors()[self.wiki]
-            format_strings = ','.join(['%s'] * len(self.pageIDs))
-            cur.execute('SELECT page_id, page_len FROM page WHERE page_id IN (%s) AND page_namespace=0 AND page_is_redirect=0' % format_strings, self.pageIDs)
-            rows= cur.fetchall()
-            try:
-                self.parent.pageLengthLock.acquire()
-                for row in rows:
-                    pagelen= row['page_len']
-                    self.parent.pageLengths[row['page_id']]= pagelen
-                    self.parent.lengthSum+= pagelen
-                self.parent.pagesLeft-= len(self.pageIDs)
-            finally:
-                self.parent.pageLengthLock.release()
+        def execute(self, resultQueue):
+            rows= [ row for row in self.getPageRows(self.pageIDs).itervalues() if row['page_namespace']==0 and row['page_is_redirect']==0 ]
+            self.parent.pageLengths.add([ row['page_id'] for row in rows ], [ row['page_len'] for row in rows ])
+        
+        def getResultPageIDs(self):
+            return ()   # results are put by the final action
 
     class FinalAction(TlgAction):
-        # todo: the final action stuff takes a while, maybe this can be optimized.
+        def getResultPageIDs(self):
+            return None
+        
+        ## override this to return (page ID, infotext, sortkey) for the pages to put results for.
+        def findPages(self, pageLengths):
+            raise NotImplementedError("findPages not implemented")
+        
         def execute(self, resultQueue):
             pageLengths= self.parent.pageLengths
-            self.avg= self.parent.lengthSum / float(len(pageLengths))
-            sum= 0
-            for i in pageLengths:
-                delta= pageLengths[i]-self.avg
-                sum+= delta*delta
-            self.stddev= math.sqrt(sum/len(pageLengths))
-            dprint(3, "FTPageSize.FinalAction.execute() lengthSum = %d pages = %d avg length = %f stddev = %f" % (self.parent.lengthSum, len(pageLengths), self.avg, self.stddev))
-
-        def canExecute(self):
-            return self.parent.pagesLeft == 0
+            dprint(3, "%s.FinalAction.execute() pages = %d avg length = %f stddev = %f" % 
+                (self.parent.shortname, len(pageLengths.lengths), pageLengths.mean, pageLengths.getStddev()))
+            found= self.findPages(pageLengths)
+            # fetch the rows of the found pages in bulk
+            for i in range(0, len(found), 1000):
+                chunk= found[i:i+1000]
+                rows= self.getPageRows([ pageID for (pageID, infotext, sortkey) in chunk ])
+                for (pageID, infotext, sortkey) in chunk:
+                    if pageID in rows:
+                        resultQueue.put(TlgResult(self.wiki, rows[pageID], self.parent, infotext, sortkey= sortkey))
             
     def __init__(self, tlg):
         FlawFilter.__init__(self, tlg)
-        self.pagesLeft= len(tlg.getPageIDs())
-        self.finalActionCreated= False
-        self.pageLengths= {}
-        self.pageLengthLock= threading.Lock()
-        self.lengthSum= 0
+        self.finalAction= None
+        self.pageLengths= None      # PageLengths, shared by the page size filters of a query
+        self.collectsLengths= False
     
     def getPreferredPagesPerAction(self):
         return 50
     
     def createActions(self, language, pages, actionQueue):
-        actionQueue.put(self.Action(self, language, pages))
-        if not self.finalActionCreated: 
-            actionQueue.put(self.FinalAction(self, language, self.tlg.getPageIDs))
-            self.finalActionCreated= True
+        if not self.finalAction: 
+            first= self.getQueryFilters(FPageSizeBase)[0]
+            self.collectsLengths= first is self
+            self.pageLengths= PageLengths() if self.collectsLengths else first.pageLengths
+            self.finalAction= self.FinalAction(self, language, self.tlg.getPageIDs)
+            actionQueue.put(self.finalAction)
+            # the other filters create their actions after all actions of the first one exist
+            self.finalAction.dependsOn(self.pageLengths.actions)
+        if self.collectsLengths:
+            action= self.Action(self, language, pages)
+            actionQueue.put(action)
+            self.pageLengths.actions.append(action)
+            # the final action needs the lengths of all pages
+            self.finalAction.dependsOn((action,))
 
 class FSmall(FPageSizeBase):
     shortname= 'Small'
@@ -212,24 +281,8 @@ class FSmall(FPageSizeBase):
     description= _('Page is very small, relative to mean page size in result set.')
     
     class FinalAction(FPageSizeBase.FinalAction):
-        # todo: the final action stuff takes a while, maybe this can be optimized.
-        def execute(self, resultQueue):
-            pageLengths= self.parent.pageLengths
-            if len(pageLengths):
-                self.avg= self.parent.lengthSum / float(len(pageLengths))
-                threshold= self.avg/4
-                for i in pageLengths:
-                    #~ delta= pageLengths[i]-self.avg
-                    #~ if delta > self.stddev*8:
-                        #~ resultQueue.put(TlgResult(self.wiki, getPageByID(self.wiki, i)[0], self.parent))
-                    if pageLengths[i] < threshold:
-                        resultQueue.put(TlgResult(self.wiki, getPageByID(self.wiki, i)[0], self.parent, '%d bytes' % pageLengths[i], sortkey= pageLengths[i]))
-
-    def createActions(self, language, pages, actionQueue):
-        actionQueue.put(FPageSizeBase.Action(self, language, pages))
-        if not self.finalActionCreated: 
-            actionQueue.put(self.FinalAction(self, language, self.tlg.getPageIDs))
-            self.finalActionCreated= True
+        def findPages(self, pageLengths):
+            return [ (pageID, '%d bytes' % length, length) for (pageID, length) in pageLengths.select(minLength= pageLengths.mean/4) ]
 
 FlawFilters.register(FSmall)
 
@@ -240,20 +293,9 @@ class FLarge(FPageSizeBase):
     description= _('Page is very large, relative to mean page size in result set.')
     
     class FinalAction(FPageSizeBase.FinalAction):
-        # todo: the final action stuff takes a while, maybe this can be optimized.
-        def execute(self, resultQueue):
-            FPageSizeBase.FinalAction.execute(self, resultQueue)
-            pageLengths= self.parent.pageLengths
-            for i in pageLengths:
-                delta= pageLengths[i]-self.avg
-                if delta > self.stddev*5:
-                    resultQueue.put(TlgResult(self.wiki, getPageByID(self.wiki, i)[0], self.parent, infotext= '%d bytes' % pageLengths[i], sortkey= -pageLengths[i]))
-
-    def createActions(self, language, pages, actionQueue):
-        actionQueue.put(FPageSizeBase.Action(self, language, pages))
-        if not self.finalActionCreated: 
-            actionQueue.put(self.FinalAction(self, language, self.tlg.getPageIDs))
-            self.finalActionCreated= True
+        def findPages(self, pageLengths):
+            return [ (pageID, '%d bytes' % length, -length) 
+                for (pageID, length) in pageLengths.select(maxLength= pageLengths.mean + pageLengths.getStddev()*5) ]
 
 FlawFilters.register(FLarge)
 
@@ -265,25 +307,32 @@ class FNoImages(FlawFilter):
     shortname= 'NoImages'
     label= _('No Images')
     description= _('Article has no image links.')
+    usesPageStore= True
 
     # our action class
     class Action(TlgAction):
         def execute(self, resultQueue):
+            candidates= [ row for row in self.getPageRows(self.pageIDs).itervalues() if row['page_namespace']==0 and row['page_is_redirect']==0 ]
+            if not candidates:
+                return
+            # find the pages which use images that are not used by any template
+            templateImages= getTemplateImageCache().get(self.wiki)
             cur= getCursors()[self.wiki]
-            format_strings = ','.join(['%s'] * len(self.pageIDs))
-            # IN stuff possibly makes this slow...
-            sqlstr= """SELECT * FROM page WHERE page_namespace=0 AND page_id IN (%s) AND page_is_redirect = 0 
-                AND page_id NOT IN (select il_from FROM imagelinks AS src WHERE il_from IN (%s) 
-                    AND NOT EXISTS (SELECT 1 FROM imagelinks WHERE il_to=src.il_to AND il_from IN (SELECT page_id FROM page WHERE page_namespace=10)));""" % \
-                    (format_strings, format_strings)
-                    #~ AND (SELECT COUNT(*) FROM imagelinks WHERE il_to=src.il_to AND il_from IN (SELECT page_id FROM page WHERE page_namespace=10) LIMIT 1)=0);""" % \
-            dblpages= copy.copy(self.pageIDs)
-            dblpages.extend(self.pageIDs)
-            cur.execute(sqlstr, dblpages)
-            sqlres= cur.fetchall()
-
-            for row in sqlres:
-                resultQueue.put(TlgResult(self.wiki, row, self.parent))
+            format_strings = ','.join(['%s'] * len(candidates))
+            if templateImages!=None:
+                cur.execute('SELECT il_from, il_to FROM imagelinks WHERE il_from IN (%s)' % format_strings, [ row['page_id'] for row in candidates ])
+                withImages= set([ row['il_from'] for row in cur.fetchall() if not row['il_to'] in templateImages ])
+            else:
+                # the set is still being built
+                sqlstr= """SELECT DISTINCT il_from FROM imagelinks AS src WHERE il_from IN (%s) 
+                    AND NOT EXISTS (SELECT 1 FROM imagelinks WHERE il_to=src.il_to AND il_from IN (SELECT page_id FROM page WHERE page_namespace=10));""" % \
+                        (format_strings)
+                cur.execute(sqlstr, [ row['page_id'] for row in candidates ])
+                withImages= set([ row['il_from'] for row in cur.fetchall() ])
+
+            for row in candidates:
+                if not row['page_id'] in withImages:
+                    resultQueue.put(TlgResult(self.wiki, row, self.parent))
 
 
     def getPreferredPagesPerAction(self):
@@ -299,22 +348,36 @@ class FLonely(FlawFilter):
     shortname= 'Lonely'
     label= _('No Links to this article')
     description= _('Article is not linked from any other article.')
+    usesPageStore= True
 
     # our action class
     class Action(TlgAction):
         def execute(self, resultQueue):
-            cur= getCursors()[self.wiki]
-            format_strings = ' OR '.join(['page_id=%s'] * len(self.pageIDs))
+            candidates= [ row for row in self.getPageRows(self.pageIDs).itervalues() if row['page_namespace']==0 and row['page_is_redirect']==0 ]
+            if not candidates:
+                return
             
-            sqlstr= """SELECT * FROM page WHERE (%s) AND page_namespace=0 AND page_is_redirect=0 
-                AND NOT EXISTS (SELECT 1 FROM pagelinks WHERE pl_title=page_title AND pl_namespace=0)""" \
-                % (format_strings)
-                #~ AND (SELECT COUNT(*) FROM pagelinks WHERE pl_from=page_id AND pl_namespace=0 LIMIT 1)=0""" 
-            cur.execute(sqlstr, self.pageIDs)
-            sqlres= cur.fetchall()
+            # look up the link counts in the index. pages it leaves out (not indexed, or with low counts which might 
+            # be outdated), or all of them if it is stale, are checked in the database.
+            index= getInDegreeIndex(self.wiki)
+            inDegrees= index.getInDegrees([ row['page_id'] for row in candidates ]) if index else None
+            if inDegrees==None: inDegrees= {}
+            unknown= [ row for row in candidates if not row['page_id'] in inDegrees ]
+            linked= set()
+            if unknown:
+                cur= getCursors()[self.wiki]
+                format_strings = ','.join(['%s'] * len(unknown))
+                # find the titles which are linked from somewhere
+                sqlstr= """SELECT DISTINCT pl_title FROM pagelinks WHERE pl_namespace=0 AND pl_title IN (%s)""" % (format_strings)
+                cur.execute(sqlstr, [ row['page_title'] for row in unknown ])
+                linked= set([ row['pl_title'] for row in cur.fetchall() ])
             
-            for row in sqlres:
-                resultQueue.put(TlgResult(self.wiki, row, self.parent))
+            for row in candidates:
+                if row['page_id'] in inDegrees:
+                    if inDegrees[row['page_id']]==0:
+                        resultQueue.put(TlgResult(self.wiki, row, self.parent))
+                elif not row['page_title'] in linked:
+                    resultQueue.put(TlgResult(self.wiki, row, self.parent))
 
 
     def getPreferredPagesPerAction(self):
@@ -2,6 +2,7 @@
 # -*- coding:utf-8 -*-
 import time
 import datetime
+import itertools
 import requests
 from tlgflaws import *
 from utils import *
@@ -41,22 +42,21 @@ class FPagehits(FlawFilter):
             return str(ex)  # ....
         return '?'
     
+    usesPageStore= True
+    
     # our action class
     class Action(TlgAction):
         def execute(self, resultQueue):
-            cur= getCursors()[self.wiki]
-            format_strings = ' OR '.join(['page_id=%s'] * len(self.pageIDs))
-            cur.execute("""SELECT page_id, page_namespace, page_title, page_restrictions, page_counter, page_is_redirect, 
-page_is_new, page_random, page_touched, page_latest, page_len 
-FROM page WHERE (page_namespace=0 OR page_namespace=6) AND page_is_redirect=0 AND (%s)""" % format_strings, self.pageIDs)
-            res= cur.fetchall()
+            res= [ row for row in self.getPageRows(self.pageIDs).itervalues() 
+                   if (row['page_namespace']==0 or row['page_namespace']==6) and row['page_is_redirect']==0 ]
             
             lastmonth= datetime.datetime.fromtimestamp(time.time())
             statyear= lastmonth.year
             statmonth= lastmonth.month
             
-            for row in res:
-                count= self.parent.getHitcount(statyear, statmonth, row['page_title'])
+            # the requests are sent concurrently, most of the time is spent waiting for the server
+            getHitcount= lambda row: self.parent.getHitcount(statyear, statmonth, row['page_title'])
+            for row, count in itertools.izip(res, self.mapConcurrent(getHitcount, res)):
                 filtertitle= 'count: %s' % count
                 sortkey= -int(count) if isInt_str(count) else 1
                 resultQueue.put(TlgResult(self.wiki, row, self.parent, filtertitle, sortkey= sortkey))
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for the adaptive batch sizes of filter actions
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import shutil
+import tempfile
+import unittest
+import tlgflaws
+from tlgbatching import BatchSizer
+from tlgpageids import PageIDSet
+
+class FakeFilter(tlgflaws.FlawFilter):
+    shortname= 'Fake'
+
+    def getPreferredPagesPerAction(self):
+        return 10
+
+class BatchSizerTest(unittest.TestCase):
+    def setUp(self):
+        self.flaw= FakeFilter(None)
+
+    def record(self, sizer, numPages, seconds, flaw= None):
+        sizer.record(tlgflaws.TlgAction(flaw or self.flaw, 'de', range(numPages)), seconds)
+
+    def testMovingAverage(self):
+        sizer= BatchSizer(None, 2.0)
+        # nothing measured yet
+        self.assertEqual(sizer.getPagesPerAction('dewiki_p', self.flaw), 10)
+        self.assertEqual(sizer.getSplitSize(tlgflaws.TlgAction(self.flaw, 'de', range(100))), None)
+        self.record(sizer, 10, 1.0)
+        self.assertAlmostEqual(sizer.secondsPerPage['dewiki_p:Fake'], 0.1)
+        self.record(sizer, 5, 1.0)
+        self.assertAlmostEqual(sizer.secondsPerPage['dewiki_p:Fake'], 0.7*0.1 + 0.3*0.2)
+        self.assertEqual(sizer.getPagesPerAction('dewiki_p', self.flaw), int(2.0/0.13))
+        # measurements are kept per wiki and filter
+        self.assertEqual(sizer.getPagesPerAction('enwiki_p', self.flaw), 10)
+        other= FakeFilter(None)
+        other.shortname= 'Other'
+        self.assertEqual(sizer.getPagesPerAction('dewiki_p', other), 10)
+        # actions without a sequence of pages are not measured
+        sizer.record(tlgflaws.TlgAction(self.flaw, 'de', None), 100.0)
+        self.record(sizer, 0, 100.0)
+        self.assertAlmostEqual(sizer.secondsPerPage['dewiki_p:Fake'], 0.13)
+        # page ID sets are sliced into arrays
+        sizer.record(tlgflaws.TlgAction(self.flaw, 'de', PageIDSet(range(20))[:10]), 2.6)
+        self.assertAlmostEqual(sizer.secondsPerPage['dewiki_p:Fake'], 0.7*0.13 + 0.3*0.26)
+
+    def testLimits(self):
+        sizer= BatchSizer(None, 2.0, 4)
+        # fast filters get at most maxGrowth times their preferred size
+        self.record(sizer, 100, 0.001)
+        self.assertEqual(sizer.getPagesPerAction('dewiki_p', self.flaw), 40)
+        # the split size is not capped, so fast actions are not split
+        self.assertTrue(sizer.getSplitSize(tlgflaws.TlgAction(self.flaw, 'de', range(100))) > 100000)
+        # slow filters get one page per action
+        sizer= BatchSizer(None, 2.0, 4)
+        self.record(sizer, 1, 60.0)
+        self.assertEqual(sizer.getPagesPerAction('dewiki_p', self.flaw), 1)
+        self.assertEqual(sizer.getSplitSize(tlgflaws.TlgAction(self.flaw, 'de', range(100))), 1)
+
+    def testSplit(self):
+        action= tlgflaws.TlgAction(self.flaw, 'de', range(25))
+        parts= action.split(10)
+        self.assertEqual([ part.pageIDs for part in parts ], [ range(10), range(10, 20), range(20, 25) ])
+        self.assertTrue(all([ part.parent is self.flaw for part in parts ]))
+        # actions less than twice the size are not split
+        self.assertEqual(action.split(13), None)
+        self.assertEqual(len(action.split(12)), 3)
+        self.assertEqual(len(tlgflaws.TlgAction(self.flaw, 'de', PageIDSet(range(25))[:]).split(1)), 25)
+        # nor are actions which put results for other pages
+        self.flaw.resultsForOtherPages= True
+        self.assertEqual(action.split(1), None)
+
+    def testSaveLoad(self):
+        tempdir= tempfile.mkdtemp()
+        try:
+            filename= os.path.join(tempdir, 'batchsizes.json')
+            sizer= BatchSizer(filename, 2.0)
+            self.record(sizer, 10, 1.0)
+            sizer.save()
+            self.assertEqual(os.listdir(tempdir), [ 'batchsizes.json' ])
+            self.assertEqual(BatchSizer(filename, 2.0).getPagesPerAction('dewiki_p', self.flaw), 20)
+            # a broken file is ignored
+            with open(filename, 'w') as f:
+                f.write('{"dewiki_p:Fa')
+            self.assertEqual(BatchSizer(filename, 2.0).getPagesPerAction('dewiki_p', self.flaw), 10)
+        finally:
+            shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for the process-wide pool of database connections
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import time
+import threading
+import unittest
+import MySQLdb
+import utils
+from utils import ConnectionPool, ConnectionPoolTimeout
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn= conn
+        self.closed= False
+
+    def execute(self, query, args= None):
+        pass
+
+    def close(self):
+        self.closed= True
+
+class FakeConnection:
+    def __init__(self, host):
+        self.host= host
+        self.broken= False      # ping and rollback fail, e. g. after the server closed the connection
+        self.closed= False
+
+    def ping(self):
+        if self.broken: raise MySQLdb.OperationalError('server has gone away')
+
+    def rollback(self):
+        if self.broken: raise MySQLdb.OperationalError('server has gone away')
+
+    def close(self):
+        self.closed= True
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def escape_string(self, s):
+        return s
+
+## a pool which opens fake connections.
+class FakePool(ConnectionPool):
+    def __init__(self, *args, **kwargs):
+        ConnectionPool.__init__(self, *args, **kwargs)
+        self.connections= []
+
+    def connect(self, host):
+        conn= FakeConnection(host)
+        self.connections.append(conn)
+        return conn
+
+class ConnectionPoolTest(unittest.TestCase):
+    def testReuse(self):
+        pool= FakePool(2)
+        conn= pool.checkout('a')
+        pool.checkin('a', conn)
+        self.assertTrue(pool.checkout('a') is conn)
+        # connections are kept per host
+        self.assertFalse(pool.checkout('b') is conn)
+        self.assertEqual(pool.getStats()['connects'], 2)
+
+    def testCheckoutTimeout(self):
+        pool= FakePool(2)
+        conns= [ pool.checkout('a'), pool.checkout('a') ]
+        begin= time.time()
+        self.assertRaises(ConnectionPoolTimeout, pool.checkout, 'a', 0.1)
+        self.assertTrue(time.time()-begin >= 0.1)
+        self.assertEqual(pool.getStats()['timeouts'], 1)
+        # other hosts are not affected
+        pool.checkin('b', pool.checkout('b'))
+        # a waiting checkout gets the connection which is returned
+        threading.Timer(0.1, pool.checkin, ('a', conns[0])).start()
+        self.assertTrue(pool.checkout('a', 5) is conns[0])
+        self.assertEqual(pool.getStats()['waits'], 2)
+        self.assertEqual(pool.getStats()['open'], 3)
+
+    def testBrokenConnections(self):
+        pool= FakePool(1, checkInterval= 0)
+        conn= pool.checkout('a')
+        # a connection which can't be rolled back is closed instead of being returned to the pool
+        conn.broken= True
+        pool.checkin('a', conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.getStats()['open'], 0)
+        # its slot is free again
+        conn= pool.checkout('a', 0.1)
+        self.assertFalse(conn.broken)
+        # idle connections which fail the health check are replaced
+        pool.checkin('a', conn)
+        conn.broken= True
+        other= pool.checkout('a', 0.1)
+        self.assertFalse(other is conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.getStats()['failed_health_checks'], 1)
+
+    def testIdleTimeout(self):
+        pool= FakePool(2, idleTimeout= 0.05)
+        conn= pool.checkout('a')
+        pool.checkin('a', conn)
+        time.sleep(0.1)
+        self.assertFalse(pool.checkout('a') is conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.getStats()['reaped'], 1)
+
+    def testReleaseThreadConnections(self):
+        pool= FakePool(4)
+        saved= utils.connectionPool
+        utils.connectionPool= pool
+        try:
+            # each thread gets its own connections, which are returned when the thread releases them
+            acquired= threading.Event()
+            release= threading.Event()
+            cursors= []
+            def run():
+                with utils.TempCursor('a', 'dewiki_p') as cur:
+                    cursors.append(cur)
+                acquired.set()
+                release.wait(5)
+                utils.releaseThreadConnections()
+            thread= threading.Thread(target= run)
+            thread.start()
+            acquired.wait(5)
+            with utils.TempCursor('a', 'dewiki_p') as cur:
+                cursors.append(cur)
+                # the same thread gets the same cursor again
+                with utils.TempCursor('a', 'dewiki_p') as again:
+                    self.assertTrue(again is cur)
+            self.assertFalse(cursors[0].conn is cursors[1].conn)
+            self.assertEqual(pool.getStats()['idle'], 0)
+            release.set()
+            thread.join(5)
+            self.assertTrue(cursors[0].closed)
+            self.assertEqual(pool.idle['a'], [ (cursors[0].conn, pool.idle['a'][0][1]) ])
+            # the connection of this thread is still in use
+            self.assertFalse(cursors[1].closed)
+            utils.releaseThreadConnections()
+            self.assertEqual(pool.getStats()['idle'], 2)
+            self.assertEqual(pool.getStats()['open'], 2)
+        finally:
+            utils.connectionPool= saved
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for filter infrastructure
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import unittest
+import multiprocessing
+import tlgflaws
+import tlgbackend
+
+def square(i):
+    return i*i
+
+# runs in a worker process
+def mapSquares(n):
+    return list(tlgflaws.mapConcurrent(square, range(n), 4))
+
+class MapConcurrentTest(unittest.TestCase):
+    def testOrder(self):
+        self.assertEqual(list(tlgflaws.mapConcurrent(square, range(100), 7)), [ i*i for i in range(100) ])
+
+    def testInWorkerProcess(self):
+        # the parent's I/O pool exists before the worker processes are forked
+        tlgflaws.getIOPool()
+        pool= multiprocessing.Pool(1, tlgbackend.initWorkerProcess)
+        try:
+            self.assertEqual(pool.apply_async(mapSquares, (10,)).get(30), [ i*i for i in range(10) ])
+        finally:
+            pool.terminate()
+
+
+if __name__ == '__main__':
+    unittest.main()
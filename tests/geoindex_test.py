@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for the local spatial index of geotagged pages
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import time
+import array
+import random
+import threading
+import unittest
+import geobbox
+import tlggeoindex
+from tlggeoindex import GeoIndex
+
+## an in-memory geo_tags table which answers the queries of GeoIndex.
+class FakeGeoTags:
+    def __init__(self, rnd):
+        self.rows= {}       # gt_id => (gt_id, page_id, lat, lon)
+        points= []
+        for i in range(600):
+            # around the 180 degree meridian, around the poles, and anywhere
+            kind= i%4
+            if kind==0: lat, lon= rnd.uniform(-60, 60), rnd.choice([ rnd.uniform(178, 180), rnd.uniform(-180, -178) ])
+            elif kind==1: lat, lon= rnd.uniform(87, 90), rnd.uniform(-180, 180)
+            elif kind==2: lat, lon= rnd.uniform(-90, -87), rnd.uniform(-180, 180)
+            else: lat, lon= rnd.uniform(-90, 90), rnd.uniform(-180, 180)
+            points.append((lat, lon))
+        # the index keeps coordinates as 32 bit floats. the reference uses the same values.
+        lats= array.array('f', [ lat for (lat, lon) in points ])
+        lons= array.array('f', [ lon for (lat, lon) in points ])
+        for i in range(len(points)):
+            self.rows[i+1]= (i+1, 1000+i, lats[i], lons[i])
+
+    def execute(self, query, args):
+        if 'gt_id IN' in query:
+            return [ { 'gt_id': gtID } for gtID in args if gtID in self.rows ]
+        if 'BETWEEN' in query:
+            (latMin, latMax, lonMin, lonMax)= args
+            rows= [ row for row in self.rows.values() if latMin <= row[2] <= latMax and lonMin <= row[3] <= lonMax ]
+        elif 'gt_id >' in query:
+            rows= sorted([ row for row in self.rows.values() if row[0] > args[0] ])[:args[1]]
+        else:
+            raise AssertionError('unexpected query: %s' % query)
+        return [ { 'gt_id': row[0], 'gt_page_id': row[1], 'gt_lat': row[2], 'gt_lon': row[3] } for row in rows ]
+
+    ## (distance, gt_id, page_id) of all rows within distance km of a point, sorted by distance.
+    def findNear(self, lat, lon, distance):
+        result= [ (geobbox.distance_between_points(lat, lon, row[2], row[3]), row[0], row[1]) for row in self.rows.values() ]
+        return sorted([ r for r in result if r[0] <= distance ])
+
+class FakeCursor:
+    def __init__(self, table):
+        self.table= table
+
+    def execute(self, query, args= None):
+        self.rows= self.table.execute(query, args)
+
+    def fetchall(self):
+        return self.rows
+
+class GeoIndexTest(unittest.TestCase):
+    # centers near the 180 degree meridian, near the poles and on the poles
+    centers= [ (0, 179.9), (10, -179.5), (-45, 180), (89.5, 20), (90, 0), (-89.9, -100), (-90, 0), (88, 179), (30, 10) ]
+    distances= [ 10, 150, 600, 2500 ]
+
+    def setUp(self):
+        self.table= FakeGeoTags(random.Random(1))
+        table= self.table
+        class TempCursor:
+            def __init__(self, host, dbname): pass
+            def __enter__(self): return FakeCursor(table)
+            def __exit__(self, *args): pass
+        self.saved= (tlggeoindex.TempCursor, tlggeoindex.getDatabaseHost, tlggeoindex.releaseThreadConnections, tlggeoindex.numpy)
+        tlggeoindex.TempCursor= TempCursor
+        tlggeoindex.getDatabaseHost= lambda dbname: 'localhost'
+        tlggeoindex.releaseThreadConnections= lambda: None
+        tlggeoindex.numpy= None     # exact comparison with the reference distances
+
+    def tearDown(self):
+        tlggeoindex.TempCursor, tlggeoindex.getDatabaseHost, tlggeoindex.releaseThreadConnections, tlggeoindex.numpy= self.saved
+
+    def testCellRanges(self):
+        index= GeoIndex('testwiki_p')
+        # boxes crossing the 180 degree meridian are split
+        # (100 km are 0.9 degrees at the equator)
+        self.assertEqual(sorted(index.getCellRanges(0, 179.9, 100)), [ ((89, 90), (0, 0)), ((89, 90), (359, 359)) ])
+        self.assertEqual(sorted(index.getCellRanges(0, -179.9, 100)), [ ((89, 90), (0, 0)), ((89, 90), (359, 359)) ])
+        self.assertEqual(sorted(index.getCellRanges(0, 179.5, 200)), [ ((88, 91), (0, 1)), ((88, 91), (357, 359)) ])
+        # boxes containing a pole span all longitudes and end at the pole (200 km are 1.8 degrees of latitude)
+        self.assertEqual(index.getCellRanges(89.5, 20, 200), [ ((177, 179), (0, 359)) ])
+        self.assertEqual(index.getCellRanges(-89.5, 20, 200), [ ((0, 2), (0, 359)) ])
+        self.assertEqual(index.getCellRanges(30, 10, 50), [ ((119, 120), (189, 190)) ])
+
+    def checkFindNear(self, index):
+        for (lat, lon) in self.centers:
+            for distance in self.distances:
+                self.assertEqual(index.findNear(lat, lon, distance), self.table.findNear(lat, lon, distance), (lat, lon, distance))
+                self.assertEqual(index.findPageIDsInRadius(lat, lon, distance),
+                    set([ pageID for (d, gtID, pageID) in self.table.findNear(lat, lon, distance) ]))
+
+    def testFindNear(self):
+        index= GeoIndex('testwiki_p')
+        index.build()
+        self.checkFindNear(index)
+
+    def testFindNearWithoutIndex(self):
+        # the candidates are fetched from the database
+        self.checkFindNear(GeoIndex('testwiki_p'))
+
+    def testNearest(self):
+        index= GeoIndex('testwiki_p')
+        index.build()
+        for (lat, lon) in self.centers:
+            reference= [ pageID for (d, gtID, pageID) in self.table.findNear(lat, lon, 50000) ]
+            for k in (1, 5, 50):
+                self.assertEqual(index.findNearestPageIDs(lat, lon, k), reference[:k])
+                self.assertEqual(index.findNearestPageIDs(lat, lon, k, reference[0]), reference[1:k+1])
+
+    def testDeletedAndAdded(self):
+        index= GeoIndex('testwiki_p')
+        index.build()
+        (d, gtID, pageID)= self.table.findNear(0, 179.9, 600)[0]
+        del self.table.rows[gtID]
+        self.table.rows[1000]= (1000, 5000, 0.0, 179.9)
+        index.refresh()
+        self.assertEqual(index.findNear(0, 179.9, 600), self.table.findNear(0, 179.9, 600))
+
+    def testBackgroundUpdate(self):
+        index= GeoIndex('testwiki_p')
+        fetchRows= index.fetchRows
+        release= threading.Event()
+        def slowFetchRows(minGtID):
+            release.wait(10)
+            return fetchRows(minGtID)
+        index.fetchRows= slowFetchRows
+        # queries don't wait for the build
+        index.startUpdate(10*60, 24*60*60)
+        self.assertTrue(index.updating)
+        self.assertEqual(index.findNear(0, 179.9, 600), self.table.findNear(0, 179.9, 600))
+        release.set()
+        for i in range(100):
+            with index.lock:
+                if not index.updating: break
+            time.sleep(0.05)
+        self.assertTrue(index.built)
+        self.assertEqual(index.findNear(0, 179.9, 600), self.table.findNear(0, 179.9, 600))
+
+
+if __name__ == '__main__':
+    unittest.main()
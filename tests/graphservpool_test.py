@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for the pool of graphserv connections
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import time
+import socket
+import unittest
+import tlgcatgraph
+from tlgcatgraph import GraphservPool, CatGraphInterface
+
+class FakeConnection:
+    def __init__(self, key):
+        self.key= key
+        self.tainted= False     # set by gp.client after protocol errors
+        self.closed= False
+        self.alive= True        # False when the server has closed the connection
+
+    def ping(self):
+        if not self.alive: raise socket.error('connection reset by peer')
+
+    def isClosed(self):
+        return self.closed
+
+    def close(self):
+        self.closed= True
+
+    def fail(self):
+        raise socket.error('connection reset by peer')
+
+## a pool which opens fake connections.
+class FakePool(GraphservPool):
+    def __init__(self, *args, **kwargs):
+        GraphservPool.__init__(self, *args, **kwargs)
+        self.connections= []
+
+    def connect(self, host, port, graphname):
+        conn= FakeConnection((host, port, graphname))
+        self.connections.append(conn)
+        return conn
+
+class GraphservPoolTest(unittest.TestCase):
+    def testReuse(self):
+        pool= FakePool(2)
+        conn= pool.checkout('h', 6666, 'dewiki')
+        pool.checkin('h', 6666, 'dewiki', conn)
+        self.assertTrue(pool.checkout('h', 6666, 'dewiki') is conn)
+        # connections are kept per host, port and graph
+        pool.checkin('h', 6666, 'dewiki', conn)
+        self.assertFalse(pool.checkout('h', 6666, 'enwiki') is conn)
+        self.assertFalse(pool.checkout('h', 6667, 'dewiki') is conn)
+        self.assertEqual(pool.getStats()['connects'], 3)
+        # at most maxIdle connections are kept
+        conns= [ pool.checkout('h', 6666, 'dewiki') for i in range(3) ]
+        for c in conns: pool.checkin('h', 6666, 'dewiki', c)
+        self.assertEqual([ c.closed for c in conns ], [ False, False, True ])
+        self.assertEqual(pool.getStats()['idle'], 2)
+
+    def testReconnect(self):
+        pool= FakePool(4)
+        for how in ('broken', 'tainted', 'closed'):
+            conn= pool.checkout('h', 6666, 'dewiki')
+            if how=='tainted': conn.tainted= True
+            if how=='closed': conn.closed= True
+            pool.checkin('h', 6666, 'dewiki', conn, how=='broken')
+            # the connection is closed, and the next checkout connects again
+            self.assertTrue(conn.closed, how)
+            other= pool.checkout('h', 6666, 'dewiki')
+            self.assertFalse(other is conn, how)
+            pool.checkin('h', 6666, 'dewiki', other)
+            self.assertTrue(pool.checkout('h', 6666, 'dewiki') is other)
+        self.assertEqual(pool.getStats()['discarded'], 3)
+
+    def testHealthCheck(self):
+        pool= FakePool(4, checkInterval= 0)
+        conn= pool.checkout('h', 6666, 'dewiki')
+        pool.checkin('h', 6666, 'dewiki', conn)
+        # the server closed the connection while it was idle
+        conn.alive= False
+        other= pool.checkout('h', 6666, 'dewiki')
+        self.assertFalse(other is conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.getStats()['failed_health_checks'], 1)
+        pool.checkin('h', 6666, 'dewiki', other)
+        self.assertTrue(pool.checkout('h', 6666, 'dewiki') is other)
+
+    def testIdleTimeout(self):
+        pool= FakePool(4, idleTimeout= 0.05)
+        conn= pool.checkout('h', 6666, 'dewiki')
+        pool.checkin('h', 6666, 'dewiki', conn)
+        time.sleep(0.1)
+        self.assertFalse(pool.checkout('h', 6666, 'enwiki') is conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.getStats()['reaped'], 1)
+
+    def testCatGraphInterface(self):
+        saved= tlgcatgraph.graphservPool
+        tlgcatgraph.graphservPool= FakePool(4)
+        try:
+            cg= CatGraphInterface('h', 6666, 'dewiki')
+            conn= cg.gp
+            cg.close()
+            cg= CatGraphInterface('h', 6666, 'dewiki')
+            self.assertTrue(cg.gp is conn)
+            # a failed command makes the interface return a broken connection
+            self.assertRaises(socket.error, cg.call, conn.fail)
+            cg.close()
+            self.assertTrue(conn.closed)
+            cg= CatGraphInterface('h', 6666, 'dewiki')
+            self.assertFalse(cg.gp is conn)
+            cg.close()
+        finally:
+            tlgcatgraph.graphservPool= saved
+
+
+if __name__ == '__main__':
+    unittest.main()
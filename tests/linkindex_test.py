@@ -0,0 +1,152 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for the local link index used by the Lonely filter
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import time
+import random
+import shutil
+import tempfile
+import unittest
+import utils
+import tlglinkindex
+from tlglinkindex import InDegreeIndex
+
+## an in-memory wiki database which answers the queries of InDegreeIndex.
+class FakeWiki:
+    def __init__(self, rnd, numPages):
+        self.pages= dict([ (i, { 'page_id': i, 'page_title': 'T%d' % i, 'page_namespace': 0 if i%5 else 1 }) for i in range(1, numPages+1) ])
+        self.links= set([ (rnd.randint(1, numPages), 'T%d' % rnd.randint(1, numPages)) for i in range(numPages*2) ])   # (pl_from, pl_title)
+        self.recentchanges= []      # (rc_timestamp, rc_cur_id)
+        self.lastBuildQueryTime= 0     # time of the last query counting a range of page IDs, as build() does
+
+    def change(self, pageID):
+        self.recentchanges.append((utils.MakeMWTimestamp(), pageID))
+
+    def getInDegree(self, title):
+        return len([ 1 for (source, target) in self.links if target==title ])
+
+    def getArticles(self):
+        return [ page for page in self.pages.values() if page['page_namespace']==0 ]
+
+    def execute(self, query, args):
+        args= list(args or ())
+        if 'MAX(page_id)' in query:
+            return [ { 'maxid': max(self.pages) } ]
+        if 'AS indegree' in query:
+            if 'page_id >= %s AND page_id < %s' in query: 
+                self.lastBuildQueryTime= time.time()
+                pages= [ p for p in self.getArticles() if args[0] <= p['page_id'] < args[1] ]
+            elif 'page_id IN' in query: pages= [ p for p in self.getArticles() if p['page_id'] in args ]
+            else: pages= [ p for p in self.getArticles() if p['page_id'] > args[0] ]
+            return [ { 'page_id': p['page_id'], 'indegree': self.getInDegree(p['page_title']) } for p in pages ]
+        if 'recentchanges' in query:
+            return [ { 'rc_cur_id': pageID } for (timestamp, pageID) in self.recentchanges if timestamp >= args[0] ]
+        if 'JOIN page' in query:
+            byTitle= dict([ (p['page_title'], p['page_id']) for p in self.getArticles() ])
+            return [ { 'page_id': byTitle[target] } for (source, target) in self.links if source in args and target in byTitle ]
+        raise AssertionError('unexpected query: %s' % query)
+
+class FakeCursor:
+    def __init__(self, wiki):
+        self.wiki= wiki
+
+    def execute(self, query, args= None):
+        self.rows= self.wiki.execute(query, args)
+
+    def fetchall(self):
+        return self.rows
+
+class InDegreeIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.indexDir= tempfile.mkdtemp()
+        self.wiki= FakeWiki(random.Random(1), 300)
+        wiki= self.wiki
+        class TempCursor:
+            def __init__(self, host, dbname): pass
+            def __enter__(self): return FakeCursor(wiki)
+            def __exit__(self, *args): pass
+        self.saved= (tlglinkindex.TempCursor, tlglinkindex.getDatabaseHost, tlglinkindex.releaseThreadConnections)
+        tlglinkindex.TempCursor= TempCursor
+        tlglinkindex.getDatabaseHost= lambda dbname: 'localhost'
+        tlglinkindex.releaseThreadConnections= lambda: None
+
+    def tearDown(self):
+        tlglinkindex.TempCursor, tlglinkindex.getDatabaseHost, tlglinkindex.releaseThreadConnections= self.saved
+        shutil.rmtree(self.indexDir)
+
+    def createIndex(self, verifyCount= 0):
+        index= InDegreeIndex('testwiki_p', self.indexDir, 15*60, 60*60, 7*24*60*60, verifyCount)
+        index.chunkSize= 7
+        index.checked= time.time()      # no background updates unless a test asks for them
+        return index
+
+    def expected(self, verifyCount= 0):
+        result= {}
+        for page in self.wiki.getArticles():
+            count= self.wiki.getInDegree(page['page_title'])
+            if count==0 or count > verifyCount: result[page['page_id']]= count
+        return result
+
+    def testBuild(self):
+        index= self.createIndex()
+        self.assertEqual(index.getInDegrees([ 1, 2, 3 ]), None)
+        index.runUpdate(index.build)
+        articles= [ p['page_id'] for p in self.wiki.getArticles() ]
+        self.assertEqual(index.getInDegrees(articles), self.expected())
+        # the age is counted from the end of the build
+        self.assertTrue(index.meta['built'] >= self.wiki.lastBuildQueryTime)
+        # another process loads the saved index
+        other= self.createIndex()
+        other.load()
+        self.assertEqual(other.getInDegrees(articles), self.expected())
+
+    def testRefresh(self):
+        index= self.createIndex()
+        index.runUpdate(index.build)
+        # links added to existing and to new articles
+        self.wiki.links.add((1, 'T2'))
+        self.wiki.change(1)
+        self.wiki.pages[400]= { 'page_id': 400, 'page_title': 'T400', 'page_namespace': 0 }
+        self.wiki.links.add((3, 'T400'))
+        self.wiki.change(3)
+        index.runUpdate(index.refresh)
+        articles= [ p['page_id'] for p in self.wiki.getArticles() ]
+        self.assertEqual(index.getInDegrees(articles), self.expected())
+        self.assertEqual(index.getInDegrees([ 400 ]), { 400: 1 })
+
+    def testLowCountsLeftOut(self):
+        index= self.createIndex(2)
+        index.runUpdate(index.build)
+        # an article which lost its only link keeps its old count until the next build, but it is not returned
+        (source, target)= [ (s, t) for (s, t) in self.wiki.links if self.wiki.getInDegree(t)==1 and int(t[1:])%5 ][0]
+        self.wiki.links.remove((source, target))
+        self.wiki.change(source)
+        index.runUpdate(index.refresh)
+        articles= [ p['page_id'] for p in self.wiki.getArticles() ]
+        expected= self.expected(2)
+        del expected[int(target[1:])]
+        self.assertEqual(index.getInDegrees(articles), expected)
+
+    def testStale(self):
+        index= self.createIndex()
+        index.runUpdate(index.build)
+        index.meta['updated']= time.time() - 2*60*60
+        self.assertEqual(index.getInDegrees([ 1 ]), None)
+
+    def testBackgroundBuild(self):
+        index= self.createIndex()
+        index.checked= 0
+        # the first lookup starts building the index in a background thread
+        self.assertEqual(index.getInDegrees([ 1 ]), None)
+        for i in range(100):
+            with index.lock:
+                if not index.updating: break
+            time.sleep(0.05)
+        articles= [ p['page_id'] for p in self.wiki.getArticles() ]
+        self.assertEqual(index.getInDegrees(articles), self.expected())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for concurrent I/O-bound calls of filter actions
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import time
+import random
+import threading
+import unittest
+import tlgflaws
+from utils import QueryCancelled
+
+## a call which waits for a random time and keeps track of the number of calls running at the same time.
+class TrackedCall:
+    def __init__(self, rnd):
+        self.lock= threading.Lock()
+        self.running= 0
+        self.maxRunning= 0
+        self.started= []
+        self.delays= dict([ (i, rnd.uniform(0, 0.01)) for i in range(200) ])
+
+    def __call__(self, item):
+        with self.lock:
+            self.running+= 1
+            self.maxRunning= max(self.maxRunning, self.running)
+            self.started.append(item)
+        time.sleep(self.delays[item])
+        with self.lock:
+            self.running-= 1
+        if item==13: raise ValueError(item)
+        return item*2
+
+class MapConcurrentTest(unittest.TestCase):
+    def testOrderAndWindow(self):
+        rnd= random.Random(1)
+        for maxConcurrent in (1, 4, 16):
+            call= TrackedCall(rnd)
+            items= [ i for i in range(200) if i!=13 ]
+            self.assertEqual(list(tlgflaws.mapConcurrent(call, items, maxConcurrent)), [ i*2 for i in items ])
+            self.assertTrue(call.maxRunning <= maxConcurrent, (call.maxRunning, maxConcurrent))
+        self.assertTrue(call.maxRunning > 1)
+
+    def testException(self):
+        call= TrackedCall(random.Random(2))
+        result= tlgflaws.mapConcurrent(call, range(20), 4)
+        self.assertEqual([ result.next() for i in range(13) ], [ i*2 for i in range(13) ])
+        self.assertRaises(ValueError, result.next)
+
+    def testCancel(self):
+        call= TrackedCall(random.Random(3))
+        cancelled= []
+        def checkCancelled():
+            if cancelled: raise QueryCancelled('closed')
+        result= tlgflaws.mapConcurrent(call, range(14, 200), 4, checkCancelled)
+        self.assertEqual(result.next(), 28)
+        cancelled.append(True)
+        self.assertRaises(QueryCancelled, result.next)
+        time.sleep(0.05)
+        # only the calls of the first window were started
+        self.assertTrue(len(call.started) <= 5, call.started)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for compact page ID sets
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import array
+import random
+import operator
+import unittest
+import tlgpageids
+from tlgpageids import PageIDSet
+
+class PageIDSetTest(unittest.TestCase):
+    def setUp(self):
+        self.numpy= tlgpageids.numpy
+
+    def tearDown(self):
+        tlgpageids.numpy= self.numpy
+
+    # compare the set operations with python sets, for random sets of different sizes and overlaps.
+    def checkOperations(self):
+        rnd= random.Random(1)
+        for i in range(300):
+            universe= rnd.choice([ 10, 1000, 2**32-1 ])
+            a= [ rnd.randint(0, universe) for j in range(rnd.randint(0, 200)) ]
+            b= [ rnd.randint(0, universe) for j in range(rnd.randint(0, 200)) ] + rnd.sample(a, len(a)/2)
+            for (op, name) in ((operator.or_, 'or'), (operator.and_, 'and'), (operator.sub, 'sub')):
+                expected= sorted(op(set(a), set(b)))
+                result= op(PageIDSet(a), PageIDSet(b))
+                self.assertTrue(isinstance(result, PageIDSet))
+                self.assertEqual(result.tolist(), expected, name)
+                # the other operand can be any iterable
+                self.assertEqual(op(PageIDSet(a), b).tolist(), expected, name)
+
+    def testOperations(self):
+        tlgpageids.numpy= None
+        self.checkOperations()
+
+    def testOperationsNumpy(self):
+        if not self.numpy:
+            return
+        self.checkOperations()
+
+    def testMergeSorted(self):
+        # very different sizes, and IDs beyond the end of the other array
+        a= array.array('I', range(0, 100000, 7))
+        b= array.array('I', [ 0, 14, 15, 700, 99996, 200000 ])
+        self.assertEqual(tlgpageids.mergeSorted(b, a, True).tolist(), [ 0, 14, 700 ])
+        self.assertEqual(tlgpageids.mergeSorted(b, a, False).tolist(), [ 15, 99996, 200000 ])
+        self.assertEqual(tlgpageids.mergeSorted(a, b, False).tolist(), [ x for x in a if x not in b ])
+
+    def testContainer(self):
+        ids= [ 5, 3, 3, 9, 1 ]
+        s= PageIDSet(ids)
+        self.assertEqual(len(s), 4)
+        self.assertEqual(list(s), [ 1, 3, 5, 9 ])
+        # slices stay compact arrays
+        self.assertEqual(s[1:3], array.array('I', [ 3, 5 ]))
+        self.assertEqual(s[0], 1)
+        for i in range(11):
+            self.assertEqual(i in s, i in ids)
+        self.assertEqual(PageIDSet(s), s)
+        self.assertEqual(PageIDSet(array.array('I', [ 1, 3, 5, 9 ]), True), s)
+        self.assertNotEqual(PageIDSet([ 1 ]), s)
+        self.assertEqual(len(PageIDSet()), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for the page length statistics of the Small and Large filters
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'filtermodules'))
+import math
+import random
+import unittest
+import miscfilters
+from miscfilters import PageLengths
+
+class PageLengthsTest(unittest.TestCase):
+    def setUp(self):
+        self.numpy= miscfilters.numpy
+
+    def tearDown(self):
+        miscfilters.numpy= self.numpy
+
+    def testRunningStats(self):
+        rnd= random.Random(1)
+        for i in range(100):
+            lengths= [ rnd.choice([ rnd.randint(0, 500), rnd.randint(0, 10**6) ]) for j in range(rnd.randint(1, 500)) ]
+            p= PageLengths()
+            # add the lengths in batches of random sizes, as the actions of the filter do
+            start= 0
+            while start < len(lengths):
+                end= start + rnd.randint(0, 50)
+                p.add(range(start, min(end, len(lengths))), lengths[start:end])
+                start= end
+            mean= sum(lengths) / float(len(lengths))
+            stddev= math.sqrt(sum([ (length-mean)**2 for length in lengths ]) / len(lengths))
+            self.assertAlmostEqual(p.mean, mean, delta= 1e-9*max(1, mean))
+            self.assertAlmostEqual(p.getStddev(), stddev, delta= 1e-6*max(1, stddev))
+
+    def testEmpty(self):
+        p= PageLengths()
+        p.add([], [])
+        self.assertEqual(p.getStddev(), 0.0)
+        self.assertEqual(p.select(10, 20), [])
+
+    def checkSelect(self):
+        rnd= random.Random(2)
+        pageIDs= range(1000, 1300)
+        lengths= [ rnd.randint(0, 1000) for pageID in pageIDs ]
+        p= PageLengths()
+        p.add(pageIDs, lengths)
+        for (minLength, maxLength) in ((None, None), (100, None), (None, 900), (300, 700)):
+            expected= [ (pageID, length) for (pageID, length) in zip(pageIDs, lengths)
+                        if (minLength!=None and length < minLength) or (maxLength!=None and length > maxLength) ]
+            self.assertEqual(p.select(minLength, maxLength), expected)
+
+    def testSelect(self):
+        miscfilters.numpy= None
+        self.checkSelect()
+
+    def testSelectNumpy(self):
+        if not self.numpy:
+            return
+        self.checkSelect()
+
+
+if __name__ == '__main__':
+    unittest.main()
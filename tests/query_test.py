@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for query string parsing, compilation and evaluation
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import random
+import unittest
+import utils
+import tlgcatgraph
+import tlgresultcache
+from tlgbackend import TaskListGenerator
+from tlgpageids import PageIDSet
+
+## evaluate a query string from left to right with python sets, like evalQueryString did before graphserv
+# did the set operations. pages is a dict of token => page IDs.
+def referenceEval(string, pages):
+    result= set()
+    n= 0
+    for param in string.split(';'):
+        param= param.strip()
+        if param[0] in '+-':
+            category= param[1:].strip()
+            op= param[0]
+        else:
+            category= param
+            op= '|'
+        if op=='|' or (op=='+' and n==0):
+            result|= set(pages[category])
+        elif op=='+':
+            result&= set(pages[category])
+        elif op=='-' and n!=0:
+            result-= set(pages[category])
+        n+= 1
+    return result
+
+## a CatGraphInterface which records graphserv commands instead of sending them.
+class FakeCatGraph(tlgcatgraph.CatGraphInterface):
+    def __init__(self):
+        self.graphname= 'dewiki'
+        self.wikiname= 'dewiki_p'
+        self.broken= False
+        self.gp= self
+        self.commands= []
+
+    def execute(self, command, data, sink):
+        self.commands.append(command)
+
+class NoTraversalCache:
+    def get(self, graph, catID, depth):
+        return None
+
+class QueryTest(unittest.TestCase):
+    def setUp(self):
+        self.tlg= TaskListGenerator(numthreads= 1)
+        self.config= dict(utils.config)
+        self.getCategoryID= tlgcatgraph.getCategoryID
+        self.getTraversalCache= tlgcatgraph.getTraversalCache
+
+    def tearDown(self):
+        utils.config.clear()
+        utils.config.update(self.config)
+        tlgcatgraph.getCategoryID= self.getCategoryID
+        tlgcatgraph.getTraversalCache= self.getTraversalCache
+
+    def testCompileNormalizesCategoryNames(self):
+        utils.config['graphserv-max-operators']= 1
+        terms= self.tlg.compileQuery(self.tlg.parseQueryString('Biologie; -Katzen und Hunde; +title#Katze und Hund'))
+        self.assertEqual(terms, [ [ [('|', 'Biologie'), ('-', 'Katzen_und_Hunde')], [('&', 'title#Katze und Hund')] ] ])
+
+    def testMultiWordCategoryTerm(self):
+        # category IDs are only found for normalized names, as in the database
+        catIDs= { 'Biologie': 1, 'Katzen_und_Hunde': 2 }
+        tlgcatgraph.getCategoryID= lambda wiki, category: catIDs.get(category)
+        tlgcatgraph.getTraversalCache= NoTraversalCache
+        utils.config['graphserv-max-operators']= 1
+        cg= FakeCatGraph()
+        for (server, client) in self.tlg.compileQuery(self.tlg.parseQueryString('Biologie; -Katzen und Hunde')):
+            cg.getPagesInCategoryTerm(tuple(server), 2)
+        cg.getPagesInCategoryTerm((('|', 'Biologie'), ('&', 'Katzen und Hunde')), 2)
+        self.assertEqual(cg.commands, [ 'traverse-successors 1 2 &&! traverse-successors 2 2',
+                                        'traverse-successors 1 2 && traverse-successors 2 2' ])
+
+    def testEvalMatchesReference(self):
+        rnd= random.Random(1)
+        tokens= [ 'A', 'B b', 'C', 'D', 'title#E', 'geobbox#F,1' ]
+        for maxOperators in (1, 2, 3):
+            utils.config['graphserv-max-operators']= maxOperators
+            for i in range(300):
+                pages= dict([ (token, rnd.sample(range(40), rnd.randint(0, 20))) for token in tokens ])
+                # graphserv and evalQueryToken normalize category names
+                pages.update([ (token.replace(' ', '_'), pages[token]) for token in tokens if not '#' in token ])
+                string= '; '.join([ rnd.choice(['', '+', '-']) + rnd.choice(tokens) for j in range(rnd.randint(1, 6)) ])
+                def fetch(items, depth):
+                    result= []
+                    for item in items:
+                        if isinstance(item, tuple):
+                            p= set(pages[item[0][1]])
+                            for (op, token) in item[1:]:
+                                if op=='&': p&= set(pages[token])
+                                else: p-= set(pages[token])
+                            result.append(list(p))
+                        else:
+                            result.append(pages[item])
+                    return result
+                self.tlg.fetchQueryTerms= fetch
+                result= self.tlg.evalQueryString(string, 2)
+                self.assertTrue(isinstance(result, PageIDSet))
+                self.assertEqual(set(result), referenceEval(string, pages), string)
+
+    def testNormalizeQueryString(self):
+        n= tlgresultcache.normalizeQueryString
+        self.assertEqual(n('B; A; +C; +D D'), n('A ;B;+D_D;  +C'))
+        self.assertNotEqual(n('A; +B; C'), n('A; C; +B'))
+        self.assertEqual(n('-A; +B'), n('-X; +B'))
+        self.assertEqual(n('A; wl#User,token'), None)
+        # queries with the same normalized string have the same result
+        rnd= random.Random(2)
+        tokens= [ 'A', 'B', 'C' ]
+        byKey= {}
+        for i in range(2000):
+            string= '; '.join([ rnd.choice(['', '+', '-']) + rnd.choice(tokens) for j in range(rnd.randint(1, 4)) ])
+            byKey.setdefault(n(string), set()).add(string)
+        for i in range(20):
+            pages= dict([ (token, rnd.sample(range(30), rnd.randint(0, 15))) for token in tokens ])
+            for strings in byKey.values():
+                results= [ referenceEval(string, pages) for string in strings ]
+                self.assertTrue(all([ result==results[0] for result in results ]), strings)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for the cache of complete query results
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import gzip
+import time
+import shutil
+import tempfile
+import unittest
+from tlgresultcache import ResultCache
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cacheDir= tempfile.mkdtemp()
+        self.cache= ResultCache(self.cacheDir, 60)
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir)
+
+    def put(self, key, lines, header= { 'pages_tested': 10, 'result_size': 2 }):
+        writer= self.cache.createWriter(key)
+        for line in lines:
+            writer.write(line)
+        writer.commit(header)
+
+    def testKeys(self):
+        key= self.cache.getKey
+        self.assertEqual(key('de', 'B; A; +C', 2, 'Small NoImages', False, 'default', 0),
+                         key('de', 'A;B ; +C', '2', 'NoImages  Small Small', False, 'default', '0'))
+        for args in (('en', 'A; B; +C', 2, 'Small NoImages', False, 'default', 0), ('de', 'A; B; -C', 2, 'Small NoImages', False, 'default', 0),
+                     ('de', 'A; B; +C', 3, 'Small NoImages', False, 'default', 0), ('de', 'A; B; +C', 2, 'Small', False, 'default', 0),
+                     ('de', 'A; B; +C', 2, 'Small NoImages', True, 'default', 0), ('de', 'A; B; +C', 2, 'Small NoImages', False, 'none', 0),
+                     ('de', 'A; B; +C', 2, 'Small NoImages', False, 'default', 10)):
+            self.assertNotEqual(key(*args), key('de', 'B; A; +C', 2, 'Small NoImages', False, 'default', 0), args)
+        # watchlists are not cached, nor is anything when the cache is disabled
+        self.assertEqual(key('de', 'A; wl#User,token', 2, 'Small', False, 'default', 0), None)
+        self.assertEqual(ResultCache(self.cacheDir, 0).getKey('de', 'A', 2, 'Small', False, 'default', 0), None)
+
+    def testPutGet(self):
+        key= self.cache.getKey('de', 'A', 2, 'Small', False, 'default', 0)
+        self.assertEqual(self.cache.get(key), None)
+        lines= [ '{"status": "x"}', '{"page": {"page_id": %d}}' % 1, u'{"page": {"page_title": "ä"}}'.encode('utf-8') ]
+        self.put(key, lines)
+        header, cached= self.cache.get(key)
+        self.assertEqual(list(cached), lines)
+        self.assertEqual((header['pages_tested'], header['result_size']), (10, 2))
+        self.assertTrue(0 <= header['age'] < 10)
+        # the lines are stored gzipped
+        headername, linesname= self.cache.getFilenames(key)
+        with gzip.open(linesname) as f:
+            self.assertEqual(f.read(), '\n'.join(lines) + '\n')
+
+    def testPartialWrite(self):
+        key= self.cache.getKey('de', 'A', 2, 'Small', False, 'default', 0)
+        self.put(key, [ 'old' ])
+        # readers see the old entry until a new one is committed
+        writer= self.cache.createWriter(key)
+        writer.write('new')
+        self.assertEqual(list(self.cache.get(key)[1]), [ 'old' ])
+        # an aborted result leaves no temporary files
+        writer.abort()
+        self.assertEqual(sorted(os.listdir(self.cacheDir)), sorted([ os.path.basename(f) for f in self.cache.getFilenames(key) ]))
+        self.assertEqual(list(self.cache.get(key)[1]), [ 'old' ])
+        # a result which was never committed is not visible
+        other= self.cache.getKey('de', 'B', 2, 'Small', False, 'default', 0)
+        self.cache.createWriter(other).write('partial')
+        self.assertEqual(self.cache.get(other), None)
+
+    def testExpiry(self):
+        key= self.cache.getKey('de', 'A', 2, 'Small', False, 'default', 0)
+        self.put(key, [ 'line' ])
+        headername, linesname= self.cache.getFilenames(key)
+        time.sleep(0.01)
+        self.assertEqual(ResultCache(self.cacheDir, 0.001).get(key), None)
+        self.assertFalse(os.path.exists(headername) or os.path.exists(linesname))
+
+    def testInvalidate(self):
+        key= self.cache.getKey('de', 'A', 2, 'Small', False, 'default', 0)
+        # a query running while pages are marked as done
+        writer= self.cache.createWriter(key)
+        writer.write('line')
+        time.sleep(0.01)
+        self.cache.invalidate()
+        writer.commit({ 'pages_tested': 1, 'result_size': 1 })
+        self.assertEqual(self.cache.get(key), None)
+        time.sleep(0.01)
+        self.put(key, [ 'line' ])
+        self.assertEqual(list(self.cache.get(key)[1]), [ 'line' ])
+
+
+if __name__ == '__main__':
+    unittest.main()
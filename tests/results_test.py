@@ -0,0 +1,55 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for merging and ordering the results of a query
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import random
+import unittest
+from tlgflaws import TlgResult
+from tlgbackend import MergedResult
+
+class FakeFilter:
+    def __init__(self, shortname):
+        self.shortname= shortname
+        self.label= 'label of %s' % shortname
+
+## the sort key of the results of all filters for a page, as computed from the list of results before MergedResult.
+# number of flaws (descending), flaw list (alphabetical), sort keys, page title (alphabetical).
+def referenceSortKey(results):
+    return (-len(results),
+            sorted([ r.FlawFilter.shortname for r in results ]),
+            sorted([ r.sortkey for r in results ]),
+            results[0].page['page_title'])
+
+class MergedResultTest(unittest.TestCase):
+    def testOrder(self):
+        rnd= random.Random(1)
+        filters= [ FakeFilter(shortname) for shortname in ('ALL', 'Lonely', 'NoCats', 'NoImages', 'Small') ]
+        # bits as assigned by TaskListGenerator: filters which are first in alphabetical order get more significant bits
+        bits= dict([ (f.shortname, 1 << (len(filters)-1-i)) for (i, f) in enumerate(filters) ])
+        for i in range(50):
+            merged= []
+            reference= []
+            for pageID in range(rnd.randint(1, 40)):
+                page= { 'page_id': pageID, 'page_title': rnd.choice(['A', 'B', 'C']) + str(pageID) }
+                results= [ TlgResult('dewiki_p', page, f, 'info of %s' % f.shortname, rnd.randint(0, 3))
+                           for f in rnd.sample(filters, rnd.randint(1, len(filters))) ]
+                m= MergedResult(results[0], bits[results[0].FlawFilter.shortname])
+                for result in results[1:]:
+                    m.add(result, bits[result.FlawFilter.shortname])
+                # a second result of the same filter is ignored
+                duplicate= rnd.choice(results)
+                m.add(TlgResult('dewiki_p', page, duplicate.FlawFilter, 'duplicate', -1), bits[duplicate.FlawFilter.shortname])
+                merged.append(m)
+                reference.append(results)
+                # flaws are listed in alphabetical order of the filters
+                self.assertEqual([ (label, infotext) for (bit, label, infotext, hidden) in m.flaws ],
+                    [ (r.FlawFilter.label, r.infotext) for r in sorted(results, key= lambda r: r.FlawFilter.shortname) ])
+            merged.sort(key= lambda m: m.sortKey)
+            reference.sort(key= referenceSortKey)
+            self.assertEqual([ m.page['page_id'] for m in merged ], [ results[0].page['page_id'] for results in reference ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for the dependency-aware action scheduler
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import random
+import threading
+import unittest
+import tlgflaws
+from tlgbackend import ActionScheduler
+
+class FakeFilter:
+    shortname= 'Fake'
+    resultsForOtherPages= False
+
+## a BatchSizer which splits every action into parts of a fixed size.
+class FixedBatchSizer:
+    def __init__(self, size):
+        self.size= size
+
+    def getSplitSize(self, action):
+        return self.size
+
+    def record(self, action, seconds):
+        pass
+
+def makeAction(pageIDs= ()):
+    return tlgflaws.TlgAction(FakeFilter(), 'de', list(pageIDs))
+
+## execute the actions of a scheduler like the worker threads would, finishing the running actions in random order.
+# returns the actions in the order they were handed out. checks that each action was only handed out after
+# all of its dependencies had finished (split actions are finished by the scheduler when their parts are).
+def runScheduler(test, scheduler, rnd, maxRunning= 4):
+    started= []
+    running= []
+    finished= set()
+    while True:
+        while len(running) < maxRunning:
+            action= scheduler.tryGet()
+            if action==None: break
+            for dep in action.dependencies:
+                test.assertTrue(dep in finished or (dep in scheduler.splitActions and dep in scheduler.finished))
+            started.append(action)
+            running.append(action)
+        if not running:
+            break
+        action= running.pop(rnd.randrange(len(running)))
+        scheduler.taskDone(action)
+        finished.add(action)
+    test.assertTrue(scheduler.isFinished())
+    return started
+
+class ActionSchedulerTest(unittest.TestCase):
+    def testFifo(self):
+        scheduler= ActionScheduler(threading.Condition())
+        actions= [ makeAction() for i in range(20) ]
+        for action in actions: scheduler.put(action)
+        self.assertEqual(scheduler.tryGet(), None)      # nothing is released before start()
+        scheduler.start()
+        self.assertEqual(runScheduler(self, scheduler, random.Random(1), 1), actions)
+
+    def testDependencies(self):
+        rnd= random.Random(2)
+        for i in range(50):
+            actions= []
+            for j in range(rnd.randint(1, 60)):
+                action= makeAction()
+                action.dependsOn(rnd.sample(actions, rnd.randint(0, min(3, len(actions)))))
+                actions.append(action)
+            scheduler= ActionScheduler(threading.Condition())
+            order= actions[:]
+            rnd.shuffle(order)
+            # some actions are put before start(), some while the others are running
+            numEarly= rnd.randint(0, len(order))
+            for action in order[:numEarly]: scheduler.put(action)
+            scheduler.start()
+            for action in order[numEarly:]: scheduler.put(action)
+            started= runScheduler(self, scheduler, rnd)
+            self.assertEqual(sorted(started), sorted(actions))
+            self.assertEqual(scheduler.actionsDone, len(actions))
+
+    def testBarrier(self):
+        scheduler= ActionScheduler(threading.Condition())
+        prefetch= [ makeAction() for i in range(5) ]
+        for action in prefetch: scheduler.put(action)
+        scheduler.setBarrier(prefetch)
+        actions= [ makeAction() for i in range(10) ]
+        for action in actions: scheduler.put(action)
+        scheduler.start()
+        started= runScheduler(self, scheduler, random.Random(3))
+        self.assertEqual(set(started[:5]), set(prefetch))
+        self.assertEqual(started[5:], actions)
+
+    def testSplit(self):
+        scheduler= ActionScheduler(threading.Condition(), FixedBatchSizer(3))
+        action= makeAction(range(10))
+        dependent= makeAction(range(10, 12))
+        dependent.dependsOn((action,))
+        scheduler.put(action)
+        scheduler.put(dependent)
+        scheduler.start()
+        started= runScheduler(self, scheduler, random.Random(4))
+        # the split action is replaced by its parts, the dependent action runs after all of them.
+        # it is too small to be split itself.
+        self.assertFalse(action in started)
+        self.assertEqual([ a.pageIDs for a in started ], [ [0, 1, 2], [3, 4, 5], [6, 7, 8], [9], [10, 11] ])
+        self.assertEqual(scheduler.actionsDone, len(scheduler.actions))
+        self.assertEqual(scheduler.getFilterStats()['Fake']['splits'], 1)
+
+    def testUnsatisfiableDependencies(self):
+        scheduler= ActionScheduler(threading.Condition())
+        a, b= makeAction(), makeAction()
+        a.dependsOn((b,))
+        b.dependsOn((a,))
+        scheduler.put(a)
+        scheduler.put(b)
+        scheduler.start()
+        self.assertEqual(scheduler.tryGet(), None)
+        self.assertRaises(RuntimeError, scheduler.isFinished)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for the cache of images used by templates, and the NoImages filter using it
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'filtermodules'))
+import time
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+import MySQLdb
+import tlgflaws
+import tlgtemplateimages
+import miscfilters
+from tlgtemplateimages import TemplateImageCache
+
+## an in-memory wiki database which answers the queries of TemplateImageCache and the NoImages filter.
+class FakeWiki:
+    def __init__(self, rnd):
+        self.pages= {}
+        for pageID in range(1, 61):
+            namespace= 10 if pageID > 50 else 0
+            self.pages[pageID]= { 'page_id': pageID, 'page_title': 'P%d' % pageID, 'page_namespace': namespace, 'page_is_redirect': int(pageID%7==0) }
+        self.imagelinks= set([ (rnd.randint(1, 60), 'Image%d.jpg' % rnd.randint(1, 40)) for i in range(150) ])
+        self.failure= None      # exception raised by the next query
+
+    def getTemplateImages(self):
+        return set([ image for (pageID, image) in self.imagelinks if self.pages[pageID]['page_namespace']==10 ])
+
+    def execute(self, query, args):
+        if self.failure:
+            raise self.failure
+        args= list(args or ())
+        if 'NOT EXISTS' in query:
+            templateImages= self.getTemplateImages()
+            return [ { 'il_from': pageID } for pageID in set([ pageID for (pageID, image) in self.imagelinks if pageID in args and not image in templateImages ]) ]
+        if 'SELECT DISTINCT il_to' in query:
+            return [ { 'il_to': image } for image in set([ image for (pageID, image) in self.imagelinks if pageID in args ]) ]
+        if 'SELECT il_from, il_to' in query:
+            return [ { 'il_from': pageID, 'il_to': image } for (pageID, image) in self.imagelinks if pageID in args ]
+        if 'page_namespace=10' in query:
+            return [ { 'page_id': page['page_id'] } for page in self.pages.values() if page['page_namespace']==10 ]
+        if 'SELECT * FROM page' in query:
+            return [ self.pages[pageID] for pageID in args if pageID in self.pages ]
+        raise AssertionError('unexpected query: %s' % query)
+
+class FakeCursor:
+    def __init__(self, wiki):
+        self.wiki= wiki
+
+    def execute(self, query, args= None):
+        self.rows= self.wiki.execute(query, args)
+
+    def fetchall(self):
+        return self.rows
+
+class ResultList(list):
+    def put(self, result):
+        self.append(result)
+
+class TemplateImageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cacheDir= tempfile.mkdtemp()
+        self.wiki= FakeWiki(random.Random(1))
+        wiki= self.wiki
+        class TempCursor:
+            def __init__(self, host, dbname): pass
+            def __enter__(self): return FakeCursor(wiki)
+            def __exit__(self, *args): pass
+        self.saved= (tlgtemplateimages.TempCursor, tlgtemplateimages.getDatabaseHost, tlgtemplateimages.releaseThreadConnections,
+                     tlgflaws.getCursors, miscfilters.getCursors, miscfilters.getTemplateImageCache)
+        tlgtemplateimages.TempCursor= TempCursor
+        tlgtemplateimages.getDatabaseHost= lambda dbname: 'localhost'
+        tlgtemplateimages.releaseThreadConnections= lambda: None
+        tlgflaws.getCursors= miscfilters.getCursors= lambda: { 'dewiki_p': FakeCursor(wiki) }
+
+    def tearDown(self):
+        (tlgtemplateimages.TempCursor, tlgtemplateimages.getDatabaseHost, tlgtemplateimages.releaseThreadConnections,
+         tlgflaws.getCursors, miscfilters.getCursors, miscfilters.getTemplateImageCache)= self.saved
+        shutil.rmtree(self.cacheDir)
+
+    def waitForRefresh(self, cache):
+        for i in range(100):
+            with cache.lock:
+                if not cache.refreshing: return
+            time.sleep(0.05)
+        self.fail('refresh did not finish')
+
+    def testBackgroundBuild(self):
+        cache= TemplateImageCache(self.cacheDir, 60)
+        # the first lookup doesn't wait for the set to be built
+        self.assertEqual(cache.get('dewiki_p'), None)
+        self.waitForRefresh(cache)
+        self.assertEqual(cache.get('dewiki_p'), self.wiki.getTemplateImages())
+        # another process loads the saved set
+        self.wiki.failure= MySQLdb.Error('no database')
+        self.assertEqual(TemplateImageCache(self.cacheDir, 60).get('dewiki_p'), self.wiki.getTemplateImages())
+        self.assertEqual(os.listdir(self.cacheDir), [ 'dewiki_p.gz' ])
+
+    def testRefresh(self):
+        cache= TemplateImageCache(self.cacheDir, 60)
+        cache.get('dewiki_p')
+        self.waitForRefresh(cache)
+        old= self.wiki.getTemplateImages()
+        self.wiki.imagelinks.add((55, 'New.jpg'))
+        # an expired set is still used while it is refreshed
+        cache.images['dewiki_p']= (cache.images['dewiki_p'][0], time.time()-120)
+        os.utime(cache.getFilename('dewiki_p'), (time.time()-120, time.time()-120))
+        release= threading.Event()
+        build= cache.build
+        def slowBuild(wiki):
+            release.wait(10)
+            return build(wiki)
+        cache.build= slowBuild
+        self.assertEqual(cache.get('dewiki_p'), old)
+        self.assertEqual(cache.get('dewiki_p'), old)
+        release.set()
+        self.waitForRefresh(cache)
+        self.assertEqual(cache.get('dewiki_p'), old | set([ 'New.jpg' ]))
+
+    def testDatabaseError(self):
+        cache= TemplateImageCache(self.cacheDir, 60)
+        self.wiki.failure= MySQLdb.Error('no database')
+        self.assertEqual(cache.get('dewiki_p'), None)
+        self.waitForRefresh(cache)
+        # the next lookup tries again
+        self.wiki.failure= None
+        self.assertEqual(cache.get('dewiki_p'), None)
+        self.waitForRefresh(cache)
+        self.assertEqual(cache.get('dewiki_p'), self.wiki.getTemplateImages())
+
+    # NoImages gives the same results with the cached set and with the SQL fallback
+    def testNoImagesFallback(self):
+        cache= TemplateImageCache(self.cacheDir, 60)
+        miscfilters.getTemplateImageCache= lambda: cache
+        def run():
+            results= ResultList()
+            miscfilters.FNoImages.Action(miscfilters.FNoImages(None), 'de', range(1, 61)).execute(results)
+            return sorted([ result.page['page_id'] for result in results ])
+        cache.refreshing.add('dewiki_p')      # no background build yet
+        withoutCache= run()
+        cache.refreshing.discard('dewiki_p')
+        cache.get('dewiki_p')
+        self.waitForRefresh(cache)
+        self.assertEqual(run(), withoutCache)
+        templateImages= self.wiki.getTemplateImages()
+        expected= [ pageID for pageID in range(1, 51) if pageID%7 and
+                    not [ image for (p, image) in self.wiki.imagelinks if p==pageID and not image in templateImages ] ]
+        self.assertEqual(withoutCache, expected)
+        self.assertTrue(0 < len(expected) < 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for the category traversal cache
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import time
+import random
+import shutil
+import tempfile
+import unittest
+from tlgtraversalcache import TraversalCache
+
+class TraversalCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cacheDir= tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir)
+
+    def testPutGet(self):
+        rnd= random.Random(1)
+        cache= TraversalCache(self.cacheDir, 60)
+        pages= {}
+        for catID in range(20):
+            pages[catID]= rnd.sample(xrange(1, 2**32), rnd.randint(0, 1000))
+            self.assertEqual(cache.put('dewiki', catID, 2, pages[catID]).tolist(), sorted(pages[catID]))
+        for catID in range(20):
+            self.assertEqual(cache.get('dewiki', catID, 2).tolist(), sorted(pages[catID]))
+        # other depths and graphs are cached separately
+        self.assertEqual(cache.get('dewiki', 0, 3), None)
+        self.assertEqual(cache.get('enwiki', 0, 2), None)
+
+    def testExpiry(self):
+        cache= TraversalCache(self.cacheDir, 60)
+        cache.put('dewiki', 1, 2, [ 3, 1, 2 ])
+        filename= cache.getFilename('dewiki', 1, 2)
+        os.utime(filename, (time.time()-120, time.time()-120))
+        self.assertEqual(cache.get('dewiki', 1, 2), None)
+        self.assertFalse(os.path.exists(filename))
+
+    def testDisabled(self):
+        cache= TraversalCache(self.cacheDir, 0)
+        self.assertEqual(cache.put('dewiki', 1, 2, [ 3, 1, 2 ]).tolist(), [ 1, 2, 3 ])
+        self.assertEqual(cache.get('dewiki', 1, 2), None)
+        self.assertEqual(os.listdir(self.cacheDir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
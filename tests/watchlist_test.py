@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for the cached, incrementally updated watchlists
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import threading
+import unittest
+import utils
+import wiki
+
+## a SimpleMW which answers watchlist queries from an in-memory list of changes instead of the API.
+class FakeMW(wiki.SimpleMW):
+    def __init__(self):
+        self.watchlistLock= threading.Lock()
+        self.watchlists= {}
+        self.watched= set()     # page IDs
+        self.changes= []        # (timestamp, page ID)
+        self.calls= []          # (wlstart, wldir) of each API query
+
+    def change(self, pageID, timestamp):
+        self.changes.append((timestamp, pageID))
+
+    # lists the latest change of each watched page, like the API does.
+    def getWatchlist(self, wlowner, wltoken, wlstart= None, wlend= None, wldir= 'older'):
+        self.calls.append((wlstart, wldir))
+        latest= {}
+        for (timestamp, pageID) in self.changes:
+            if pageID in self.watched and (wldir=='older' or timestamp >= wlstart):
+                latest[pageID]= max(latest.get(pageID), timestamp)
+        return { 'query': { 'watchlist': [ { 'pageid': pageID, 'title': 'T%d' % pageID, 'timestamp': timestamp }
+                                          for (pageID, timestamp) in latest.items() ] } }
+
+def ts(minute):
+    return '2026-10-18T09:%02d:00Z' % minute
+
+class WatchlistTest(unittest.TestCase):
+    def setUp(self):
+        self.saved= dict(utils.config)
+        utils.config['watchlist-cache-ttl']= 0
+        utils.config['watchlist-full-refresh']= 60*60
+        self.mw= FakeMW()
+        self.mw.watched.update([ 1, 2, 3 ])
+        for pageID in (1, 2, 3): self.mw.change(pageID, ts(pageID))
+        self.mw.change(1, ts(5))
+
+    def tearDown(self):
+        utils.config.clear()
+        utils.config.update(self.saved)
+
+    def getPages(self, token= 'token'):
+        return dict([ (pageID, p['timestamp']) for (pageID, p) in self.mw.getWatchlistPages('User', token).items() ])
+
+    def testCacheTTL(self):
+        utils.config['watchlist-cache-ttl']= 60
+        self.assertEqual(self.getPages(), { 1: ts(5), 2: ts(2), 3: ts(3) })
+        self.mw.change(2, ts(10))
+        self.assertEqual(self.getPages(), { 1: ts(5), 2: ts(2), 3: ts(3) })
+        self.assertEqual(len(self.mw.calls), 1)
+        # the cache is per user and token
+        self.assertEqual(self.getPages(u'tökén'), { 1: ts(5), 2: ts(10), 3: ts(3) })
+        self.assertEqual(self.mw.calls, [ (None, 'older'), (None, 'older') ])
+
+    def testIncrementalMerge(self):
+        self.assertEqual(self.getPages(), { 1: ts(5), 2: ts(2), 3: ts(3) })
+        # changes since the newest entry are fetched and merged
+        self.mw.change(2, ts(10))
+        self.mw.watched.add(4)
+        self.mw.change(4, ts(11))
+        self.assertEqual(self.getPages(), { 1: ts(5), 2: ts(10), 3: ts(3), 4: ts(11) })
+        self.assertEqual(self.mw.calls, [ (None, 'older'), (ts(5), 'newer') ])
+        self.assertEqual(self.getPages(), { 1: ts(5), 2: ts(10), 3: ts(3), 4: ts(11) })
+        self.assertEqual(self.mw.calls[-1], (ts(11), 'newer'))
+
+    def testFullRefresh(self):
+        self.assertEqual(self.getPages(), { 1: ts(5), 2: ts(2), 3: ts(3) })
+        # unwatched pages are not noticed by incremental updates
+        self.mw.watched.remove(3)
+        self.assertEqual(self.getPages(), { 1: ts(5), 2: ts(2), 3: ts(3) })
+        # but dropped when the whole watchlist is fetched again
+        utils.config['watchlist-full-refresh']= 0
+        self.assertEqual(self.getPages(), { 1: ts(5), 2: ts(2) })
+        self.assertEqual(self.mw.calls, [ (None, 'older'), (ts(5), 'newer'), (None, 'older') ])
+
+    def testCopies(self):
+        utils.config['watchlist-cache-ttl']= 60
+        pages= self.mw.getWatchlistPages('User', 'token')
+        del pages[1]
+        self.assertEqual(sorted(self.mw.getWatchlistPages('User', 'token')), [ 1, 2, 3 ])
+
+
+if __name__ == '__main__':
+    unittest.main()
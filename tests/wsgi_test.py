@@ -0,0 +1,39 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# tests for the request handling of the wsgi frontend
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import unittest
+import threading
+import StringIO
+import tlgwsgi
+
+class BackgroundQueryTest(unittest.TestCase):
+    def setUp(self):
+        self.saved= (tlgwsgi.generator_app, tlgwsgi.releaseThreadConnections)
+        self.environs= []
+        self.started= threading.Event()
+        def generator_app(environ, start_response):
+            self.environs.append(environ)
+            self.started.set()
+            return ()
+        tlgwsgi.generator_app= generator_app
+        tlgwsgi.releaseThreadConnections= lambda: None
+
+    def tearDown(self):
+        tlgwsgi.generator_app, tlgwsgi.releaseThreadConnections= self.saved
+
+    def testPostParameters(self):
+        # a POST body which the strict parsing of query strings would reject
+        body= 'action=query&lang=de&query=Physik%3B+Chemie&flaws=Small&flaws=NoImages&mailto=a%40example.org&'
+        params= tlgwsgi.parseCGIargs({ 'CONTENT_LENGTH': str(len(body)), 'wsgi.input': StringIO.StringIO(body) })
+        tlgwsgi.startBackgroundQuery(params)
+        self.assertTrue(self.started.wait(10))
+        environ= self.environs[0]
+        self.assertEqual(environ['daemon'], 'True')
+        self.assertEqual(tlgwsgi.parseCGIargs(environ), params)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,26 +9,32 @@ import json
 import Queue
 import traceback
 import threading
+import heapq
+import bisect
+import operator
+import itertools
+import multiprocessing
 import tlgflaws
+import tlgbatching
+import tlgresultcache
 import wiki
-import geobbox
+from tlggeoindex import getGeoIndex
 
-from tlgcatgraph import CatGraphInterface, FindCGHost
+from tlgcatgraph import CatGraphInterface, FindCGHost, getGraphservPool
+from tlgpageids import PageIDSet
 from tlgflaws import FlawFilters
 from utils import *
 
-# todo: daemon threads?
-
-## a worker thread which fetches actions from a queue and executes them
+## a worker thread of the WorkerPool. fetches actions of all running queries from the pool and executes them.
 class WorkerThread(threading.Thread):
-    def __init__(self, actionQueue, resultQueue, wikiname, runEvent):
+    def __init__(self, pool):
         threading.Thread.__init__(self)
-        self.actionQueue= actionQueue
-        self.resultQueue= resultQueue
-        self.wikiname= wikiname
+        self.pool= pool
         self.daemon= True
-        self.runEvent= runEvent
         self.currentAction= ''
+        self.currentQuery= None
+        self.startTime= time.time()
+        self.busyTime= 0.0          # total time spent executing actions
     
     def setCurrentAction(self, infoString):
         if infoString.split(':'): self.currentAction= infoString.split(':')[-1]
@@ -37,53 +43,183 @@ class WorkerThread(threading.Thread):
         return self.currentAction
     
     def run(self):
-        try:
-            # create cursor which will most likely be used by actions later
-            cur= getCursors()[self.wikiname+'_p']
-            # wait until action queue is ready
-            self.runEvent.wait()
-            
+        while True: 
+            # blocks until an action of any query is ready to run
+            query, action= self.pool.get()
+            self.currentQuery= query
+            setRequestState(query.requestState)
+            self.setCurrentAction(action.parent.shortname)
+            resultQueue= CountingQueue(query.resultQueue)
+            begin= time.time()
             try:
-                while True: 
-                    # todo: if there are only actions left which cannot be run, exit the thread
-                    action= self.actionQueue.get(True, 0)
-                    if action.canExecute():
-                        self.setCurrentAction(action.parent.shortname)
-                        #~ dprint(1, 'executing action for %s' % action.parent.shortname)
-                        action.execute(self.resultQueue)
-                        #~ dprint(1, 'done.')
-                    else:
-                        dprint(3, "re-queueing action " + str(action) + " from %s, queue len=%d" % (action.parent.shortname, self.actionQueue.qsize()))
-                        self.actionQueue.put(action)
-                    
-                    tempCursors= GetTempCursors()
-                    rmkeys= []
-                    for key in tempCursors:
-                        tc= tempCursors[key]
-                        if time.time() - tc.lastuse > 3:
-                            dprint(0, 'closing temp cursor %s' % tc.key)
-                            tc.cursor.close()
-                            tc.conn.close()
-                            rmkeys.append(key)
-                    for k in rmkeys:
-                        del tempCursors[k]
-                            
-            except Queue.Empty:
+                action.execute(resultQueue)
+            except QueryCancelled:
+                # the main thread knows about the cancellation already
+                query.scheduler.actionFailed(action, resultQueue.count)
+            except Exception:
+                # unhandled exception, propagate to main thread and stop the query
+                query.resultQueue.put(sys.exc_info())
+                query.scheduler.actionFailed(action, resultQueue.count)
+            else:
+                # tell the main thread that all results of this action are in the queue
+                query.resultQueue.put(ActionFinished(action))
+                query.scheduler.taskDone(action, resultQueue.count)
+            finally:
+                self.busyTime+= time.time()-begin
+                # database connections are only held while an action runs
+                releaseThreadConnections()
                 self.setCurrentAction('')
-                tempCursors= GetTempCursors()
-                for key in tempCursors:
-                    tc= tempCursors[key]
-                    tc.cursor.close()
-                    tc.conn.close()
-                tempCursors.clear()
-                # todo: close other open connections
-                return
-        
-        except Exception:
-            # unhandled exception, propagate to main thread
-            self.resultQueue.put(sys.exc_info())
+                self.currentQuery= None
+                self.pool.taskDone(query)
+
+## wraps the result queue of a query to count the results put by an action.
+class CountingQueue:
+    def __init__(self, queue):
+        self.queue= queue
+        self.count= 0
+    
+    def put(self, item):
+        self.count+= 1
+        self.queue.put(item)
+
+
+## a query whose actions are executed by the WorkerPool.
+class PooledQuery:
+    ## constructor.
+    # @param scheduler the ActionScheduler of the query.
+    # @param resultQueue results and exceptions of the actions are put here.
+    # @param host database host the query mostly works on. the pool limits the number of actions running per host.
+    # @param maxRunning maximum number of actions of this query running at the same time.
+    # @param background True for queries nobody is waiting for interactively (mail, wiki page output). 
+    #        background queries only get worker threads which are not needed by interactive queries.
+    def __init__(self, scheduler, resultQueue, host, maxRunning, background):
+        self.scheduler= scheduler
+        self.resultQueue= resultQueue
+        self.host= host
+        self.maxRunning= maxRunning
+        self.background= background
+        self.requestState= getRequestState()
+        self.seq= None
+    
+    ## queries with smaller keys get the next free worker thread: interactive queries before background queries, 
+    # then the query with the fewest running actions (fair share), then the query with the fewest remaining actions.
+    def getShareKey(self):
+        scheduler= self.scheduler
+        return (self.background, scheduler.running, len(scheduler.actions)-scheduler.actionsDone, self.seq)
+
+## process-wide pool of worker threads shared by all running queries.
+# limits the total number of running actions (the number of threads) and the number of actions running per database host.
+class WorkerPool:
+    def __init__(self, numThreads, maxPerHost):
+        self.condition= threading.Condition()
+        self.numThreads= numThreads
+        self.maxPerHost= maxPerHost
+        self.threads= []
+        self.queries= []
+        self.runningPerHost= {}     # host => number of running actions
+        self.seq= itertools.count()
+    
+    ## add a query. its actions are executed as soon as threads are free. the scheduler must have been started.
+    def submit(self, query):
+        with self.condition:
+            # threads are started on first use, so that just importing this module doesn't create any
+            while len(self.threads) < self.numThreads:
+                self.threads.append(WorkerThread(self))
+                self.threads[-1].start()
+            query.seq= self.seq.next()
+            self.queries.append(query)
+            self.condition.notifyAll()
+    
+    ## remove a query. actions of the query which are still running are not interrupted.
+    def remove(self, query):
+        with self.condition:
+            if query in self.queries:
+                self.queries.remove(query)
+    
+    ## get the next action to execute. blocks until an action is ready. returns a (query, action) tuple.
+    def get(self):
+        with self.condition:
+            while True:
+                for query in sorted(self.queries, key= PooledQuery.getShareKey):
+                    if query.scheduler.running >= query.maxRunning or self.runningPerHost.get(query.host, 0) >= self.maxPerHost:
+                        continue
+                    action= query.scheduler.tryGet()
+                    if action:
+                        self.runningPerHost[query.host]= self.runningPerHost.get(query.host, 0) + 1
+                        # more actions might have become ready, e. g. by splitting
+                        self.condition.notifyAll()
+                        return query, action
+                self.condition.wait()
+    
+    def taskDone(self, query):
+        with self.condition:
+            self.runningPerHost[query.host]-= 1
+            self.condition.notifyAll()
+    
+    ## threads working for a query.
+    def getThreads(self, query):
+        return [ t for t in self.threads if t.currentQuery is query ]
+    
+    ## pool statistics. busy_ratio is the fraction of its lifetime each thread spent executing actions.
+    def getStats(self):
+        now= time.time()
+        with self.condition:
+            return { 'threads': len(self.threads), 'queries': len(self.queries), 
+                     'running_per_host': dict([ (host, n) for (host, n) in self.runningPerHost.items() if n ]),
+                     'busy_ratio': [ round(t.busyTime/max(now-t.startTime, 1e-6), 3) for t in self.threads ] }
+
+workerPool= None
+workerPoolLock= threading.Lock()
+
+## get the process-wide worker pool.
+def getWorkerPool():
+    global workerPool
+    with workerPoolLock:
+        if workerPool==None:
+            workerPool= WorkerPool(int(config.get('worker-threads', 16)), int(config.get('worker-threads-per-host', 10)))
+        return workerPool
 
 
+## put into the result queue by a worker thread after all results of an action.
+class ActionFinished:
+    def __init__(self, action):
+        self.action= action
+
+## merged results of all filters for one page.
+class MergedResult(object):
+    __slots__= ('wiki', 'page', 'flawMask', 'flaws', 'sortkeys', 'sortKey')
+    
+    ## constructor.
+    # @param result the first TlgResult for this page.
+    # @param bit the bit of the result's filter, see TaskListGenerator.filterBits.
+    def __init__(self, result, bit):
+        self.wiki= result.wiki
+        self.page= result.page
+        self.flawMask= 0
+        self.flaws= []          # (-bit, label, infotext, marked_as_done), in alphabetical order of filter shortnames
+        self.sortkeys= []       # sort keys of the results, sorted
+        self.add(result, bit)
+    
+    ## add the result of another filter. results of filters which were already added are ignored.
+    def add(self, result, bit):
+        if self.flawMask & bit:
+            return
+        self.flawMask|= bit
+        bisect.insort(self.flaws, (-bit, _(result.FlawFilter.label), result.infotext, result.marked_as_done))
+        bisect.insort(self.sortkeys, result.sortkey)
+        # number of flaws (descending), flaw list (alphabetical, filters have more significant bits in 
+        # alphabetical order), sort keys, page title (alphabetical).
+        self.sortKey= (-len(self.flaws), -self.flawMask, self.sortkeys, self.page['page_title'])
+
+## heap entry for top-K result selection. the order is reversed so that heapq's min-heap keeps the worst result on top.
+class TopKEntry(object):
+    __slots__= ('key', 'value')
+    def __init__(self, key, value):
+        self.key= key
+        self.value= value
+    def __lt__(self, other):
+        return other.key < self.key
+
 # replacing Queue with this lock-free container might be faster
 import collections
 class QueueWrapper(collections.deque):
@@ -105,54 +241,436 @@ class QueueWrapper(collections.deque):
     def empty(self):
         return len(self)==0
 
+## a QueueWrapper which wakes up threads waiting on a condition variable whenever something is put into it.
+class NotifyingQueue(QueueWrapper):
+    def __init__(self, condition):
+        QueueWrapper.__init__(self)
+        self.condition= condition
+    
+    def put(self, item):
+        with self.condition:
+            self.append(item)
+            self.condition.notifyAll()
+
+## dependency-aware action scheduler.
+# actions are released to the worker threads only when all actions they depend on (see TlgAction.dependsOn) have finished.
+# filters put their actions here like into a queue. nothing is released before start() is called.
+# the scheduler also counts running and finished actions. all changes are signalled through 
+# the condition variable, so threads can sleep until something happens instead of polling.
+# if a BatchSizer is given, the execution times of actions are recorded, and actions which turn out to be too 
+# large for the target execution time are split before they are handed out.
+class ActionScheduler:
+    def __init__(self, condition, batchSizer= None, cancelToken= None):
+        self.condition= condition
+        self.batchSizer= batchSizer
+        self.cancelToken= cancelToken
+        self.actions= []                        # all actions, in the order they were put
+        self.ready= collections.deque()         # actions which can be executed right now
+        self.pending= {}                        # action => number of unfinished dependencies
+        self.dependents= {}                     # action => actions waiting for it
+        self.finished= set()
+        self.started= False
+        self.aborted= False
+        self.running= 0
+        self.actionsDone= 0
+        self.startTime= None
+        self.criticalPath= {}                   # action => (length of longest chain of actions ending here, previous action in chain)
+        self.runTimes= {}                       # action => (start time, end time)
+        self.barrier= []                        # actions which all subsequently put actions depend on
+        self.splitActions= set()                # actions which were replaced by smaller actions
+        self.readyTimes= {}                     # action => time it became ready to execute
+        self.filterStats= {}                    # filter shortname => dict of counters, see getFilterStats()
+    
+    def put(self, action):
+        with self.condition:
+            if self.barrier: action.dependsOn(self.barrier)
+            self.actions.append(action)
+            if self.started:
+                self.addAction(action)
+                self.condition.notifyAll()
+    
+    # link an action to its unfinished dependencies. must be called with the condition held.
+    def addAction(self, action):
+        unfinished= 0
+        for dep in action.dependencies:
+            if not dep in self.finished:
+                self.dependents.setdefault(dep, []).append(action)
+                unfinished+= 1
+        if unfinished: self.pending[action]= unfinished
+        else: self.makeReady(action)
+    
+    # must be called with the condition held.
+    def makeReady(self, action):
+        self.readyTimes[action]= time.time()
+        self.ready.append(action)
+    
+    # get the counters of an action's filter. must be called with the condition held.
+    def getCounters(self, action):
+        counters= self.filterStats.get(action.parent.shortname)
+        if counters==None:
+            counters= self.filterStats[action.parent.shortname]= { 'actions': 0, 'failed': 0, 'splits': 0, 'rows': 0, 
+                'queue_wait': 0.0, 'max_queue_wait': 0.0, 'exec_time': 0.0, 'max_exec_time': 0.0 }
+        return counters
+    
+    ## make all actions put after this call depend on the given actions.
+    def setBarrier(self, actions):
+        with self.condition:
+            self.barrier= list(actions)
+    
+    ## release all actions without dependencies. 
+    def start(self):
+        with self.condition:
+            self.startTime= time.time()
+            self.started= True
+            for action in self.actions:
+                self.addAction(action)
+            self.condition.notifyAll()
+    
+    ## get the next action to execute, or None if no action is ready or the scheduler was aborted.
+    def tryGet(self):
+        with self.condition:
+            while True:
+                if self.aborted or not self.ready or (self.cancelToken and self.cancelToken.isCancelled()):
+                    return None
+                action= self.ready.popleft()
+                if not action in self.splitActions:
+                    break
+                # all parts of a split action have finished. it is not executed itself.
+                self.runTimes[action]= (time.time(), None)
+                self.finishAction(action)
+            now= time.time()
+            counters= self.getCounters(action)
+            wait= now - self.readyTimes.pop(action, now)
+            counters['queue_wait']+= wait
+            counters['max_queue_wait']= max(counters['max_queue_wait'], wait)
+            if self.batchSizer:
+                action= self.split(action)
+            self.running+= 1
+            self.runTimes[action]= (now, None)
+            return action
+    
+    # split an action which is too large into parts, if possible. must be called with the condition held.
+    # the original action stays in the scheduler and is finished when all parts have finished, 
+    # so that actions depending on it are released only then.
+    # returns the first part, the others are made ready to execute next.
+    def split(self, action):
+        size= self.batchSizer.getSplitSize(action)
+        if not size: 
+            return action
+        parts= action.split(size)
+        if not parts:
+            return action
+        for part in parts:
+            self.dependents[part]= [action]
+        action.dependsOn(parts)
+        self.pending[action]= len(parts)
+        self.splitActions.add(action)
+        self.actions.extend(parts)
+        self.ready.extendleft(reversed(parts[1:]))
+        now= time.time()
+        for part in parts[1:]:
+            self.readyTimes[part]= now
+        self.getCounters(action)['splits']+= 1
+        return parts[0]
+    
+    ## mark an action as finished and release the actions depending on it.
+    # @param rows number of results the action put into the result queue.
+    def taskDone(self, action, rows= 0):
+        with self.condition:
+            self.running-= 1
+            seconds= time.time()-self.runTimes[action][0]
+            if self.batchSizer:
+                self.batchSizer.record(action, seconds)
+            counters= self.getCounters(action)
+            counters['actions']+= 1
+            counters['rows']+= rows
+            counters['exec_time']+= seconds
+            counters['max_exec_time']= max(counters['max_exec_time'], seconds)
+            self.finishAction(action)
+    
+    # must be called with the condition held.
+    def finishAction(self, action):
+        now= time.time()
+        begin= self.runTimes[action][0]
+        self.runTimes[action]= (begin, now)
+        self.actionsDone+= 1
+        self.finished.add(action)
+        
+        # the longest chain ending in this action consists of the action itself plus the longest chain of its dependencies.
+        prev= None
+        for dep in action.dependencies:
+            if prev==None or self.criticalPath[dep][0] > self.criticalPath[prev][0]:
+                prev= dep
+        self.criticalPath[action]= (now-begin + (self.criticalPath[prev][0] if prev else 0), prev)
+        
+        for dependent in self.dependents.pop(action, ()):
+            self.pending[dependent]-= 1
+            if self.pending[dependent]==0:
+                del self.pending[dependent]
+                self.makeReady(dependent)
+        self.condition.notifyAll()
+    
+    ## an action was stopped by an exception. no more actions are handed out.
+    def actionFailed(self, action, rows= 0):
+        with self.condition:
+            self.running-= 1
+            counters= self.getCounters(action)
+            counters['failed']+= 1
+            counters['rows']+= rows
+            self.aborted= True
+            self.condition.notifyAll()
+    
+    ## stop handing out actions and wake up all waiting threads.
+    def abort(self):
+        with self.condition:
+            self.aborted= True
+            self.condition.notifyAll()
+    
+    ## returns True when no more actions will run: all actions have finished, 
+    # or the scheduler was aborted or cancelled and no action is running any more.
+    def isFinished(self):
+        with self.condition:
+            if (self.aborted or (self.cancelToken and self.cancelToken.isCancelled())):
+                return self.running==0
+            if self.started and self.actionsDone==len(self.actions):
+                return True
+            if self.started and not self.ready and self.running==0:
+                raise RuntimeError('%d actions are waiting for dependencies which will never finish' % len(self.pending))
+            return False
+    
+    ## per-filter statistics of the executed actions: number of actions (finished, failed and split ones), 
+    # results put into the result queue, time spent waiting in the queue after becoming ready, and execution time. 
+    # times are in seconds.
+    def getFilterStats(self):
+        with self.condition:
+            stats= {}
+            for (shortname, counters) in self.filterStats.iteritems():
+                stats[shortname]= dict([ (k, round(v, 3) if isinstance(v, float) else v) for (k, v) in counters.iteritems() ])
+            return stats
+    
+    ## number of actions which have not been started yet.
+    def qsize(self):
+        return len(self.actions) - self.actionsDone - self.running
+    
+    def empty(self):
+        return self.qsize()==0
+    
+    ## returns the longest chain of dependent actions as a list of (filter name, action class name, execution time) tuples, 
+    # and its total execution time.
+    def getCriticalPath(self):
+        with self.condition:
+            if not self.criticalPath:
+                return [], 0.0
+            action= max(self.criticalPath, key= lambda a: self.criticalPath[a][0])
+            length= self.criticalPath[action][0]
+            path= []
+            while action:
+                begin, end= self.runTimes[action]
+                path.insert(0, (action.parent.shortname, action.__class__.__name__, end-begin))
+                action= self.criticalPath[action][1]
+            return path, length
+
+
+## per-query store of page rows, bulk-loaded once for all pages to test and shared by all filters (see TlgAction.getPageRows).
+# rows are kept as tuples to save memory and converted to dicts when requested.
+class PageStore:
+    def __init__(self, wiki):
+        self.wiki= wiki     # database name, e.g. 'dewiki_p'
+        self.rows= {}       # page ID => tuple of column values
+        self.columns= None  # names of the columns of the page table, in the order of the tuples
+    
+    ## load the rows of some pages from the database. called by PagePrefetch actions, in parallel for disjoint sets of pages.
+    def load(self, pageIDs):
+        cur= getCursors()[self.wiki]
+        format_strings= ','.join(['%s'] * len(pageIDs))
+        cur.execute('SELECT * FROM page WHERE page_id IN (%s)' % format_strings, pageIDs)
+        if self.columns==None:
+            # the same for every load, so it doesn't matter which one sets it
+            self.columns= tuple([ column[0] for column in cur.description ])
+        for row in cur.fetchall():
+            self.rows[row['page_id']]= tuple([ row[c] for c in self.columns ])
+    
+    ## get the row of a page as a dict, or None if the page does not exist.
+    def get(self, pageID):
+        values= self.rows.get(pageID)
+        if values==None: return None
+        return dict(zip(self.columns, values))
+    
+    def __contains__(self, pageID):
+        return pageID in self.rows
+
+## pseudo filter which fills the page store of the task list generator. 
+# all filter actions depend on the prefetch actions.
+class PagePrefetch(tlgflaws.FlawFilter):
+    shortname= 'PagePrefetch'
+    processSafe= False
+    
+    class Action(tlgflaws.TlgAction):
+        def execute(self, resultQueue):
+            self.parent.tlg.pageStore.load(self.pageIDs)
+        
+        def getResultPageIDs(self):
+            return ()
+    
+    def getPreferredPagesPerAction(self):
+        return 1000
+    
+    def createActions(self, language, pages, actionQueue):
+        actionQueue.put(self.Action(self, language, pages))
+
+
+# thread caches (with database connections) inherited from the parent process by worker processes.
+# they are kept referenced here so that their connections are neither used nor closed by the child.
+inheritedThreadCaches= []
+
+## initializer for the worker processes of the process pool.
+def initWorkerProcess():
+    t= threading.currentThread()
+    inheritedThreadCaches.append(getattr(t, 'cache', None))
+    inheritedThreadCaches.append(resetConnectionPool())
+    t.cache= dict()
+    # the threads of the parent's I/O pool don't exist here. a new pool is created when a filter needs it.
+    tlgflaws.ioPool= None
+    tlgflaws.ioPoolLock= threading.Lock()
+
+processPool= None
+
+## create the process-wide pool of worker processes for executor='process'.
+# the processes are forked here, so this must be called before the process starts any other threads (worker pool, 
+# I/O pool, servers, index updates): a child of a multithreaded process can inherit locks held by other threads, 
+# which then stay locked forever.
+def startProcessPool(numProcesses):
+    global processPool
+    if processPool==None:
+        if threading.activeCount()>1:
+            raise RuntimeError('the process pool must be started before any other threads')
+        processPool= multiprocessing.Pool(numProcesses, initWorkerProcess)
+    return processPool
+
+## get the process-wide pool of worker processes, or None if it was not started.
+def getProcessPool():
+    return processPool
+
+## runs in a worker process: create the actions of a filter for a batch of pages, execute them 
+# and return the results as compact (wiki, page, infotext, sortkey) tuples.
+# @param descriptor tuple of (filter shortname, language, page IDs)
+def executeActionDescriptor(descriptor):
+    shortname, language, pageIDs= descriptor
+    flaw= FlawFilters.classInfos[shortname](None)
+    actions= QueueWrapper()
+    flaw.createActions(language, pageIDs, actions)
+    results= QueueWrapper()
+    for action in actions:
+        action.execute(results)
+    return [ (r.wiki, r.page, r.infotext, r.sortkey) for r in results ]
+
+## an action which runs the actions of its filter for a batch of pages in a worker process.
+# the worker thread executing this only waits for the results, so the GIL is not held during the actual work.
+class ProcessAction(tlgflaws.TlgAction):
+    def __init__(self, parent, language, pages, pool):
+        tlgflaws.TlgAction.__init__(self, parent, language, pages)
+        self.pool= pool
+    
+    def execute(self, resultQueue):
+        result= self.pool.apply_async(executeActionDescriptor, ((self.parent.shortname, self.language, self.pageIDs),))
+        while True:
+            try:
+                results= result.get(1)
+                break
+            except multiprocessing.TimeoutError:
+                # the worker process finishes the batch even if the query was cancelled, the result is dropped
+                self.checkCancelled()
+        for (wiki, page, infotext, sortkey) in results:
+            resultQueue.put(tlgflaws.TlgResult(wiki, page, self.parent, infotext, sortkey))
+
         
 ## main app class
 class TaskListGenerator:
-    def __init__(self, numthreads= 10, testrun_= False):
-        self.actionQueue= QueueWrapper()    #Queue.Queue()     # actions to process
-        self.resultQueue= QueueWrapper()    #Queue.Queue()     # results of actions 
-        self.mergedResults= {}              # final merged results, one entry per article
-        self.workerThreads= []
-        self.pagesToTest= []                # page IDs to test for flaws
-        self.numWorkerThreads= int(numthreads)
+    ## constructor.
+    # @param numthreads maximum number of actions of this query running at the same time. 
+    #        actions are executed by the threads of the process-wide WorkerPool, so this is also limited by the pool size.
+    # @param executor 'thread' to execute actions in the worker threads, 'process' to execute them in the 
+    #        process pool (for filters which support it, see FlawFilter.processSafe). see startProcessPool().
+    # @param background True for queries nobody waits for interactively. interactive queries get worker threads first.
+    def __init__(self, numthreads= 10, testrun_= False, executor= 'thread', background= False):
+        if not executor in ('thread', 'process'):
+            raise InputValidationError(_('Unknown executor \'%s\'') % executor)
+        if executor=='process' and getProcessPool()==None:
+            raise InputValidationError(_('executor=process is not available on this server'))
+        self.workerPool= getWorkerPool()
+        if int(numthreads) < 1:
+            raise InputValidationError(_('numthreads must be at least 1'))
+        self.stateChanged= threading.Condition()    # notified when results arrive or actions finish
+        self.batchSizer= tlgbatching.getBatchSizer()
+        self.cancelToken= CancellationToken()
+        self.actionQueue= ActionScheduler(self.stateChanged, self.batchSizer, self.cancelToken)    # actions to process
+        self.resultQueue= NotifyingQueue(self.stateChanged)     # results of actions 
+        self.mergedResults= {}              # (wiki, page ID) => MergedResult
+        self.filterBits= {}                 # filter shortname => bit in MergedResult.flawMask
+        self.pooledQuery= None              # PooledQuery, while the query is running
+        self.background= background
+        self.pagesToTest= PageIDSet()       # page IDs to test for flaws
+        self.numWorkerThreads= min(int(numthreads), self.workerPool.numThreads)
+        self.executor= executor
+        self.processPool= None
         self.language= None                 # language code e.g. 'en'
         self.wiki= None                     # e.g. 'enwiki'
         self.cg= None
-        self.runEvent= threading.Event()
+        self.cgHost= None
+        self.pageStore= None                # PageStore, if any of the selected filters uses it
+        self.flawFilters= []                # the filter instances of the current query
         self.loadFilterModules()
         self.simpleMW= None # SimpleMW instance
         self.resultsPerFilter= {}           # shortname => resultcount
+        self.resultPageCount= 0             # number of pages in the result set
+        self.pendingActionsPerPage= {}      # page ID => number of unfinished actions which can produce results for it
+        self.pendingAnyPageActions= 0       # number of unfinished actions which can produce results for any page
+        self.finalPages= []                 # keys of merged results which can not change any more
         if testrun_: enableTestrun()
 
     
+    ## the pool threads currently working for this query.
+    def getWorkerThreads(self):
+        if not self.pooledQuery: return []
+        return self.workerPool.getThreads(self.pooledQuery)
+    
     def getActiveWorkerCount(self):
-        count= 0
-        for t in self.workerThreads:
-            if t.isAlive(): count+= 1
-        return count
+        return len(self.getWorkerThreads())
     
     @staticmethod
-    def mkStatus(string):
-        status= json.dumps({'status': string})
+    def mkStatus(string, **extra):
+        status= json.dumps(dict(extra, status= string))
         return status
         
-    def loadFilterModules(self):
+    # filter modules are loaded only once per process, see loadFilterModules.
+    filterModulesLoaded= False
+    filterModulesLock= threading.Lock()
+    
+    ## load the filter modules, if this process didn't load them yet.
+    # filter labels are translated when the modules are loaded. in a process serving several requests, 
+    # modules should be loaded before any language is set, so that labels can be translated for each request.
+    @staticmethod
+    def loadFilterModules():
         import imp
-        for root, dirs, files in os.walk(os.path.join(sys.path[0], 'filtermodules')):
-            for name in files:
-                if name[-3:]=='.py':
-                    file= None
-                    module= None
-                    try:
-                        modname= name[:-3]
-                        (file, pathname, description)= imp.find_module(modname, [root])
-                        module= imp.load_module(modname, file, pathname, description)
-                    except Exception as e:
-                        dprint(0, "error occured while loading filter module %s, exception string was '%s'" % (modname, str(e)))
-                        pass
-                    finally:
-                        if file: file.close()
-                        if module: dprint(3, "loaded filter module '%s'" % modname)
+        with TaskListGenerator.filterModulesLock:
+            if TaskListGenerator.filterModulesLoaded:
+                return
+            for root, dirs, files in os.walk(os.path.join(sys.path[0], 'filtermodules')):
+                for name in files:
+                    if name[-3:]=='.py':
+                        file= None
+                        module= None
+                        try:
+                            modname= name[:-3]
+                            (file, pathname, description)= imp.find_module(modname, [root])
+                            module= imp.load_module(modname, file, pathname, description)
+                        except Exception as e:
+                            dprint(0, "error occured while loading filter module %s, exception string was '%s'" % (modname, str(e)))
+                            pass
+                        finally:
+                            if file: file.close()
+                            if module: dprint(3, "loaded filter module '%s'" % modname)
+            TaskListGenerator.filterModulesLoaded= True
 
     def getFlawList(self):
         infoString= '{\n'
@@ -162,7 +680,7 @@ class TaskListGenerator:
             if not firstLine:
                 infoString+= ',\n'
             firstLine= False
-            infoString+= '\t"%s": %s' % (ci.shortname, json.dumps({ 'group': ci.group, 'label': ci.label, 'description': ci.description }))
+            infoString+= '\t"%s": %s' % (ci.shortname, json.dumps({ 'group': _(ci.group), 'label': _(ci.label), 'description': _(ci.description) }))
         infoString+= '\n}\n'
         return infoString
     
@@ -177,23 +695,41 @@ class TaskListGenerator:
         if len(res): return [ res[0]['gt_lat'], res[0]['gt_lon'] ]
         return None
     
+    ## find the pages with coordinates within distance km of a point, using the wiki's geo index.
     def findPageIDsInGeoBBox(self, lat, lon, distance):
-        bblat, bblon= geobbox.bounding_box(lat, lon, distance)
         dprint(1, "looking for articles in %s at geocoord %s,%s with max distance %s" % (self.wiki, lat, lon, distance))
-        dprint(1, "bbox lat: %s, lon: %s" % (bblat, bblon))
-        cur= getCursors()[self.wiki+'_p']
-        cur.execute('SELECT gt_page_id FROM geo_tags WHERE gt_globe = "earth" AND gt_lat>=%s AND gt_lat<=%s AND gt_lon>=%s AND gt_lon<=%s', 
-            (lat-bblat,lat+bblat, lon-bblon,lon+bblon))
-        return [ row['gt_page_id'] for row in cur.fetchall() ]
+        return getGeoIndex(self.wiki+'_p').findPageIDsInRadius(lat, lon, distance)
+    
+    ## find the k pages nearest to a point, using the wiki's geo index.
+    # k is limited by the geonear-max-k setting, as the search radius grows until k pages are found.
+    def findNearestPageIDs(self, lat, lon, k, excludePageID= None):
+        maxK= int(config.get('geonear-max-k', 1000))
+        if k < 1 or k > maxK:
+            raise InputValidationError(_('geonear: K must be between 1 and %d') % maxK)
+        dprint(1, "looking for the %d articles in %s nearest to geocoord %s,%s" % (k, self.wiki, lat, lon))
+        return getGeoIndex(self.wiki+'_p').findNearestPageIDs(lat, lon, k, excludePageID)
+    
+    ## get the page ID and coordinates of a geotagged page, for geobbox and geonear queries.
+    def findGeoCoordsForTitle(self, title):
+        row= getPageByTitle(self.wiki + '_p', title.replace(' ', '_'), 0)
+        if len(row)==0:
+            raise InputValidationError(_('Page not found: %s') % title)
+        latlon= self.findGeoCoordsForPage(row[0]['page_id'])
+        if latlon==None:
+            raise InputValidationError("No geocoords found for '%s'" % title)
+        return row[0]['page_id'], float(latlon[0]), float(latlon[1])
     
     ## evaluate a single query category.
     # 'wl#USER,TOKEN' special syntax queries USER's watchlist instead of CatGraph.
     # 'title#PAGETITLE' returns only a single page.
-    def evalQueryToken(self, string, defaultdepth):
+    # 'geobbox#PAGETITLE,KM' returns the pages with coordinates within KM kilometers of PAGETITLE's coordinates.
+    # 'geonear#PAGETITLE,K' returns the K pages nearest to PAGETITLE's coordinates. 
+    # @param cg the CatGraphInterface to use for categories, default is self.cg.
+    def evalQueryToken(self, string, defaultdepth, cg= None):
         separatorChar= '#'  # special separator char for things like 'title#PAGETITLE'
         s= string.split(separatorChar, 1)
         if len(s)==1:
-            res= self.cg.getPagesInCategory(string.replace(' ', '_'), defaultdepth)
+            res= (cg or self.cg).getPagesInCategory(string.replace(' ', '_'), defaultdepth)
             #~ print res
             return res
         else:
@@ -214,29 +750,37 @@ class TaskListGenerator:
                     raise InputValidationError(_('Page not found in mainspace: %s') % s[1])
                 return (row[0]['page_id'], )
                 
-            elif s[0]=='geobbox': # bounding box around geotagged page
+            elif s[0]=='geobbox': # pages within a radius around a geotagged page
                 if len(s)!=2:
                     raise InputValidationError(_('Use: \'geobbox%cPAGETITLE,BBOXSIZE_IN_KM\'') % separatorChar)
                 params= s[1].split(',')
                 if len(params)<2 or len(params)>3:
-                    raise InputValidationError(_('Use: \'geobbox%cPAGETITLE,BBOXSIZE_IN_KM\' or \'geobbox%cLAT,LON,BBOXSIZE_IN_KM\'') % separatorChar)
+                    raise InputValidationError(_('Use: \'geobbox%cPAGETITLE,BBOXSIZE_IN_KM\' or \'geobbox%cLAT,LON,BBOXSIZE_IN_KM\'') % (separatorChar, separatorChar))
                 if len(params)==2:
-                    row= getPageByTitle(self.wiki + '_p', params[0].replace(' ', '_'), 0)
-                    if len(row)==0:
-                        raise InputValidationError(_('Page not found: %s') % params[0])
-                    latlon= self.findGeoCoordsForPage(row[0]['page_id'])
-                    if latlon==None:
-                        raise InputValidationError("No geocoords found for '%s'" % params[0])
-                    return self.findPageIDsInGeoBBox(latlon[0], latlon[1], float(params[1]))
+                    pageID, lat, lon= self.findGeoCoordsForTitle(params[0])
+                    return self.findPageIDsInGeoBBox(lat, lon, float(params[1]))
                 else:
                     return self.findPageIDsInGeoBBox(float(params[0]), float(params[1]), float(params[2]))
+            
+            elif s[0]=='geonear': # the K pages nearest to a geotagged page
+                params= s[1].split(',')
+                if len(params)<2 or len(params)>3 or not params[-1].strip().isdigit():
+                    raise InputValidationError(_('Use: \'geonear%cPAGETITLE,K\' or \'geonear%cLAT,LON,K\'') % (separatorChar, separatorChar))
+                if len(params)==2:
+                    pageID, lat, lon= self.findGeoCoordsForTitle(params[0])
+                    return self.findNearestPageIDs(lat, lon, int(params[1]), pageID)
+                else:
+                    return self.findNearestPageIDs(float(params[0]), float(params[1]), int(params[2]))
                 
             # todo (nice-to-have): feed tlg backend output to itself as search input, shell pipe-style?
             else:
                 raise InputValidationError(_('invalid query type: \'%s\'') % s[0])
     
-    def evalQueryString(self, string, depth):
-        result= set()
+    ## parse a query string into a list of (operator, token) tuples, with operators '|' (union), '&' (intersection) 
+    # and '-' (difference), to be applied from left to right to an initially empty set.
+    # '+' on the first token is a union. '-' on the first token has no effect, so it is left out.
+    def parseQueryString(self, string):
+        tokens= []
         n= 0
         for param in string.split(';'):
             param= param.strip()
@@ -248,25 +792,80 @@ class TaskListGenerator:
             else:
                 category= param
                 op= '|'
+            if op=='+':
+                op= '&' if n!=0 else '|'
+            if op!='-' or n!=0:
+                tokens.append((op, category))
+            n+= 1
+        return tokens
+    
+    ## compile parsed query tokens into terms whose union is the query result.
+    # intersections and differences distribute over unions: (A | B) - C == (A - C) | (B - C). 
+    # so each union token starts a term, and all later '&' and '-' tokens are applied to every term. 
+    # up to graphserv-max-operators of them are done by graphserv in the term's command, 
+    # so that the pages of excluded categories are not transferred. the rest is done on the client side.
+    # returns a list of [server-side (operator, token) list, client-side (operator, token) list] pairs.
+    def compileQuery(self, tokens):
+        maxOperators= int(config.get('graphserv-max-operators', 1))
+        isCategory= lambda token: not '#' in token
+        terms= []
+        for (op, token) in tokens:
+            # category names are normalized as in evalQueryToken, they might be looked up by getPagesInCategoryTerm
+            if isCategory(token): token= token.replace(' ', '_')
             if op=='|':
-                result|= set(self.evalQueryToken(category, depth))
-                if 'wl#' in category: dprint(2, ' | "%s"' % 'wl#___,___')
-                else: dprint(2, ' | "%s"' % category)
-            elif op=='+':
-                if n==0:
-                    # '+' on first category should do the expected thing
-                    result|= set(self.evalQueryToken(category, depth))
-                    dprint(2, ' | "%s"' % category)
+                terms.append([ [(op, token)], [] ])
+                continue
+            # tokens before the first union have no effect
+            for (server, client) in terms:
+                if not client and len(server)<=maxOperators and isCategory(server[0][1]) and isCategory(token):
+                    server.append((op, token))
                 else:
-                    result&= set(self.evalQueryToken(category, depth))
-                    dprint(2, ' & "%s"' % category)
-            elif op=='-':
-                # '-' on first category has no effect
-                if n!=0:
-                    result-= set(self.evalQueryToken(category, depth))
-                    dprint(2, ' - "%s"' % category)
-            n+= 1
-        return list(result)
+                    client.append((op, token))
+        return terms
+    
+    ## evaluate query tokens and graphserv terms concurrently, each graphserv command over its own connection.
+    # @param items list of tokens, or tuples of (operator, category) to be evaluated by graphserv (see compileQuery()).
+    # returns a list of page ID lists, in the order of items.
+    def fetchQueryTerms(self, items, depth):
+        def fetch(item, cg= None):
+            if isinstance(item, tuple):
+                return (cg or self.cg).getPagesInCategoryTerm(item, depth)
+            return self.evalQueryToken(item, depth, cg)
+        if len(items)<2:
+            return [ fetch(item) for item in items ]
+        def fetchConcurrently(item):
+            cg= None
+            try:
+                if isinstance(item, tuple) or not '#' in item:
+                    # graphserv connections can't be shared between threads
+                    cg= CatGraphInterface(host= self.cgHost, port= int(config['graphserv-port']), graphname= self.wiki)
+                return fetch(item, cg)
+            finally:
+                if cg: cg.close()
+                releaseThreadConnections()
+        return list(tlgflaws.mapConcurrent(fetchConcurrently, items, int(config.get('query-token-threads', 8)), self.cancelToken.check))
+    
+    ## evaluate a query string. set operations are done by graphserv where possible, see compileQuery().
+    # all graphserv commands and other tokens are fetched concurrently, then combined. returns a PageIDSet.
+    def evalQueryString(self, string, depth):
+        terms= self.compileQuery(self.parseQueryString(string))
+        # terms with a single token are fetched like client-side tokens, so that each token is fetched only once
+        getItem= lambda server: tuple(server) if len(server)>1 else server[0][1]
+        items= set()
+        for (server, client) in terms:
+            items.add(getItem(server))
+            items.update([ token for (op, token) in client ])
+        items= list(items)
+        pages= dict([ (item, PageIDSet.wrap(p)) for (item, p) in zip(items, self.fetchQueryTerms(items, depth)) ])
+        result= PageIDSet()
+        for (server, client) in terms:
+            termResult= pages[getItem(server)]
+            for (op, token) in client:
+                if op=='&': termResult&= pages[token]
+                else: termResult-= pages[token]
+            result|= termResult
+            dprint(2, ' '.join([ '%s "%s"' % (op, token if not 'wl#' in token else 'wl#___,___') for (op, token) in server + client ]))
+        return result
     
     
     ## find flaws (generator function).
@@ -274,21 +873,48 @@ class TaskListGenerator:
     # @param queryString The query string. See CatGraphInterface.executeSearchString documentation.
     # @param queryDepth Search recursion depth.
     # @param flaws String of filter names
-    def generateQuery(self, lang, queryString, queryDepth, flaws, include_hidden= False):
+    # @param order 'default' to sort the results, 'none' to output each result page as soon as it is final.
+    # @param limit If nonzero, only output this many result pages (the first ones, according to order).
+    # @param nocache Don't use a cached result, run the query instead. the new result is still cached.
+    # @param maxtime Maximum processing time in seconds. when it is exceeded, the results found so far are output. 
+    #        can't be larger than the query-max-seconds config value, if that is set.
+    def generateQuery(self, lang, queryString, queryDepth, flaws, include_hidden= False, order= 'default', limit= 0, nocache= False, maxtime= None, stats= False):
+        cacheWriter= None
         try:
+            if not order in ('default', 'none'):
+                raise InputValidationError(_('Unknown order \'%s\'') % order)
+            limit= int(limit)
             begin= time.time()
+            maxSeconds= [ float(t) for t in (maxtime, config.get('query-max-seconds')) if t ]
+            if maxSeconds:
+                self.cancelToken.deadline= begin + min(maxSeconds)
             
             self.language= lang
             self.wiki= lang + 'wiki'
-            self.simpleMW= wiki.SimpleMW(lang)
+            self.simpleMW= wiki.getSimpleMW(lang)
             self.resultsPerFilter= {}
 
             #~ dprint(0, 'generateQuery(): lang "%s", query string "%s", depth %s, flaws "%s"' % (lang, queryString, queryDepth, flaws))
             #~ dprint(0, 'stats: %s' % json.dumps( { 'lang': lang, 'querystring': queryString, 'depth': queryDepth, 'flaws': flaws } ))
             logStats({ 'lang': lang, 'querystring': queryString, 'depth': queryDepth, 'flaws': flaws })
             
-            # spawn the worker threads
-            self.initThreads()
+            resultCache= tlgresultcache.getResultCache()
+            cacheKey= resultCache.getKey(lang, queryString, queryDepth, flaws, include_hidden, order, limit)
+            if cacheKey and not nocache:
+                cached= resultCache.get(cacheKey)
+                if cached:
+                    header, lines= cached
+                    yield self.mkStatus(_('using cached result from %d minutes ago. %d pages tested, %d pages in result set.') % \
+                        (header['age']/60, header['pages_tested'], header['result_size']))
+                    logStats({'result_cache': 'hit', 'age': header['age']})
+                    for line in lines:
+                        yield line
+                    return
+            if cacheKey:
+                cacheWriter= resultCache.createWriter(cacheKey)
+            
+            if self.executor=='process':
+                self.processPool= getProcessPool()
             
             if len(queryString)==0:
                 # todo: use InputValidationError exception
@@ -302,60 +928,133 @@ class TaskListGenerator:
             if cghost==None:
                 raise RuntimeError("no catgraph host found for graph '%s'" % self.wiki)
             #~ raise RuntimeError("host: %s" % cghost)
+            self.cgHost= cghost
             self.cg= CatGraphInterface(host= cghost, port= int(config['graphserv-port']), graphname= self.wiki)
-            #~ self.pagesToTest= self.cg.executeSearchString(queryString, queryDepth)
-            self.pagesToTest= self.evalQueryString(queryString, queryDepth)
+            try:
+                #~ self.pagesToTest= self.cg.executeSearchString(queryString, queryDepth)
+                self.pagesToTest= self.evalQueryString(queryString, queryDepth)
+            finally:
+                # return the graphserv connection to the pool
+                self.cg.close()
+            releaseThreadConnections()
             
             yield self.mkStatus(_('query found %d results.') % len(self.pagesToTest))
 
-            # todo: add something like MaxWaitTime, instead of this
-            #~ if len(self.pagesToTest) > 50000:
-                #~ raise RuntimeError('result set of %d pages is too large to process in a reasonable time, please modify your search string.' % len(self.pagesToTest))
+            # large queries are limited by the deadline
+            self.cancelToken.check()
             
-            # create the actions for every page x every flaw
+            flawFilters= []
             for flawname in flaws.split():
                 try:
-                    flaw= FlawFilters.classInfos[flawname](self)
+                    flawFilters.append(FlawFilters.classInfos[flawname](self))
                 except KeyError:
                     raise InputValidationError('Unknown flaw %s' % flawname)
+            self.flawFilters= flawFilters
+            shortnames= sorted(set([ flaw.shortname for flaw in flawFilters ]))
+            for i in range(len(shortnames)):
+                self.filterBits[shortnames[i]]= 1 << (len(shortnames)-1-i)
+            
+            # if filters running in this process need page rows, load them once for all filters before anything else runs
+            if [ flaw for flaw in flawFilters if flaw.usesPageStore and not (self.processPool and flaw.processSafe) ]:
+                self.pageStore= PageStore(self.wiki + '_p')
+                self.createActions(PagePrefetch(self), self.language, self.pagesToTest)
+                self.actionQueue.setBarrier(self.actionQueue.actions)
+            
+            # create the actions for every page x every flaw
+            for flaw in flawFilters:
                 self.createActions(flaw, self.language, self.pagesToTest)
             
             numActions= self.actionQueue.qsize()
             yield self.mkStatus(_('%d pages to test, %d actions to process') % (len(self.pagesToTest), numActions))
             
-            # signal worker threads that they can run
-            self.runEvent.set()
+            # for streaming and top-K output, keep track of which pages can still get results
+            trackFinalPages= (order=='none' or limit>0)
+            if trackFinalPages:
+                self.initPendingPages()
+            topK= []        # heap of TopKEntry
+            resultsYielded= 0
             
-            # process results as they are created
-            actionsProcessed= 0 #numActions-self.actionQueue.qsize()
-            while self.getActiveWorkerCount()>0 or (not self.resultQueue.empty()):
+            # release the actions to the worker threads
+            self.actionQueue.start()
+            self.pooledQuery= PooledQuery(self.actionQueue, self.resultQueue, getDatabaseHost(self.wiki + '_p'), 
+                self.numWorkerThreads, self.background)
+            self.workerPool.submit(self.pooledQuery)
+            
+            # process results as they are created. 
+            # sleep until there are new results, an action was finished, all actions have finished or the deadline has passed.
+            actionsProcessed= 0
+            while True:
+                with self.stateChanged:
+                    while self.resultQueue.empty() and self.actionQueue.actionsDone==actionsProcessed and not self.actionQueue.isFinished() \
+                            and not self.cancelToken.isCancelled():
+                        self.stateChanged.wait(self.cancelToken.timeLeft())
+                    actionsDone= self.actionQueue.actionsDone
+                    finished= self.actionQueue.isFinished()
                 self.drainResultQueue(include_hidden)
-                n= max(numActions-self.actionQueue.qsize()-(self.getActiveWorkerCount()), 0)
-                if n!=actionsProcessed:
-                    actionsProcessed= n
-                    eta= (time.time()-begin) / actionsProcessed * (numActions-actionsProcessed)
+                if actionsDone!=actionsProcessed:
+                    actionsProcessed= actionsDone
+                    numActions= len(self.actionQueue.actions)   # grows when actions are split
                     yield json.dumps( { 'progress': '%d/%d' % (actionsProcessed, numActions) } )
                     yield self.mkStatus(_('%d of %d actions processed') % (actionsProcessed, numActions))
-                time.sleep(0.25)
-            for i in self.workerThreads:
-                i.join()
-            # process the last results
-            self.drainResultQueue(include_hidden, 60*60)
-                        
+                if trackFinalPages:
+                    for line in self.takeFinalPages(order, limit, topK, resultsYielded):
+                        resultsYielded+= 1
+                        if cacheWriter: cacheWriter.write(line)
+                        yield line
+                    if order=='none' and limit>0 and resultsYielded>=limit:
+                        # all requested pages were output, the remaining actions can't add any
+                        self.cancelToken.cancel('limit')
+                if self.cancelToken.isCancelled():
+                    # don't wait for running actions. their results are discarded.
+                    self.actionQueue.abort()
+                    break
+                if finished and self.resultQueue.empty():
+                    break
+            # a query stopped because it reached its limit is complete
+            partial= self.cancelToken.isCancelled() and self.cancelToken.reason!='limit'
+            if not self.cancelToken.isCancelled():
+                # process the last results
+                self.drainResultQueue(include_hidden, 60*60)
+            
+            if trackFinalPages:
+                # everything is final now
+                self.finalPages= self.mergedResults.keys()
+                for line in self.takeFinalPages(order, limit, topK, resultsYielded):
+                    resultsYielded+= 1
+                    if cacheWriter: cacheWriter.write(line)
+                    yield line
+            
             # sort
-            sortedResults= sorted(self.mergedResults, key= lambda i: \
-                (-len(self.mergedResults[i]),                                                           # length of flaw list, 
-                 sorted( map(lambda x: x.FlawFilter.shortname, self.mergedResults[i]) ),                # flaw list (alphabetical), 
-                 map( lambda x: x[1], sorted( map(lambda x: (x.FlawFilter.shortname, x.sortkey), 
-                         self.mergedResults[i]), 
-                         key= lambda x: x[1]) ),                                                        # sort key,  
-                 self.mergedResults[i][0].page['page_title']))                                          # page title (alphabetical)
+            if order=='none':
+                sortedResults= []
+            elif limit>0:
+                topK.sort(key= operator.attrgetter('key'))
+                sortedResults= [ entry.value for entry in topK ]
+            else:
+                sortedResults= sorted(self.mergedResults.itervalues(), key= operator.attrgetter('sortKey'))
             
-            yield self.mkStatus(_('%d pages tested in %d actions. %d pages in result set. processing took %.1f seconds. please wait while the result list is being transferred.') % \
-                (len(self.pagesToTest), numActions, len(self.mergedResults), time.time()-begin))
+            status= _('%d pages tested in %d actions. %d pages in result set. processing took %.1f seconds. please wait while the result list is being transferred.') % \
+                (len(self.pagesToTest), numActions, self.resultPageCount, time.time()-begin)
+            if partial:
+                status= _('query was cancelled (%s) after %d of %d actions, results are incomplete.') % \
+                    (self.cancelToken.reason, self.actionQueue.actionsDone, len(self.actionQueue.actions)) + ' ' + status
+            yield self.mkStatus(status, partial= partial)
             
             logStats({'pages_tested': len(self.pagesToTest), 'action_count': numActions, \
-                'result_size': len(self.mergedResults), 'processingtime': time.time()-begin})
+                'result_size': self.resultPageCount, 'processingtime': time.time()-begin, 'cancelled': self.cancelToken.reason})
+            
+            criticalPath, criticalPathTime= self.actionQueue.getCriticalPath()
+            logStats({'critical_path_seconds': criticalPathTime, 'critical_path': criticalPath})
+            logStats({'sql_pool': getConnectionPool().getStats()})
+            logStats({'graphserv_pool': getGraphservPool().getStats()})
+            logStats({'actions_split': len(self.actionQueue.splitActions)})
+            filterStats= self.actionQueue.getFilterStats()
+            workerPoolStats= self.workerPool.getStats()
+            # fraction of the time the query's share of worker threads was executing actions
+            utilization= sum([ s['exec_time'] for s in filterStats.itervalues() ]) / max((time.time()-begin)*self.numWorkerThreads, 1e-6)
+            logStats({'filter_stats': filterStats, 'worker_utilization': round(utilization, 3)})
+            logStats({'worker_pool': workerPoolStats})
+            self.batchSizer.save()
             
             logStats({'results_per_filter': self.resultsPerFilter })
             
@@ -363,14 +1062,28 @@ class TaskListGenerator:
             
             # print results
             for i in sortedResults:
-                result= self.mergedResults[i]
-                d= { 'page': result[0].page,         #['page_title'].replace('_', ' '), 
-                     'flaws': map( lambda res: { 'name': res.FlawFilter.label, 'infotext': res.infotext, 'hidden': res.marked_as_done }, result )
-                    }
-                d['page']['page_title']= d['page']['page_title'].replace('_', ' ')
-                yield json.dumps(d)
+                line= self.formatResult(i)
+                if cacheWriter: cacheWriter.write(line)
+                yield line
+            
+            if cacheWriter and not partial:
+                cacheWriter.commit({'pages_tested': len(self.pagesToTest), 'result_size': self.resultPageCount})
+                cacheWriter= None
             
             logStats({'generator_yieldtime': time.time()-beforeYield})
+            
+            if stats:
+                yield json.dumps({'stats': {'filters': filterStats, 'worker_utilization': round(utilization, 3), 'worker_pool': workerPoolStats, 
+                    'critical_path_seconds': criticalPathTime, 'processingtime': time.time()-begin}})
+        
+        except QueryCancelled as e:
+            dprint(0, 'Query cancelled: %s' % str(e))
+            yield self.mkStatus(_('query was cancelled (%s) before any results were found.') % str(e), partial= True)
+        
+        except GeneratorExit:
+            # the generator was closed, e. g. because the client disconnected
+            self.cancelToken.cancel('closed')
+            raise
         
         except InputValidationError as e:
             dprint(0, 'Input validation failed: %s' % str(e))
@@ -381,6 +1094,74 @@ class TaskListGenerator:
             dprint(0, traceback.format_exc(info[2]))
             yield '{"exception": "%s"}' % (traceback.format_exc(info[2]).replace('\n', '\\n').replace('"', '\\"'))
             return
+        
+        finally:
+            # stop everything still running for this query
+            self.cancelToken.cancel('finished')
+            self.actionQueue.abort()
+            if self.pooledQuery:
+                self.workerPool.remove(self.pooledQuery)
+            if cacheWriter:
+                cacheWriter.abort()
+            releaseThreadConnections()
+            self.processPool= None
+    
+    ## format a MergedResult as a JSON line.
+    def formatResult(self, result):
+        d= { 'page': result.page,         #['page_title'].replace('_', ' '), 
+             'flaws': [ { 'name': label, 'infotext': infotext, 'hidden': hidden } for (bit, label, infotext, hidden) in result.flaws ]
+            }
+        d['page']['page_title']= d['page']['page_title'].replace('_', ' ')
+        return json.dumps(d)
+    
+    ## count the unfinished actions which can produce results for each page (see TlgAction.getResultPageIDs).
+    def initPendingPages(self):
+        for action in self.actionQueue.actions:
+            pageIDs= action.getResultPageIDs()
+            if pageIDs==None:
+                self.pendingAnyPageActions+= 1
+            else:
+                for pageID in pageIDs:
+                    self.pendingActionsPerPage[pageID]= self.pendingActionsPerPage.get(pageID, 0) + 1
+    
+    ## called by drainResultQueue when all results of an action have been processed. 
+    # collects the result pages which can not get any more results.
+    def actionFinished(self, action):
+        if not self.pendingActionsPerPage and not self.pendingAnyPageActions:
+            return  # not tracking
+        pageIDs= action.getResultPageIDs()
+        if pageIDs==None:
+            self.pendingAnyPageActions-= 1
+            if self.pendingAnyPageActions==0:
+                # pages which were only waiting for this action are final now
+                self.finalPages.extend([ key for key in self.mergedResults if self.pendingActionsPerPage.get(key[1], 0)==0 ])
+        else:
+            for pageID in pageIDs:
+                self.pendingActionsPerPage[pageID]-= 1
+                if self.pendingActionsPerPage[pageID]==0:
+                    del self.pendingActionsPerPage[pageID]
+                    key= (action.wiki, pageID)
+                    if self.pendingAnyPageActions==0 and key in self.mergedResults:
+                        self.finalPages.append(key)
+    
+    ## remove final pages from the merged results and return the output lines for them (generator function).
+    # with order=='none', pages are output directly, up to limit pages. otherwise, the best limit pages are kept in the topK heap.
+    def takeFinalPages(self, order, limit, topK, resultsYielded):
+        finalPages= self.finalPages
+        self.finalPages= []
+        for key in finalPages:
+            if not key in self.mergedResults:
+                continue
+            result= self.mergedResults.pop(key)
+            if order=='none':
+                if limit==0 or resultsYielded<limit:
+                    resultsYielded+= 1
+                    yield self.formatResult(result)
+            else:
+                # the worst result drops out of the heap
+                heapq.heappush(topK, TopKEntry(result.sortKey, result))
+                if len(topK)>limit:
+                    heapq.heappop(topK)
     
     ## get IDs of all the pages to be tested for flaws
     def getPageIDs(self):
@@ -388,10 +1169,13 @@ class TaskListGenerator:
     
     def createActions(self, flaw, language, pagesToTest):
         pagesLeft= len(pagesToTest)
-        pagesPerAction= max(1, min( flaw.getPreferredPagesPerAction(), pagesLeft/self.numWorkerThreads ))
+        pagesPerAction= max(1, min( self.batchSizer.getPagesPerAction(language+'wiki_p', flaw), pagesLeft/self.numWorkerThreads ))
         while pagesLeft:
             start= max(0, pagesLeft-pagesPerAction)
-            flaw.createActions( self.language, pagesToTest[start:pagesLeft], self.actionQueue )
+            if self.processPool and flaw.processSafe:
+                self.actionQueue.put(ProcessAction(flaw, self.language, pagesToTest[start:pagesLeft], self.processPool))
+            else:
+                flaw.createActions( self.language, pagesToTest[start:pagesLeft], self.actionQueue )
             pagesLeft-= (pagesLeft-start)
             
     #@cache_region(disk24h)
@@ -428,31 +1212,13 @@ class TaskListGenerator:
         else:
             self.resultsPerFilter[result.FlawFilter.shortname]+= 1
 
-        #~ key= '%s:%d' % (result.wiki, result.page['page_id'])
-        #~ try:
-            #~ self.mergedResults[key].append(result)
-            #~ self.mergedResults[key].sort(key= lambda x: x.FlawFilter.shortname)
-        #~ except KeyError:
-            #~ self.mergedResults[key]= [ result ]
-
-        key= '%s:%s' % (result.wiki, str(result.page['page_id']))
-        if not key in self.mergedResults:
-            self.mergedResults[key]= [ result ]
+        key= (result.wiki, result.page['page_id'])
+        merged= self.mergedResults.get(key)
+        if merged==None:
+            self.mergedResults[key]= MergedResult(result, self.filterBits[result.FlawFilter.shortname])
+            self.resultPageCount+= 1
         else:
-            shortnames= [ x.FlawFilter.shortname for x in self.mergedResults[key] ]
-            if result.FlawFilter.shortname in shortnames:
-                #~ dprint(1, 'omitting duplicate %s result' % result.FlawFilter.shortname)
-                pass
-            else:
-                self.mergedResults[key].append(result)
-                self.mergedResults[key].sort(key= lambda x: x.FlawFilter.shortname)
-            #~ for x in self.mergedResults[key]:
-                #~ if x.FlawFilter.shortname == result.FlawFilter.shortname:
-                    #~ dprint(1, 'omitting duplicate %s result for %s' % (result.FlawFilter.shortname, result.page['page_title']))
-                    #~ return
-            #~ dprint(1, "adding result for %s" % result.FlawFilter.shortname)
-            #~ self.mergedResults[key].append(result)
-            #~ self.mergedResults[key].sort(key= lambda x: x.FlawFilter.shortname)
+            merged.add(result, self.filterBits[result.FlawFilter.shortname])
 
     def processWorkerException(self, exc_info):
         raise exc_info[0], exc_info[1], exc_info[2] # re-throw exception from worker thread
@@ -462,14 +1228,9 @@ class TaskListGenerator:
         while not self.resultQueue.empty() and time.time()-starttime<timeout:
             result= self.resultQueue.get()
             if isinstance(result, tlgflaws.TlgResult): self.processResult(result, include_hidden)
+            elif isinstance(result, ActionFinished): self.actionFinished(result.action)
             else: self.processWorkerException(result)
 
-    # create and start worker threads
-    def initThreads(self):
-        for i in range(0, self.numWorkerThreads):
-            self.workerThreads.append(WorkerThread(self.actionQueue, self.resultQueue, self.wiki, self.runEvent))
-            self.workerThreads[-1].start()
-
     def markAsDone(self, pageID, pageTitle, pageRev, filterName, unmark):
         from getpass import getuser
         import MySQLdb
@@ -498,6 +1259,8 @@ class TaskListGenerator:
         conn.commit()
         cursor.close()
         conn.close()
+        # cached results contain the old hidden flags
+        tlgresultcache.getResultCache().invalidate()
 
 
 class test:
@@ -523,25 +1286,18 @@ class test:
             raise
 
     def testSingleThread(self):
-        self.createActions()
-        numActions= self.tlg.actionQueue.qsize()
-        WorkerThread(self.tlg.actionQueue, self.tlg.resultQueue).run()
-        self.drainResultQueue()
-        print "numActions=%d" % numActions
-        sys.stdout.flush()
+        self.testMultiThread(1)
 
     def testMultiThread(self, nthreads):
         self.createActions()
         numActions= self.tlg.actionQueue.qsize()
-        for i in range(0, nthreads):
-            dprint(0, "******** before thread start %d" % i)
-            self.tlg.workerThreads.append(WorkerThread(self.tlg.actionQueue, self.tlg.resultQueue))
-            self.tlg.workerThreads[-1].start()
-        while threading.activeCount()>1:
+        self.tlg.actionQueue.start()
+        query= PooledQuery(self.tlg.actionQueue, self.tlg.resultQueue, 'test', nthreads, False)
+        self.tlg.workerPool.submit(query)
+        while not self.tlg.actionQueue.isFinished():
             self.drainResultQueue()
             time.sleep(0.5)
-        for i in self.tlg.workerThreads:
-            i.join()
+        self.tlg.workerPool.remove(query)
         self.drainResultQueue()
         print "numActions=%d" % numActions
         sys.stdout.flush()
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# task list generator - adaptive action batch sizes
+import os
+import json
+import array
+import threading
+from utils import *
+
+## chooses the number of pages per action for each (wiki, filter) pair.
+# the execution time of every action is measured, and batch sizes are chosen so that actions take about
+# targetSeconds. the measured times are saved to a file and reused by later queries.
+class BatchSizer:
+    ## constructor.
+    # @param filename JSON file to load measurements from and save them to. None to not keep them across runs.
+    # @param targetSeconds desired execution time of one action.
+    # @param maxGrowth batches are never made larger than maxGrowth times the filter's preferred size.
+    def __init__(self, filename= None, targetSeconds= 2.0, maxGrowth= 4):
+        self.filename= filename
+        self.targetSeconds= targetSeconds
+        self.maxGrowth= maxGrowth
+        self.lock= threading.Lock()
+        self.secondsPerPage= {}     # 'wiki:shortname' => moving average of execution time per page
+        self.load()
+
+    def getKey(self, wiki, shortname):
+        return '%s:%s' % (wiki, shortname)
+
+    ## get the batch size for a filter, or the filter's preferred size if nothing was measured yet.
+    def getPagesPerAction(self, wiki, flaw):
+        preferred= flaw.getPreferredPagesPerAction()
+        with self.lock:
+            secondsPerPage= self.secondsPerPage.get(self.getKey(wiki, flaw.shortname))
+        if not secondsPerPage:
+            return preferred
+        return max(1, min( int(self.targetSeconds/secondsPerPage), preferred*self.maxGrowth ))
+
+    ## get the batch size an action should be split into, or None if nothing was measured for its filter yet.
+    def getSplitSize(self, action):
+        with self.lock:
+            secondsPerPage= self.secondsPerPage.get(self.getKey(action.wiki, action.parent.shortname))
+        if not secondsPerPage:
+            return None
+        return max(1, int(self.targetSeconds/secondsPerPage))
+
+    ## record the execution time of an action.
+    def record(self, action, seconds):
+        if not isinstance(action.pageIDs, (list, tuple, array.array)) or not len(action.pageIDs):
+            return
+        secondsPerPage= seconds/len(action.pageIDs)
+        key= self.getKey(action.wiki, action.parent.shortname)
+        with self.lock:
+            old= self.secondsPerPage.get(key)
+            if old==None: self.secondsPerPage[key]= secondsPerPage
+            else: self.secondsPerPage[key]= old*0.7 + secondsPerPage*0.3
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as f:
+                self.secondsPerPage.update(json.load(f))
+        except Exception as ex:
+            dprint(1, "exception while loading batch sizes from %s: %s" % (self.filename, str(ex)))
+
+    ## save the measurements. the file is replaced atomically, so concurrent queries don't see partial files.
+    def save(self):
+        if not self.filename:
+            return
+        with self.lock:
+            data= json.dumps(self.secondsPerPage)
+        try:
+            # several threads of this process might save at the same time
+            tmpname= '%s.%d.%s.tmp' % (self.filename, os.getpid(), threading.currentThread().ident)
+            with open(tmpname, 'w') as f:
+                f.write(data)
+            os.rename(tmpname, self.filename)
+        except Exception as ex:
+            dprint(1, "exception while saving batch sizes to %s: %s" % (self.filename, str(ex)))
+
+batchSizer= None
+batchSizerLock= threading.Lock()
+
+## get the process-wide batch sizer.
+def getBatchSizer():
+    global batchSizer
+    with batchSizerLock:
+        if batchSizer==None:
+            batchSizer= BatchSizer(os.path.join(DATADIR, 'batchsizes.json'), float(config.get('action-target-seconds', 2.0)))
+        return batchSizer
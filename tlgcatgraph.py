@@ -1,37 +1,260 @@
 #!/usr/bin/python
 # task list generator - interface to catgraph
 import time
+import socket
 import requests
 from gp import *
 from utils import *
+from tlgtraversalcache import getTraversalCache
+from tlgpageids import PageIDSet
+
+## knows which graphserv host serves which graph. the hostmap lookups are cached.
+# entries older than refreshInterval are refreshed in a background thread, while the old host is still used. 
+# entries older than maxAge are looked up again before being used.
+class GraphRegistry:
+    def __init__(self, url= 'http://sylvester/hostmap/%s', refreshInterval= 10*60, maxAge= 60*60, timeout= 10):
+        self.url= url
+        self.refreshInterval= refreshInterval
+        self.maxAge= maxAge
+        self.timeout= timeout
+        self.lock= threading.Lock()
+        self.hosts= {}              # graph name => (host, time of lookup)
+        self.refreshing= set()      # graph names being refreshed in the background
+    
+    def lookup(self, graphname):
+        r= requests.get(self.url % graphname, timeout= self.timeout)
+        if r.status_code==200:
+            return r.text
+        return None
+    
+    ## get the host of a graph, or None if the graph is unknown.
+    def getHost(self, graphname):
+        with self.lock:
+            host, lookupTime= self.hosts.get(graphname, (None, 0))
+            age= time.time()-lookupTime
+            refresh= host and self.refreshInterval < age < self.maxAge and not graphname in self.refreshing
+            if refresh: self.refreshing.add(graphname)
+        if refresh:
+            thread= threading.Thread(target= self.refresh, args= (graphname,))
+            thread.daemon= True
+            thread.start()
+        if host and age < self.maxAge:
+            return host
+        return self.refresh(graphname)
+    
+    # look up the host of a graph and update the cache. unknown graphs are not cached.
+    # if the lookup fails, a previously found host is kept.
+    def refresh(self, graphname):
+        try:
+            host= self.lookup(graphname)
+            with self.lock:
+                if host: self.hosts[graphname]= (host, time.time())
+                else: self.hosts.pop(graphname, None)
+            return host
+        except requests.RequestException as ex:
+            dprint(0, "hostmap lookup for %s failed: %s" % (graphname, str(ex)))
+            with self.lock:
+                if graphname in self.hosts: return self.hosts[graphname][0]
+            raise
+        finally:
+            with self.lock:
+                self.refreshing.discard(graphname)
+
+graphRegistry= None
+graphRegistryLock= threading.Lock()
+
+## get the process-wide graph registry.
+def getGraphRegistry():
+    global graphRegistry
+    with graphRegistryLock:
+        if graphRegistry==None:
+            graphRegistry= GraphRegistry(refreshInterval= float(config.get('hostmap-refresh-interval', 10*60)))
+        return graphRegistry
 
 def FindCGHost(graphname):
-    r= requests.get('http://sylvester/hostmap/%s' % graphname)
-    if r.status_code==200:
-        return r.text
-    return None
+    return getGraphRegistry().getHost(graphname)
+
 
+## a client transport with connect and read timeouts.
+class TimeoutClientTransport(client.ClientTransport):
+    def __init__(self, host, port, connectTimeout, readTimeout):
+        client.ClientTransport.__init__(self, host, port)
+        self.connectTimeout= connectTimeout
+        self.readTimeout= readTimeout
+    
+    def connect(self):
+        try:
+            self.socket= socket.create_connection((self.host, self.port), self.connectTimeout)
+        except socket.error as ex:
+            raise client.gpProtocolException("failed to connect to %s:%s: %s" % (self.host, self.port, str(ex)))
+        self.socket.settimeout(self.readTimeout)
+        self.hin= self.socket.makefile("r")
+        self.hout= self.socket.makefile("w")
+        return True
+
+## a process-wide pool of graphserv connections, keyed by host, port and graph.
+# connections are returned to the pool after use and reused by later queries. 
+# idle connections are health-checked before reuse and closed after idleTimeout seconds.
+class GraphservPool:
+    def __init__(self, maxIdle= 4, idleTimeout= 60, checkInterval= 10, connectTimeout= 10, readTimeout= 300):
+        self.maxIdle= maxIdle               # max. idle connections kept per graph
+        self.idleTimeout= idleTimeout
+        self.checkInterval= checkInterval   # connections idle for longer than this are pinged before reuse
+        self.connectTimeout= connectTimeout
+        self.readTimeout= readTimeout
+        self.lock= threading.Lock()
+        self.idle= {}                       # (host, port, graph) => list of (connection, time of checkin)
+        self.stats= { 'checkouts': 0, 'connects': 0, 'reaped': 0, 'failed_health_checks': 0, 'discarded': 0 }
+    
+    def connect(self, host, port, graphname):
+        conn= client.Connection(TimeoutClientTransport(host, port, self.connectTimeout, self.readTimeout), graphname)
+        conn.connect()
+        return conn
+    
+    ## get a connection to a graph. graphname can be None for commands which don't use a graph.
+    def checkout(self, host, port, graphname):
+        key= (host, port, graphname)
+        while True:
+            with self.lock:
+                self.stats['checkouts']+= 1
+                reaped= self.reapIdle()
+                idle= self.idle.get(key)
+                conn, lastuse= idle.pop() if idle else (None, None)
+            for c in reaped: self.close(c)
+            if not conn:
+                break
+            if time.time()-lastuse < self.checkInterval or self.isHealthy(conn):
+                return conn
+            with self.lock: self.stats['failed_health_checks']+= 1
+            self.close(conn)
+        conn= self.connect(host, port, graphname)
+        with self.lock: self.stats['connects']+= 1
+        return conn
+    
+    # remove connections which were idle for too long. must be called with the lock held.
+    # returns the connections to close.
+    def reapIdle(self):
+        reaped= []
+        now= time.time()
+        for key in self.idle:
+            keep= [ (conn, lastuse) for (conn, lastuse) in self.idle[key] if now-lastuse < self.idleTimeout ]
+            reaped.extend([ conn for (conn, lastuse) in self.idle[key] if now-lastuse >= self.idleTimeout ])
+            self.idle[key]= keep
+        self.stats['reaped']+= len(reaped)
+        return reaped
+    
+    def isHealthy(self, conn):
+        try:
+            conn.ping()
+            return not conn.isClosed()
+        except (client.gpException, socket.error):
+            return False
+    
+    def close(self, conn):
+        try:
+            conn.close()
+        except (client.gpException, socket.error):
+            pass
+    
+    ## return a connection to the pool.
+    # @param broken True if a command failed on the connection. it is closed, because it might be out of step.
+    def checkin(self, host, port, graphname, conn, broken= False):
+        key= (host, port, graphname)
+        with self.lock:
+            idle= self.idle.setdefault(key, [])
+            keep= not broken and not conn.tainted and not conn.isClosed() and len(idle) < self.maxIdle
+            if keep: idle.append( (conn, time.time()) )
+            else: self.stats['discarded']+= 1
+        if not keep: self.close(conn)
+    
+    def getStats(self):
+        with self.lock:
+            return dict(self.stats, idle= sum([ len(idle) for idle in self.idle.itervalues() ]))
+
+graphservPool= None
+graphservPoolLock= threading.Lock()
+
+## get the process-wide graphserv connection pool.
+def getGraphservPool():
+    global graphservPool
+    with graphservPoolLock:
+        if graphservPool==None:
+            graphservPool= GraphservPool(maxIdle= int(config.get('graphserv-idle-connections', 4)), 
+                connectTimeout= float(config.get('graphserv-connect-timeout', 10)), 
+                readTimeout= float(config.get('graphserv-read-timeout', 300)))
+        return graphservPool
+
+
+## access to the category graph of a wiki, over a connection from the GraphservPool.
+# call close() to return the connection to the pool.
 class CatGraphInterface:
     def __init__(self, host='ortelius.toolserver.org', port=6666, graphname=None):
-        self.gp= client.Connection( client.ClientTransport(host, port), graphname )
-        self.gp.connect()
+        self.host= host
+        self.port= port
+        self.gp= getGraphservPool().checkout(host, port, graphname)
+        self.broken= False
         self.graphname= graphname
         self.wikiname= graphname + '_p'
     
+    def close(self):
+        if self.gp:
+            getGraphservPool().checkin(self.host, self.port, self.graphname, self.gp, self.broken)
+            self.gp= None
+    
+    # run a graphserv command. after errors, the connection is not reused.
+    def call(self, method, *args):
+        try:
+            return method(*args)
+        except:
+            self.broken= True
+            raise
+    
+    ## get the pages in a category and its subcategories, as a PageIDSet. 
+    # traversals are cached, see TraversalCache.
     def getPagesInCategory(self, category, depth=2):
         catID= getCategoryID(self.wikiname, category)
         if catID!=None:
-            result= []
-            successors= self.gp.capture_traverse_successors(catID, depth)
-            if successors:  # result can be None for empty categories
-                # convert list of tuples to simple list. is there a faster (i.e. built-in) way to do this?
-                for i in successors:
-                    result.append(i[0])
-            return result
+            cache= getTraversalCache()
+            result= cache.get(self.graphname, catID, depth)
+            if result==None:
+                successors= self.call(self.gp.capture_traverse_successors, catID, depth)
+                # result can be None for empty categories
+                result= cache.put(self.graphname, catID, depth, [ row[0] for row in successors or () ])
+            return PageIDSet(result, True)
         else:
             # category not found. 
             raise InputValidationError(_('Category %s not found in database %s.') % (category, self.wikiname))
     
+    ## get the pages of a combination of categories, computed by graphserv in a single command.
+    # only the final result is transferred.
+    # @param terms list of (operator, category) tuples. the first operator is ignored, the others are 
+    #        '&' (intersection with the category's pages) or '-' (difference), applied from left to right.
+    # if the traversals of all categories are cached, the result is computed from the cached traversals instead.
+    def getPagesInCategoryTerm(self, terms, depth=2):
+        cache= getTraversalCache()
+        command= []
+        cached= []
+        for (op, category) in terms:
+            catID= getCategoryID(self.wikiname, category.replace(' ', '_'))
+            if catID==None:
+                raise InputValidationError(_('Category %s not found in database %s.') % (category, self.wikiname))
+            if cached!=None:
+                pages= cache.get(self.graphname, catID, depth)
+                if pages==None: cached= None
+                else: cached.append((op, pages))
+            if command:
+                command.append({ '&': '&&', '-': '&&!' }[op])
+            command+= [ 'traverse-successors', str(catID), str(depth) ]
+        if cached!=None:
+            result= PageIDSet(cached[0][1], True)
+            for (op, pages) in cached[1:]:
+                if op=='&': result&= PageIDSet(pages, True)
+                else: result-= PageIDSet(pages, True)
+            return result
+        sink= client.ArraySink()
+        self.call(self.gp.execute, ' '.join(command), None, sink)
+        return PageIDSet([ row[0] for row in sink.getData() ])
+    
     ## execute a search engine-style string
     #  operators '+' (intersection) and '-' (difference) are supported
     #  e. g. "Biology; Art; +Apes; -Cats" searches for everything in Biology or Art and in Apes, not in Cats
@@ -44,7 +267,7 @@ class CatGraphInterface:
     def executeSearchString(self, string, depth):
         # todo: something like "Category|3" to override search depth
         # todo: it would be cool to have this command in graphcore, possibly using threads for each category.
-        result= set()
+        result= PageIDSet()
         n= 0
         for param in string.split(';'):
             param= param.strip()
@@ -57,23 +280,23 @@ class CatGraphInterface:
                 category= param.replace(' ', '_')
                 op= '|'
             if op=='|':
-                result|= set(self.getPagesInCategory(category, depth))
+                result|= self.getPagesInCategory(category, depth)
                 dprint(2, ' | "%s"' % category)
             elif op=='+':
                 if n==0:
                     # '+' on first category should do the expected thing
-                    result|= set(self.getPagesInCategory(category, depth))
+                    result|= self.getPagesInCategory(category, depth)
                     dprint(2, ' | "%s"' % category)
                 else:
-                    result&= set(self.getPagesInCategory(category, depth))
+                    result&= self.getPagesInCategory(category, depth)
                     dprint(2, ' & "%s"' % category)
             elif op=='-':
                 # '-' on first category has no effect
                 if n!=0:
-                    result-= set(self.getPagesInCategory(category, depth))
+                    result-= self.getPagesInCategory(category, depth)
                     dprint(2, ' - "%s"' % category)
             n+= 1
-        return list(result)
+        return result
         
 
 if __name__ == '__main__':
@@ -6,11 +6,55 @@ import sys
 import time
 import math
 import copy
+import array
 import json
 import Queue
 import random
+import collections
+import multiprocessing
+import multiprocessing.pool
 from utils import *
 
+ioPool= None
+ioPoolLock= threading.Lock()
+
+## get the process-wide pool of threads for I/O-bound calls, see TlgAction.mapConcurrent().
+def getIOPool():
+    global ioPool
+    with ioPoolLock:
+        if ioPool==None:
+            ioPool= multiprocessing.pool.ThreadPool(int(config.get('io-threads', 32)))
+        return ioPool
+
+## call func for each of items in the I/O thread pool and yield the return values in order. 
+# up to maxConcurrent calls are in flight at the same time. func must be thread-safe. exceptions raised by func are raised here.
+# @param checkCancelled called regularly while waiting. it can stop waiting by raising an exception, 
+#        in which case no more calls are started.
+def mapConcurrent(func, items, maxConcurrent= 16, checkCancelled= None):
+    pool= getIOPool()
+    requestState= getRequestState()
+    def call(item):
+        setRequestState(requestState)
+        return func(item)
+    pending= collections.deque()
+    items= iter(items)
+    while True:
+        # keep the window filled
+        for item in items:
+            pending.append(pool.apply_async(call, (item,)))
+            if len(pending)>=maxConcurrent: break
+        if not pending:
+            return
+        while True:
+            try:
+                value= pending[0].get(1)
+                break
+            except multiprocessing.TimeoutError:
+                if checkCancelled: checkCancelled()
+        pending.popleft()
+        yield value
+        if checkCancelled: checkCancelled()
+
 ## flaw tester class information
 class FlawFilters:
     classInfos= dict()
@@ -32,9 +76,33 @@ class FlawFilters:
 
 ## base class for flaw filters
 class FlawFilter(object):
+    ## set this to False in filters whose actions share state with each other or with the task list generator. 
+    # otherwise, their actions may be executed in worker processes (which create filter instances with tlg=None).
+    processSafe= True
+    ## set this to True in filters which read the rows of all their pages with TlgAction.getPageRows(),
+    # to have the task list generator prefetch the page rows of all pages to test.
+    # filters which only need the rows of a few pages (e. g. of their results) should leave it False, getPageRow() queries those.
+    usesPageStore= False
+    ## set this to True in filters which put results for pages other than the tested ones into the result queue 
+    # (e. g. files used by the tested pages). used for streaming results, see TlgAction.getResultPageIDs().
+    resultsForOtherPages= False
+    
     def __init__(self, tlg):
         self.tlg= tlg
     
+    ## get the filters selected in the same query as this one which are instances of klass, including this one.
+    # filters selected more than once are only returned once. used by filters which share work with each other.
+    def getQueryFilters(self, klass):
+        filters= []
+        shortnames= set()
+        for flaw in (getattr(self.tlg, 'flawFilters', None) or [ self ]):
+            if isinstance(flaw, klass) and not flaw.shortname in shortnames:
+                shortnames.add(flaw.shortname)
+                filters.append(flaw)
+        if not self.shortname in shortnames:
+            filters.append(self)
+        return filters
+    
     ## override this method if you want to process more than one article per action.
     def getPreferredPagesPerAction(self):
         return 1
@@ -51,14 +119,85 @@ class TlgAction:
         self.language= language
         self.wiki= language+'wiki_p'
         self.pageIDs= pages
+        self.dependencies= []
     
     ## test the pages and put TlgResults describing flawed pages into resultQueue 
     def execute(self, resultQueue):
         raise NotImplementedError("execute() not implemented")
     
-    ## in subclasses, return False here if this action needs to wait for the result of other actions.
-    def canExecute(self):
-        return True
+    ## declare that this action needs the results of other actions.
+    # the action will not be executed before all of the given actions have finished.
+    # dependencies can be added until the task list generator starts processing actions.
+    def dependsOn(self, actions):
+        self.dependencies.extend(actions)
+    
+    ## get the IDs of the pages this action can put results for into the result queue.
+    # None means that the action can produce results for any page.
+    def getResultPageIDs(self):
+        if self.parent.resultsForOtherPages: return None
+        return self.pageIDs
+    
+    ## raise QueryCancelled if the query this action works for was cancelled. 
+    # long-running actions should call this between SQL queries or other expensive steps.
+    def checkCancelled(self):
+        tlg= getattr(self.parent, 'tlg', None)
+        if tlg: tlg.cancelToken.check()
+    
+    ## split this action into copies which each test at most size of its pages, 
+    # or return None if the action can't be split or is not much larger than size.
+    # actions which produce results for any page, or have something other than a sequence of pages, are not split.
+    def split(self, size):
+        if not isinstance(self.pageIDs, (list, tuple, array.array)) or len(self.pageIDs) < 2*size or self.getResultPageIDs()==None:
+            return None
+        parts= []
+        for i in range(0, len(self.pageIDs), size):
+            part= copy.copy(self)
+            part.pageIDs= self.pageIDs[i:i+size]
+            part.dependencies= list(self.dependencies)
+            parts.append(part)
+        return parts
+    
+    ## call func for each of items and yield the return values in order. 
+    # the calls are run in the I/O thread pool, with up to maxConcurrent calls of this action in flight at the same time.
+    # use this for filters which spend most of their time waiting for remote servers (e. g. one HTTP request per page).
+    # nothing new is started after the query was cancelled. see also the mapConcurrent() function.
+    def mapConcurrent(self, func, items, maxConcurrent= 16):
+        return mapConcurrent(func, items, maxConcurrent, self.checkCancelled)
+    
+    # the page store of the task list generator, or None if there is none (e. g. in a worker process).
+    def getPageStore(self):
+        store= getattr(self.parent.tlg, 'pageStore', None)
+        if store and store.wiki==self.wiki: return store
+        return None
+    
+    ## get the page table rows of some pages as a dict of page ID => row.
+    # the rows are taken from the prefetched page store if possible, otherwise they are fetched from the database.
+    # pages which don't exist are left out.
+    def getPageRows(self, pageIDs):
+        store= self.getPageStore()
+        if store:
+            rows= {}
+            for pageID in pageIDs:
+                row= store.get(pageID)
+                if row!=None: rows[pageID]= row
+            return rows
+        return self.fetchPageRows(pageIDs)
+    
+    # fetch the rows of some pages from the database. like the page store, this gets all columns of the page table.
+    def fetchPageRows(self, pageIDs):
+        if not len(pageIDs):
+            return {}
+        cur= getCursors()[self.wiki]
+        format_strings= ','.join(['%s'] * len(pageIDs))
+        cur.execute('SELECT * FROM page WHERE page_id IN (%s)' % format_strings, list(pageIDs))
+        return dict([ (row['page_id'], row) for row in cur.fetchall() ])
+    
+    ## get the page table row of a single page, or None if it doesn't exist.
+    def getPageRow(self, pageID):
+        store= self.getPageStore()
+        if store and pageID in store:
+            return store.get(pageID)
+        return self.fetchPageRows([pageID]).get(pageID)
 
 
 ## the result of a TlgAction, describing a flawed page
@@ -0,0 +1,303 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# task list generator - local spatial index of geotagged pages
+import os
+import sys
+import math
+import json
+import time
+import array
+import bisect
+import threading
+import geobbox
+from utils import *
+try:
+    import numpy
+except ImportError:
+    numpy= None
+
+## index of the earth coordinates in a wiki's geo_tags table.
+# coordinates are kept in grid cells of cellSize degrees, as compact arrays sorted by cell. a query looks up the cells
+# covering the bounding box of a circle and filters the candidates by their exact distance.
+# the index is built from the database and saved to disk. rows added to geo_tags later are fetched incrementally
+# (by gt_id) into a small unsorted delta. rows deleted from geo_tags are dropped from results by checking their gt_id,
+# and from the index when it is rebuilt.
+# the index is loaded, built and refreshed in a background thread (see startUpdate). until it is there, queries 
+# fetch the candidates in the bounding boxes of the cells from the database instead.
+class GeoIndex:
+    checkInterval= 60       # seconds between attempts to update the index, e. g. after a failed build
+    arrayNames= (('gtIDs', 'I'), ('pageIDs', 'I'), ('lats', 'f'), ('lons', 'f'), ('cellKeys', 'I'), ('cellStarts', 'I'))
+
+    ## constructor.
+    # @param wiki database name, e. g. 'dewiki_p'.
+    # @param indexDir directory to save the index in. None to not save it.
+    # @param cellSize size of the grid cells in degrees. must divide 180.
+    def __init__(self, wiki, indexDir= None, cellSize= 1.0):
+        self.wiki= wiki
+        self.indexDir= indexDir
+        self.cellSize= cellSize
+        self.numCols= int(round(360/cellSize))
+        self.lock= threading.Lock()
+        self.updating= False
+        self.checked= 0
+        self.built= 0           # time the sorted arrays were built
+        self.refreshed= 0       # time of the last incremental refresh
+        self.maxGtID= 0         # largest gt_id in the index, including the delta
+        self.clear()
+
+    def clear(self):
+        for (name, typecode) in self.arrayNames:
+            setattr(self, name, array.array(typecode))
+        self.delta= []          # (gt_id, page_id, lat, lon) of rows added after the index was built
+
+    def getCellKey(self, lat, lon):
+        row= min(int((lat+90)/self.cellSize), int(180/self.cellSize)-1)
+        col= min(int((lon+180)/self.cellSize), self.numCols-1)
+        return row*self.numCols + col
+
+    # fetch rows of geo_tags with gt_id > minGtID, in chunks. yields (gt_id, page_id, lat, lon) tuples.
+    def fetchRows(self, minGtID, chunkSize= 100000):
+        with TempCursor(getDatabaseHost(self.wiki), self.wiki) as cur:
+            while True:
+                cur.execute('SELECT gt_id, gt_page_id, gt_lat, gt_lon FROM geo_tags WHERE gt_globe = "earth" AND gt_id > %s ' \
+                    'AND gt_lat IS NOT NULL AND gt_lon IS NOT NULL ORDER BY gt_id LIMIT %s', (minGtID, chunkSize))
+                rows= cur.fetchall()
+                for row in rows:
+                    yield (row['gt_id'], row['gt_page_id'], float(row['gt_lat']), float(row['gt_lon']))
+                if len(rows)<chunkSize:
+                    break
+                minGtID= rows[-1]['gt_id']
+
+    ## build the index from all rows of geo_tags.
+    def build(self):
+        begin= time.time()
+        rows= list(self.fetchRows(0))
+        rows.sort(key= lambda row: self.getCellKey(row[2], row[3]))
+        with self.lock:
+            self.clear()
+            lastKey= None
+            for (i, (gtID, pageID, lat, lon)) in enumerate(rows):
+                key= self.getCellKey(lat, lon)
+                if key!=lastKey:
+                    self.cellKeys.append(key)
+                    self.cellStarts.append(i)
+                    lastKey= key
+                self.gtIDs.append(gtID)
+                self.pageIDs.append(pageID)
+                self.lats.append(lat)
+                self.lons.append(lon)
+            self.cellStarts.append(len(rows))
+            self.maxGtID= max(self.gtIDs) if rows else 0
+            self.built= self.refreshed= time.time()
+        dprint(1, 'built geo index for %s: %d coordinates in %d cells, %.1fs' % (self.wiki, len(rows), len(self.cellKeys), time.time()-begin))
+        self.save()
+
+    ## fetch the rows added to geo_tags since the last refresh into the delta.
+    def refresh(self):
+        rows= list(self.fetchRows(self.maxGtID))
+        with self.lock:
+            self.delta.extend(rows)
+            if rows: self.maxGtID= max(self.maxGtID, rows[-1][0])
+            self.refreshed= time.time()
+
+    ## build, load or refresh the index, depending on its age.
+    # @param refreshInterval seconds after which new rows are fetched.
+    # @param rebuildInterval seconds after which the index is built from scratch.
+    def update(self, refreshInterval, rebuildInterval):
+        now= time.time()
+        if not self.built:
+            self.load()
+        if now-self.built > rebuildInterval:
+            self.build()
+        elif now-self.refreshed > refreshInterval:
+            self.refresh()
+    
+    # runs in a background thread.
+    def runUpdate(self, refreshInterval, rebuildInterval):
+        try:
+            self.update(refreshInterval, rebuildInterval)
+        except MySQLdb.Error as ex:
+            dprint(0, "can't update geo index for %s: %s" % (self.wiki, str(ex)))
+        finally:
+            releaseThreadConnections()
+            with self.lock:
+                self.updating= False
+    
+    ## start loading, building or refreshing the index in a background thread, if that is due. doesn't wait for it.
+    def startUpdate(self, refreshInterval, rebuildInterval):
+        now= time.time()
+        with self.lock:
+            if self.updating or now-self.checked < self.checkInterval:
+                return
+            if self.built and now-self.built <= rebuildInterval and now-self.refreshed <= refreshInterval:
+                return
+            self.checked= now
+            self.updating= True
+        thread= threading.Thread(target= self.runUpdate, args= (refreshInterval, rebuildInterval))
+        thread.daemon= True
+        thread.start()
+
+    def getFilename(self, name):
+        return os.path.join(self.indexDir, self.wiki, name)
+
+    ## save the sorted arrays. the delta is not saved, it is fetched again after loading.
+    def save(self):
+        if not self.indexDir:
+            return
+        try:
+            if not os.path.isdir(os.path.join(self.indexDir, self.wiki)):
+                os.makedirs(os.path.join(self.indexDir, self.wiki))
+            suffix= '.%d.tmp' % os.getpid()
+            with self.lock:
+                for (name, typecode) in self.arrayNames:
+                    with open(self.getFilename(name) + suffix, 'wb') as f:
+                        getattr(self, name).tofile(f)
+                meta= { 'built': self.built, 'cellSize': self.cellSize, 'byteorder': sys.byteorder,
+                        'maxGtID': max(self.gtIDs) if len(self.gtIDs) else 0 }
+            for (name, typecode) in self.arrayNames:
+                os.rename(self.getFilename(name) + suffix, self.getFilename(name))
+            # the meta file is written last. it is only valid if it was written after the arrays.
+            with open(self.getFilename('meta.json') + suffix, 'w') as f:
+                json.dump(meta, f)
+            os.rename(self.getFilename('meta.json') + suffix, self.getFilename('meta.json'))
+        except (OSError, IOError) as ex:
+            dprint(0, "can't save geo index for %s: %s" % (self.wiki, str(ex)))
+
+    ## load the index saved by another process. the rows added since then are fetched by the next refresh.
+    def load(self):
+        if not self.indexDir:
+            return
+        try:
+            with open(self.getFilename('meta.json')) as f:
+                meta= json.load(f)
+            if meta['cellSize']!=self.cellSize or meta['byteorder']!=sys.byteorder:
+                return
+            arrays= {}
+            for (name, typecode) in self.arrayNames:
+                a= array.array(typecode)
+                with open(self.getFilename(name), 'rb') as f:
+                    a.fromfile(f, os.fstat(f.fileno()).st_size/a.itemsize)
+                arrays[name]= a
+        except (OSError, IOError, ValueError, KeyError, EOFError):
+            return
+        with self.lock:
+            self.clear()
+            for name in arrays: setattr(self, name, arrays[name])
+            self.maxGtID= meta['maxGtID']
+            self.built= meta['built']
+            self.refreshed= 0
+
+    # get the (first, last) grid rows and (first, last) grid columns of the cells covering the
+    # bounding box of a circle. boxes crossing the 180 degree meridian are split, boxes containing a pole span all longitudes.
+    def getCellRanges(self, lat, lon, distance):
+        dlat= math.degrees(distance/geobbox.RADIUS)
+        latMin, latMax= lat-dlat, lat+dlat
+        if latMin <= -90 or latMax >= 90 or math.sin(math.radians(dlat)) >= math.cos(math.radians(lat)):
+            # a pole is in the circle
+            lonRanges= [ (-180, 180) ]
+        else:
+            dlon= geobbox.bounding_box(lat, lon, distance)[1]
+            lonMin, lonMax= lon-dlon, lon+dlon
+            if lonMin < -180: lonRanges= [ (lonMin+360, 180), (-180, lonMax) ]
+            elif lonMax > 180: lonRanges= [ (lonMin, 180), (-180, lonMax-360) ]
+            else: lonRanges= [ (lonMin, lonMax) ]
+        maxRow= int(180/self.cellSize)-1
+        rows= (max(0, int((max(latMin, -90)+90)/self.cellSize)), min(maxRow, int((min(latMax, 90)+90)/self.cellSize)))
+        return [ (rows, (max(0, int((lonMin+180)/self.cellSize)), min(self.numCols-1, int((lonMax+180)/self.cellSize))))
+                 for (lonMin, lonMax) in lonRanges ]
+
+    # get the (gt_id, page_id, lat, lon) of all coordinates in the cells covering the bounding box of a circle.
+    # must be called with the lock held.
+    def getCandidates(self, lat, lon, distance):
+        candidates= []
+        for ((firstRow, lastRow), (firstCol, lastCol)) in self.getCellRanges(lat, lon, distance):
+            for row in range(firstRow, lastRow+1):
+                # the cells of a grid row are contiguous in the sorted arrays
+                first= bisect.bisect_left(self.cellKeys, row*self.numCols + firstCol)
+                last= bisect.bisect_right(self.cellKeys, row*self.numCols + lastCol)
+                if first==last: continue
+                start, end= self.cellStarts[first], self.cellStarts[last]
+                candidates.extend(zip(self.gtIDs[start:end], self.pageIDs[start:end], self.lats[start:end], self.lons[start:end]))
+        candidates.extend(self.delta)
+        return candidates
+
+    # get the (gt_id, page_id, lat, lon) of all coordinates in the cells covering the bounding box of a circle 
+    # from the database, for queries while the index is not built yet.
+    def fetchCandidates(self, lat, lon, distance):
+        candidates= []
+        with TempCursor(getDatabaseHost(self.wiki), self.wiki) as cur:
+            for ((firstRow, lastRow), (firstCol, lastCol)) in self.getCellRanges(lat, lon, distance):
+                cur.execute('SELECT gt_id, gt_page_id, gt_lat, gt_lon FROM geo_tags WHERE gt_globe = "earth" ' \
+                    'AND gt_lat BETWEEN %s AND %s AND gt_lon BETWEEN %s AND %s', 
+                    (firstRow*self.cellSize-90, (lastRow+1)*self.cellSize-90, firstCol*self.cellSize-180, (lastCol+1)*self.cellSize-180))
+                candidates.extend([ (row['gt_id'], row['gt_page_id'], float(row['gt_lat']), float(row['gt_lon'])) for row in cur.fetchall() ])
+        # the bounding boxes of adjacent ranges share their edges
+        return list(set(candidates))
+
+    ## get (distance, gt_id, page_id) of all coordinates within distance km of a point, sorted by distance.
+    def findNear(self, lat, lon, distance):
+        with self.lock:
+            fromIndex= bool(self.built)
+            if fromIndex: candidates= self.getCandidates(lat, lon, distance)
+        if not fromIndex:
+            candidates= self.fetchCandidates(lat, lon, distance)
+        if not candidates:
+            return []
+        if numpy:
+            lats= numpy.radians(numpy.array([ c[2] for c in candidates ], dtype= numpy.float64))
+            lons= numpy.radians(numpy.array([ c[3] for c in candidates ], dtype= numpy.float64))
+            lat0, lon0= math.radians(lat), math.radians(lon)
+            h= numpy.sin((lats-lat0)/2)**2 + math.cos(lat0)*numpy.cos(lats)*numpy.sin((lons-lon0)/2)**2
+            distances= 2*geobbox.RADIUS*numpy.arcsin(numpy.sqrt(numpy.minimum(h, 1.0)))
+        else:
+            distances= [ geobbox.distance_between_points(lat, lon, c[2], c[3]) for c in candidates ]
+        result= [ (d, c[0], c[1]) for (d, c) in zip(distances, candidates) if d <= distance ]
+        result.sort()
+        if fromIndex:
+            result= self.dropDeleted(result)
+        return result
+
+    ## drop coordinates whose geo_tags rows were deleted after they were indexed.
+    # @param found list of (distance, gt_id, page_id)
+    def dropDeleted(self, found, chunkSize= 10000):
+        existing= set()
+        with TempCursor(getDatabaseHost(self.wiki), self.wiki) as cur:
+            for i in range(0, len(found), chunkSize):
+                gtIDs= [ gtID for (d, gtID, pageID) in found[i:i+chunkSize] ]
+                cur.execute('SELECT gt_id FROM geo_tags WHERE gt_id IN (%s)' % ','.join(['%s'] * len(gtIDs)), gtIDs)
+                existing.update([ row['gt_id'] for row in cur.fetchall() ])
+        return [ f for f in found if f[1] in existing ]
+
+    ## get the IDs of the pages with coordinates within distance km of a point.
+    def findPageIDsInRadius(self, lat, lon, distance):
+        return set([ pageID for (d, gtID, pageID) in self.findNear(lat, lon, distance) ])
+
+    ## get the IDs of the k pages nearest to a point, ordered by distance.
+    # @param excludePageID a page to leave out, e. g. the page whose coordinates are the center.
+    def findNearestPageIDs(self, lat, lon, k, excludePageID= None):
+        # widen the search radius until enough pages are found
+        distance= 10.0
+        while True:
+            found= self.findNear(lat, lon, distance)
+            pageIDs= []
+            seen= set([excludePageID])
+            for (d, gtID, pageID) in found:
+                if not pageID in seen:
+                    seen.add(pageID)
+                    pageIDs.append(pageID)
+                    if len(pageIDs)==k: return pageIDs
+            if distance >= math.pi*geobbox.RADIUS:
+                return pageIDs
+            distance*= 4
+
+geoIndexes= {}
+geoIndexesLock= threading.Lock()
+
+## get the geo index of a wiki, and start updating it in the background if that is due.
+def getGeoIndex(wiki):
+    with geoIndexesLock:
+        if not wiki in geoIndexes:
+            geoIndexes[wiki]= GeoIndex(wiki, os.path.join(DATADIR, 'geoindex'), float(config.get('geo-index-cell-size', 1.0)))
+        index= geoIndexes[wiki]
+    index.startUpdate(float(config.get('geo-index-refresh', 10*60)), float(config.get('geo-index-rebuild', 24*60*60)))
+    return index
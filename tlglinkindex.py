@@ -0,0 +1,213 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# task list generator - local index of the number of links to each article
+import os
+import sys
+import json
+import mmap
+import time
+import array
+import fcntl
+import struct
+from utils import *
+
+## the number of links to each article (namespace 0) of a wiki, for the Lonely filter.
+# the counts are stored in a file of little-endian uint16 (saturating at 65535) indexed by page ID, which is memory-mapped.
+# the index is built by counting the links to all articles, and updated in a background thread: the articles linked
+# from pages changed since the last update (found in recentchanges) are counted again, as are new articles.
+# articles which lost links keep their old counts until the index is rebuilt. this only matters for articles which 
+# lost all or almost all of their links, so low counts (see verifyCount) are not returned and the caller checks them 
+# in the database. lookups never wait for the database, they return None while the index is missing or stale, 
+# and the caller falls back to SQL.
+class InDegreeIndex:
+    maxCount= 0xffff
+    chunkSize= 10000
+    checkInterval= 60       # seconds between checks for changes by other processes or due updates
+    rcOverlap= 10*60        # recentchanges are read again from this many seconds before the last update, for replication lag
+
+    ## constructor.
+    # @param wiki database name, e. g. 'dewiki_p'.
+    # @param indexDir directory for the index files.
+    # @param refreshInterval seconds after which the index is updated from recentchanges.
+    # @param maxAge seconds after which the index is considered stale and not used.
+    # @param rebuildInterval seconds after which the index is built from scratch.
+    # @param verifyCount counts from 1 to verifyCount are left out by getInDegrees(), as they may be too high.
+    def __init__(self, wiki, indexDir, refreshInterval, maxAge, rebuildInterval, verifyCount= 2):
+        self.wiki= wiki
+        self.indexDir= indexDir
+        self.refreshInterval= refreshInterval
+        self.maxAge= maxAge
+        self.rebuildInterval= rebuildInterval
+        self.verifyCount= verifyCount
+        self.lock= threading.Lock()
+        self.meta= None         # dict with build and update times, see build()
+        self.counts= None       # mmap of the counts file
+        self.checked= 0
+        self.updating= False
+
+    def getFilename(self, ext):
+        return os.path.join(self.indexDir, '%s.%s' % (self.wiki, ext))
+
+    ## (re)load the index if it was changed on disk.
+    def load(self):
+        try:
+            with open(self.getFilename('json')) as f:
+                meta= json.load(f)
+            if meta==self.meta:
+                return
+            with open(self.getFilename('u16'), 'rb') as f:
+                size= os.fstat(f.fileno()).st_size
+                counts= mmap.mmap(f.fileno(), 0, access= mmap.ACCESS_READ) if size else None
+        except (OSError, IOError, ValueError, mmap.error):
+            return
+        with self.lock:
+            self.meta, self.counts= meta, counts
+
+    def writeMeta(self, meta):
+        tmpname= '%s.%d.tmp' % (self.getFilename('json'), os.getpid())
+        with open(tmpname, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmpname, self.getFilename('json'))
+
+    # count the links to the articles matching an SQL condition on the page table. returns a list of (page ID, count).
+    def countLinks(self, cur, condition, args):
+        cur.execute('SELECT page_id, (SELECT COUNT(*) FROM pagelinks WHERE pl_namespace=0 AND pl_title=page_title) AS indegree ' \
+            'FROM page WHERE page_namespace=0 AND ' + condition, args)
+        return [ (row['page_id'], min(row['indegree'], self.maxCount)) for row in cur.fetchall() ]
+
+    def getMaxPageID(self, cur):
+        cur.execute('SELECT MAX(page_id) AS maxid FROM page')
+        return cur.fetchall()[0]['maxid'] or 0
+
+    ## count the links to all articles, in chunks of page IDs.
+    def build(self):
+        begin= time.time()
+        tmpname= '%s.%d.tmp' % (self.getFilename('u16'), os.getpid())
+        with TempCursor(getDatabaseHost(self.wiki), self.wiki) as cur:
+            maxPageID= self.getMaxPageID(cur)
+            with open(tmpname, 'wb') as f:
+                for first in range(0, maxPageID+1, self.chunkSize):
+                    last= min(first+self.chunkSize, maxPageID+1)
+                    counts= array.array('H', [0]) * (last-first)
+                    for (pageID, count) in self.countLinks(cur, 'page_id >= %s AND page_id < %s', (first, last)):
+                        counts[pageID-first]= count
+                    if sys.byteorder=='big': counts.byteswap()
+                    counts.tofile(f)
+        os.rename(tmpname, self.getFilename('u16'))
+        # building takes hours on large wikis, the age of the index is counted from the end. 
+        # links changed while building are counted again by the refresh which follows.
+        end= time.time()
+        self.writeMeta({ 'built': end, 'updated': end, 'rcTimestamp': MakeMWTimestamp(begin-self.rcOverlap), 'maxPageID': maxPageID })
+        dprint(1, 'built link index for %s: %d pages, %.1fs' % (self.wiki, maxPageID, end-begin))
+
+    ## count the links to the articles which may have gained links since the last update again.
+    def refresh(self):
+        begin= time.time()
+        meta= dict(self.meta)
+        counts= {}
+        with TempCursor(getDatabaseHost(self.wiki), self.wiki) as cur:
+            cur.execute('SELECT DISTINCT rc_cur_id FROM recentchanges WHERE rc_timestamp >= %s', (meta['rcTimestamp'],))
+            changed= [ row['rc_cur_id'] for row in cur.fetchall() if row['rc_cur_id'] ]
+            # the articles linked from the changed pages, and the changed articles themselves (e. g. after moves)
+            recount= set(changed)
+            for i in range(0, len(changed), 1000):
+                chunk= changed[i:i+1000]
+                cur.execute('SELECT DISTINCT page_id FROM pagelinks JOIN page ON page_namespace=pl_namespace AND page_title=pl_title ' \
+                    'WHERE pl_namespace=0 AND pl_from IN (%s)' % ','.join(['%s'] * len(chunk)), chunk)
+                recount.update([ row['page_id'] for row in cur.fetchall() ])
+            recount= sorted(recount)
+            for i in range(0, len(recount), 1000):
+                chunk= recount[i:i+1000]
+                counts.update(self.countLinks(cur, 'page_id IN (%s)' % ','.join(['%s'] * len(chunk)), chunk))
+            maxPageID= max(meta['maxPageID'], self.getMaxPageID(cur))
+            if maxPageID > meta['maxPageID']:
+                counts.update(self.countLinks(cur, 'page_id > %s', (meta['maxPageID'],)))
+        with open(self.getFilename('u16'), 'r+b') as f:
+            f.seek(0, 2)
+            size= f.tell()
+            if size < 2*(maxPageID+1):
+                f.write('\0' * (2*(maxPageID+1)-size))
+            for pageID in sorted(counts):
+                f.seek(2*pageID)
+                f.write(struct.pack('<H', counts[pageID]))
+        meta.update(updated= begin, rcTimestamp= MakeMWTimestamp(begin-self.rcOverlap), maxPageID= maxPageID)
+        self.writeMeta(meta)
+        dprint(1, 'updated link index for %s: %d pages changed, %d counted, %.1fs' % (self.wiki, len(changed), len(counts), time.time()-begin))
+
+    # runs in a background thread. only one process builds or updates the index at a time.
+    def runUpdate(self, update):
+        try:
+            try:
+                os.makedirs(self.indexDir)
+            except OSError:
+                # another thread might have created it
+                if not os.path.isdir(self.indexDir): raise
+            with open(self.getFilename('lock'), 'w') as lockfile:
+                try:
+                    fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    return  # another process is updating the index
+                # pick up what another process did before we got the lock
+                self.load()
+                update()
+                if update==self.build:
+                    self.load()
+                    self.refresh()
+        except (OSError, IOError, MySQLdb.Error) as ex:
+            dprint(0, "can't update link index for %s: %s" % (self.wiki, str(ex)))
+        finally:
+            releaseThreadConnections()
+            self.load()
+            with self.lock:
+                self.updating= False
+
+    ## reload the index if another process changed it, and start building or updating it in the background if that is due.
+    def update(self):
+        now= time.time()
+        with self.lock:
+            if now-self.checked < self.checkInterval:
+                return
+            self.checked= now
+        self.load()
+        with self.lock:
+            if self.updating:
+                return
+            if self.meta==None or now-self.meta['built'] > self.rebuildInterval: update= self.build
+            elif now-self.meta['updated'] > self.refreshInterval: update= self.refresh
+            else: return
+            self.updating= True
+        thread= threading.Thread(target= self.runUpdate, args= (update,))
+        thread.daemon= True
+        thread.start()
+
+    ## get the number of links to some articles as a dict of page ID => count.
+    # pages which are not in the index, and pages with counts from 1 to verifyCount, are left out. 
+    # returns None if the index is missing or stale.
+    def getInDegrees(self, pageIDs):
+        self.update()
+        with self.lock:
+            meta, counts= self.meta, self.counts
+        if meta==None or time.time()-meta['updated'] > self.maxAge:
+            return None
+        result= {}
+        for pageID in pageIDs:
+            if pageID <= meta['maxPageID'] and counts and 2*pageID+2 <= len(counts):
+                count= struct.unpack_from('<H', counts, 2*pageID)[0]
+                if count==0 or count > self.verifyCount:
+                    result[pageID]= count
+        return result
+
+inDegreeIndexes= {}
+inDegreeIndexesLock= threading.Lock()
+
+## get the process-wide link index of a wiki, or None if the index is disabled (link-index-rebuild = 0).
+def getInDegreeIndex(wiki):
+    rebuildInterval= float(config.get('link-index-rebuild', 7*24*60*60))
+    if not rebuildInterval:
+        return None
+    with inDegreeIndexesLock:
+        if not wiki in inDegreeIndexes:
+            inDegreeIndexes[wiki]= InDegreeIndex(wiki, os.path.join(DATADIR, 'linkindex'),
+                float(config.get('link-index-refresh', 15*60)), float(config.get('link-index-max-age', 60*60)), rebuildInterval,
+                int(config.get('link-index-verify-count', 2)))
+        return inDegreeIndexes[wiki]
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# task list generator - compact sets of page IDs
+import array
+import bisect
+import itertools
+try:
+    import numpy
+except ImportError:
+    numpy= None
+
+## an immutable set of page IDs, stored as a sorted array of uint32 (4 bytes per page instead of ~40 in a python set).
+# set operations use numpy if it is installed. otherwise, the two sorted arrays are merged, 
+# which keeps the result sorted and needs no memory besides the result.
+class PageIDSet(object):
+    __slots__= ('ids',)
+
+    ## constructor.
+    # @param pageIDs any iterable of page IDs, or a PageIDSet (whose array is shared, not copied).
+    # @param isSorted True if pageIDs is an array('I') which is already sorted and free of duplicates. it is used without copying.
+    def __init__(self, pageIDs= (), isSorted= False):
+        if isinstance(pageIDs, PageIDSet):
+            self.ids= pageIDs.ids
+        elif isSorted and isinstance(pageIDs, array.array) and pageIDs.typecode=='I':
+            self.ids= pageIDs
+        else:
+            self.ids= array.array('I', sorted(set(pageIDs)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, pageID):
+        i= bisect.bisect_left(self.ids, pageID)
+        return i<len(self.ids) and self.ids[i]==pageID
+
+    ## slices are returned as arrays, to be passed on to filters as action batches. 
+    # they are converted to lists only when they are sent to the database (see utils.ArrayDictCursor).
+    def __getitem__(self, index):
+        return self.ids[index]
+
+    def __eq__(self, other):
+        return isinstance(other, PageIDSet) and self.ids==other.ids
+
+    def __ne__(self, other):
+        return not self==other
+
+    def __repr__(self):
+        return 'PageIDSet(%d pages)' % len(self.ids)
+
+    def tolist(self):
+        return self.ids.tolist()
+
+    # the page IDs as a numpy array sharing memory with self.ids.
+    def asNumpy(self):
+        if not len(self.ids): return numpy.zeros(0, dtype= numpy.uint32)
+        return numpy.frombuffer(self.ids, dtype= numpy.uint32)
+
+    @staticmethod
+    def fromNumpy(a):
+        ids= array.array('I')
+        ids.fromstring(a.astype(numpy.uint32).tostring())
+        return PageIDSet(ids, True)
+
+    # the page IDs of other as a PageIDSet.
+    @staticmethod
+    def wrap(other):
+        if isinstance(other, PageIDSet): return other
+        return PageIDSet(other)
+
+    def __or__(self, other):
+        other= PageIDSet.wrap(other)
+        if not len(other): return self
+        if not len(self): return other
+        if numpy:
+            return PageIDSet.fromNumpy(numpy.union1d(self.asNumpy(), other.asNumpy()))
+        # sorting two sorted runs is a linear merge
+        return PageIDSet(array.array('I', sorted(itertools.chain(self.ids, (other-self).ids))), True)
+
+    def __and__(self, other):
+        other= PageIDSet.wrap(other)
+        if not len(other): return other
+        if not len(self): return self
+        if numpy:
+            return PageIDSet.fromNumpy(numpy.intersect1d(self.asNumpy(), other.asNumpy(), assume_unique= True))
+        smaller, larger= (self.ids, other.ids) if len(self)<len(other) else (other.ids, self.ids)
+        return PageIDSet(mergeSorted(smaller, larger, True), True)
+
+    def __sub__(self, other):
+        other= PageIDSet.wrap(other)
+        if not len(other) or not len(self): return self
+        if numpy:
+            return PageIDSet.fromNumpy(numpy.setdiff1d(self.asNumpy(), other.asNumpy(), assume_unique= True))
+        return PageIDSet(mergeSorted(self.ids, other.ids, False), True)
+
+## walk through the sorted array a and look up each of its IDs in the sorted array b.
+# the search position in b only moves forward, in steps which double until they pass the ID (galloping),
+# so this is a linear merge when both arrays are about the same size, and needs only about log(len(b)) steps per ID when b is much larger.
+# @param keep True to return the IDs of a which are in b, False to return those which are not.
+def mergeSorted(a, b, keep):
+    result= array.array('I')
+    pos= 0
+    end= len(b)
+    for i in xrange(len(a)):
+        pageID= a[i]
+        if b[pos] < pageID:
+            step= 1
+            while pos+step < end and b[pos+step] < pageID: step*= 2
+            pos= bisect.bisect_left(b, pageID, pos+step/2, min(pos+step+1, end))
+            if pos==end:
+                # the rest of a is larger than all IDs in b
+                if not keep: result.extend(a[i:])
+                break
+        if (b[pos]==pageID)==keep: result.append(pageID)
+    return result
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# task list generator - cache for complete query results
+import os
+import re
+import gzip
+import json
+import time
+import hashlib
+import threading
+from utils import *
+
+## normalize a query string, so that equivalent queries get the same cache key.
+# the query is evaluated from left to right (see TaskListGenerator.evalQueryString), so only consecutive
+# tokens with the same operator can be reordered. whitespace and underscores in category names are canonicalized.
+# returns None for queries which should not be cached (watchlists are personal and contain a token).
+def normalizeQueryString(queryString):
+    runs= []    # [operator, set of tokens]
+    for param in queryString.split(';'):
+        param= param.strip()
+        if len(param)==0:
+            return None     # let the query itself report the error
+        if param[0] in '+-':
+            op= param[0]
+            token= param[1:].strip()
+        else:
+            op= '|'
+            token= param
+        if token.split('#', 1)[0]=='wl':
+            return None
+        token= re.sub(r'[\s_]+', '_', token)
+        if not runs:
+            if op=='-':
+                # '-' on first category has no effect, but the result is still empty for a following '+'
+                runs.append(['-', set()])
+                continue
+            op= '|'                 # '+' on first category is a union
+        if runs and runs[-1][0]==op:
+            runs[-1][1].add(token)
+        else:
+            runs.append([op, set([token])])
+    return ';'.join([ ';'.join([ op+token for token in sorted(tokens) ]) for (op, tokens) in runs ])
+
+## caches the result lines of queries on disk, as gzipped JSON lines.
+class ResultCache:
+    ## constructor.
+    # @param cacheDir directory for the cache files.
+    # @param ttl time in seconds after which cached results expire. 0 disables the cache.
+    def __init__(self, cacheDir, ttl):
+        self.cacheDir= cacheDir
+        self.ttl= ttl
+
+    ## get the cache key for a query, or None if the query should not be cached.
+    def getKey(self, lang, queryString, queryDepth, flaws, include_hidden, order, limit):
+        if not self.ttl:
+            return None
+        query= normalizeQueryString(queryString)
+        if query==None:
+            return None
+        key= json.dumps([ lang, query, int(queryDepth), sorted(set(flaws.split())), bool(include_hidden), order, int(limit) ])
+        return hashlib.sha1(key).hexdigest()
+
+    ## cache entries consist of a header file with information about the result, and the gzipped result lines.
+    def getFilenames(self, key):
+        base= os.path.join(self.cacheDir, key)
+        return base + '.json', base + '.gz'
+
+    ## look up a cached result.
+    # returns (header, lines) where header is the dict given to CacheWriter.commit() with 'age' in seconds added, 
+    # and lines is a generator for the result lines. returns None if nothing is cached or the result has expired.
+    def get(self, key):
+        headername, linesname= self.getFilenames(key)
+        try:
+            with open(headername) as f:
+                header= json.load(f)
+            age= time.time() - header['created']
+            if age > self.ttl or header['created'] < self.getInvalidationTime():
+                os.unlink(headername)
+                os.unlink(linesname)
+                return None
+            f= gzip.open(linesname)
+        except (OSError, IOError, ValueError, KeyError):
+            return None
+        header['age']= age
+        def lines():
+            try:
+                for line in f:
+                    yield line.rstrip('\n')
+            finally:
+                f.close()
+        return header, lines()
+
+    ## drop all cached results. called when pages are marked as done, which changes the hidden flags in results.
+    # the time is kept as the modification time of a file, so that it applies to all processes using the cache directory.
+    def invalidate(self):
+        try:
+            if not os.path.isdir(self.cacheDir):
+                os.makedirs(self.cacheDir)
+            with open(self.getInvalidationFilename(), 'a'):
+                os.utime(self.getInvalidationFilename(), None)
+        except (OSError, IOError) as ex:
+            dprint(0, "can't invalidate result cache: %s" % str(ex))
+
+    def getInvalidationFilename(self):
+        return os.path.join(self.cacheDir, 'invalidated')
+
+    ## results of queries which began before this time are not used.
+    def getInvalidationTime(self):
+        try:
+            return os.path.getmtime(self.getInvalidationFilename())
+        except OSError:
+            return 0
+
+    ## start writing a result to the cache. returns None if the cache directory is not writable.
+    def createWriter(self, key):
+        try:
+            if not os.path.isdir(self.cacheDir):
+                os.makedirs(self.cacheDir)
+            return CacheWriter(*self.getFilenames(key))
+        except (OSError, IOError) as ex:
+            dprint(1, "can't write to result cache: %s" % str(ex))
+            return None
+
+## writes result lines to temporary files, which replace the cache entry when the result is complete.
+# the entry is dated from the creation of the writer, i. e. the beginning of the query.
+class CacheWriter:
+    def __init__(self, headername, linesname):
+        self.created= time.time()
+        self.headername= headername
+        self.linesname= linesname
+        self.suffix= '.%d.%s.tmp' % (os.getpid(), threading.currentThread().ident)
+        self.lines= gzip.open(self.linesname + self.suffix, 'wb')
+
+    def write(self, line):
+        self.lines.write(line + '\n')
+
+    ## finish the cache entry. the header is written last, so that readers never see incomplete entries.
+    def commit(self, header):
+        self.lines.close()
+        os.rename(self.linesname + self.suffix, self.linesname)
+        header= dict(header, created= self.created)
+        with open(self.headername + self.suffix, 'w') as f:
+            json.dump(header, f)
+        os.rename(self.headername + self.suffix, self.headername)
+
+    ## discard the incomplete result.
+    def abort(self):
+        self.lines.close()
+        if os.path.exists(self.linesname + self.suffix): 
+            os.unlink(self.linesname + self.suffix)
+
+resultCache= None
+
+## get the process-wide result cache.
+def getResultCache():
+    global resultCache
+    if resultCache==None:
+        resultCache= ResultCache(os.path.join(DATADIR, 'resultcache'), float(config.get('result-cache-ttl', 60*60)))
+    return resultCache
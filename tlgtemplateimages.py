@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# task list generator - cache for the images used by templates
+import os
+import gzip
+import time
+from utils import *
+
+## caches the names of the images used by templates (namespace 10) of each wiki, for the NoImages filter.
+# the sets are kept in memory and saved to disk as gzipped lists of names, one per line.
+# sets are only built in a background thread, lookups never wait for the database: expired sets are still used 
+# while they are refreshed, and while a wiki has no set yet, get() returns None and the caller falls back to SQL.
+class TemplateImageCache:
+    ## constructor.
+    # @param cacheDir directory for the cache files.
+    # @param ttl time in seconds after which a set is refreshed.
+    def __init__(self, cacheDir, ttl):
+        self.cacheDir= cacheDir
+        self.ttl= ttl
+        self.lock= threading.Lock()
+        self.images= {}             # wiki => (frozenset of image names, creation time)
+        self.refreshing= set()      # wikis being refreshed in the background
+        self.loadLocks= {}          # wiki => lock held while loading its set from disk
+
+    def getFilename(self, wiki):
+        return os.path.join(self.cacheDir, wiki + '.gz')
+
+    ## get the names of the images used by templates of a wiki, as a frozenset, 
+    # or None if there is no set yet (it is then built in the background).
+    # @param wiki database name, e. g. 'dewiki_p'.
+    def get(self, wiki):
+        with self.lock:
+            images, created= self.images.get(wiki, (None, 0))
+            loadLock= self.loadLocks.setdefault(wiki, threading.Lock())
+        if images==None:
+            with loadLock:
+                # another thread might have loaded it while we were waiting
+                with self.lock:
+                    images, created= self.images.get(wiki, (None, 0))
+                if images==None:
+                    images, created= self.load(wiki)
+                    if images!=None:
+                        with self.lock:
+                            self.images[wiki]= (images, created)
+        with self.lock:
+            refresh= (images==None or time.time()-created > self.ttl) and not wiki in self.refreshing
+            if refresh: self.refreshing.add(wiki)
+        if refresh:
+            thread= threading.Thread(target= self.refresh, args= (wiki,))
+            thread.daemon= True
+            thread.start()
+        return images
+
+    # runs in a background thread.
+    def refresh(self, wiki):
+        try:
+            images, created= self.load(wiki)
+            if images==None or time.time()-created > self.ttl:
+                # no other process has refreshed the file
+                images, created= self.build(wiki), time.time()
+            with self.lock:
+                self.images[wiki]= (images, created)
+        except MySQLdb.Error as ex:
+            dprint(0, "can't refresh template images for %s: %s" % (wiki, str(ex)))
+        finally:
+            releaseThreadConnections()
+            with self.lock:
+                self.refreshing.discard(wiki)
+
+    ## load the set saved by this or another process. returns (images, creation time), or (None, 0) if there is none.
+    def load(self, wiki):
+        filename= self.getFilename(wiki)
+        try:
+            created= os.stat(filename).st_mtime
+            with gzip.open(filename) as f:
+                return frozenset([ line.rstrip('\n') for line in f ]), created
+        except (OSError, IOError):
+            return None, 0
+
+    ## find the images used by templates in the database and save them.
+    def build(self, wiki, chunkSize= 1000):
+        begin= time.time()
+        images= set()
+        with TempCursor(getDatabaseHost(wiki), wiki) as cur:
+            cur.execute('SELECT page_id FROM page WHERE page_namespace=10')
+            templateIDs= [ row['page_id'] for row in cur.fetchall() ]
+            for i in range(0, len(templateIDs), chunkSize):
+                chunk= templateIDs[i:i+chunkSize]
+                cur.execute('SELECT DISTINCT il_to FROM imagelinks WHERE il_from IN (%s)' % ','.join(['%s'] * len(chunk)), chunk)
+                images.update([ row['il_to'] for row in cur.fetchall() ])
+        images= frozenset(images)
+        dprint(1, 'found %d images used by %d templates in %s, %.1fs' % (len(images), len(templateIDs), wiki, time.time()-begin))
+        filename= self.getFilename(wiki)
+        tmpname= '%s.%d.%s.tmp' % (filename, os.getpid(), threading.currentThread().ident)
+        try:
+            try:
+                os.makedirs(self.cacheDir)
+            except OSError:
+                # another thread might have created it
+                if not os.path.isdir(self.cacheDir): raise
+            with gzip.open(tmpname, 'wb') as f:
+                for image in images:
+                    f.write(image + '\n')
+            # replace atomically, so that readers never see incomplete files
+            os.rename(tmpname, filename)
+        except (OSError, IOError) as ex:
+            dprint(1, "can't write to template image cache: %s" % str(ex))
+        return images
+
+templateImageCache= None
+
+## get the process-wide cache of images used by templates.
+def getTemplateImageCache():
+    global templateImageCache
+    if templateImageCache==None:
+        templateImageCache= TemplateImageCache(os.path.join(DATADIR, 'templateimages'), float(config.get('template-images-ttl', 24*60*60)))
+    return templateImageCache
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# task list generator - cache for category traversals
+import os
+import sys
+import time
+import array
+from utils import *
+
+## caches graphserv traversal results on disk, as sorted arrays of little-endian uint32 page IDs.
+# the files contain nothing else, so they can also be memory-mapped (e. g. with numpy.memmap).
+class TraversalCache:
+    ## constructor.
+    # @param cacheDir directory for the cache files. each graph gets its own subdirectory.
+    # @param ttl time in seconds after which cached traversals expire. 0 disables the cache.
+    def __init__(self, cacheDir, ttl):
+        self.cacheDir= cacheDir
+        self.ttl= ttl
+
+    def getFilename(self, graph, catID, depth):
+        return os.path.join(self.cacheDir, graph, '%d-%d.u32' % (int(catID), int(depth)))
+
+    ## get the pages found by traversing a category, or None if nothing is cached or the result has expired.
+    # returns a sorted array('I').
+    def get(self, graph, catID, depth):
+        if not self.ttl:
+            return None
+        filename= self.getFilename(graph, catID, depth)
+        try:
+            st= os.stat(filename)
+            if time.time() - st.st_mtime > self.ttl:
+                os.unlink(filename)
+                return None
+            pages= array.array('I')
+            with open(filename, 'rb') as f:
+                pages.fromfile(f, st.st_size/pages.itemsize)
+        except (OSError, IOError, EOFError):
+            return None
+        if sys.byteorder=='big': pages.byteswap()
+        return pages
+
+    ## store the pages found by traversing a category. returns the pages as a sorted array('I').
+    def put(self, graph, catID, depth, pageIDs):
+        pages= array.array('I', sorted(pageIDs))
+        if not self.ttl:
+            return pages
+        filename= self.getFilename(graph, catID, depth)
+        tmpname= '%s.%d.%s.tmp' % (filename, os.getpid(), threading.currentThread().ident)
+        try:
+            try:
+                os.makedirs(os.path.dirname(filename))
+            except OSError:
+                # another thread might have created it
+                if not os.path.isdir(os.path.dirname(filename)): raise
+            data= array.array('I', pages)
+            if sys.byteorder=='big': data.byteswap()
+            with open(tmpname, 'wb') as f:
+                data.tofile(f)
+            # replace atomically, so that readers never see incomplete files
+            os.rename(tmpname, filename)
+        except (OSError, IOError) as ex:
+            dprint(1, "can't write to traversal cache: %s" % str(ex))
+        return pages
+
+traversalCache= None
+
+## get the process-wide traversal cache.
+def getTraversalCache():
+    global traversalCache
+    if traversalCache==None:
+        traversalCache= TraversalCache(os.path.join(DATADIR, 'traversalcache'), float(config.get('traversal-cache-ttl', 6*60*60)))
+    return traversalCache
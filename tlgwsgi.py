@@ -5,7 +5,7 @@ import re
 import sys
 import time
 import json
-import gettext
+import urllib
 import csv
 import threading
 import traceback
@@ -38,6 +38,20 @@ class FileLikeList:
     def write(self, str):
         self.values.append(str)
 
+## the output of generator_app. the server closes it when the response is finished or the client disconnected.
+# closing it also closes the backend result generator, which cancels the query if it is still running.
+class ClosingOutput:
+    def __init__(self, iterable, tlgResult):
+        self.iterable= iterable
+        self.tlgResult= tlgResult
+    
+    def __iter__(self):
+        return iter(self.iterable)
+    
+    def close(self):
+        for i in (self.iterable, self.tlgResult):
+            if hasattr(i, 'close'): i.close()
+
 def addLinebreaks(iterable):
     for stuff in iterable:
         yield stuff + '\n'
@@ -53,12 +67,11 @@ def parseCGIargs(environ):
     from urllib import unquote
     from urlparse import parse_qs
     params= {}
-    if 'CONTENT_LENGTH' in environ and int(environ['CONTENT_LENGTH'])!=0:
+    if environ.get('CONTENT_LENGTH') and int(environ['CONTENT_LENGTH'])!=0:
         #~ dprint(0, "POST request, content length %s" % environ['CONTENT_LENGTH'])
         request_body= environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
         if len(request_body)!=0:
             params= parse_qs(request_body)
-            environ['QUERY_STRING']= request_body   # save parameters for the background process case...
         else:
             params= {}
     elif 'QUERY_STRING' in environ:
@@ -177,7 +190,7 @@ function setStatus(text, percentage) { document.getElementById("thestatus").inne
         if tlg.getActiveWorkerCount()<1: return ''
         r= '<div style=\\"text-align: left; position: absolute; top: 34px; left: 0px; white-space: pre; font-size: 9.5px;\\">Threads:<br>'
         i= 0
-        for t in tlg.workerThreads:
+        for t in tlg.getWorkerThreads():
             r+= "%2d: %s<br>" % (i, t.getCurrentAction())
             i+= 1
         return r + '</div>'
@@ -313,12 +326,19 @@ def CSVify(tlgResult, action, chunked, params, showThreads, tlg):
 
 
 def makeHelpPage():
-    import gp
-    gp= gp.client.Connection( gp.client.ClientTransport(config['graphserv-host'], config['graphserv-port']) )
+    from tlgcatgraph import getGraphservPool
     try:
-        gp.connect()
+        pool= getGraphservPool()
+        host, port= config['graphserv-host'], int(config['graphserv-port'])
+        gp= pool.checkout(host, port, None)
+        broken= True
+        try:
+            graphs= gp.capture_list_graphs()
+            broken= False
+        finally:
+            pool.checkin(host, port, None, gp, broken)
         runningGraphs= ''
-        for i in gp.capture_list_graphs():
+        for i in graphs:
             if 'wiki' in i[0]:
                 if len(runningGraphs): runningGraphs+= ', '
                 runningGraphs+= i[0].split('wiki')[0]
@@ -363,8 +383,26 @@ def makeHelpPage():
                     entry from the <a href="http://www.mediawiki.org/wiki/Page_table">page table</a>.
             * wikitext - this format can be used to copy to user pages or similar.
             * csv - tabbed csv format.
+* order=&lt;string> -- 'default' sorts the result pages by number of flaws, flaws and page title. 
+    'none' outputs each result page as soon as all filters have processed it, in no particular order.
+* limit=&lt;integer> -- only output the first N result pages. with the default order, only the best N pages 
+    are kept in memory while processing.
+* nocache=true -- don't use a cached result for this query. results are cached for an hour by default, 
+    queries with the same categories and filters in a different order use the same cached result.
+* maxtime=&lt;seconds> -- stop processing after this time and output the results found so far. 
+    the final status line then contains "partial": true.
+* stats=true -- add a last line with processing statistics: per filter the number of actions and results, 
+    time spent waiting for a worker thread and executing, and how busy the worker threads were.
 * i18n=&lt;language code> -- select output language ('de', 'en')
 * chunked=true -- if specified, use chunked transfer encoding. for creating dynamic progress bars and the like.
+* numthreads=&lt;integer> -- maximum number of filter actions of this query running at the same time (default: 10). 
+    worker threads are shared between all queries of a server process, so this is also limited by the 
+    server's worker-threads setting. on persistent servers, queries sent by mail or written to a wiki page 
+    run with lower priority.
+* executor=&lt;string> -- 'thread' (default) executes filters in the worker threads, 'process' executes them in 
+    worker processes. this uses more than one CPU core for large queries. a CGI request uses numthreads processes, 
+    persistent servers share the number of processes set by their worker-processes setting, and refuse 
+    executor=process if it is 0 (the default).
 * showthreads=true -- debug output; show what threads are doing. use with format=html + chunked=true.
 </pre>""";
 
@@ -378,8 +416,37 @@ def makeHelpPage():
     
     
 
+# True when requests are served by a persistent server (--serve, --fcgi)
+persistentServer= False
+
+## prepare a persistent server: fork the shared worker processes for executor=process (if the 
+# worker-processes setting is not 0) while this process has no other threads, and load the filter modules.
+def initPersistentServer():
+    global persistentServer
+    persistentServer= True
+    numProcesses= int(config.get('worker-processes', 0))
+    if numProcesses:
+        tlgbackend.startProcessPool(numProcesses)
+    # load filters before any request sets a language, so that filter labels can be translated per request
+    tlgbackend.TaskListGenerator.loadFilterModules()
+
+## run a query sent by mail or written to a wiki page in a background thread of a persistent server.
+# @param params the request's parameters as returned by parseCGIargs(), from the query string or from a POST body.
+def startBackgroundQuery(params):
+    queryString= urllib.urlencode(params, True)
+    def run():
+        try:
+            for foo in generator_app({ 'QUERY_STRING': queryString, 'daemon': 'True' }, lambda status, headers, exc_info= None: None):
+                pass
+        finally:
+            releaseThreadConnections()
+    thread= threading.Thread(target= run)
+    thread.daemon= True
+    thread.start()
+
 ############## wsgi generator function
 def generator_app(environ, start_response):
+    beginRequest()
     dprint(1, "generator_app")
 
     try:
@@ -398,23 +465,17 @@ def generator_app(environ, start_response):
         i18n= getParam(params, 'i18n', 'de')
         wikipage= getParam(params, 'wikipage', None)
         if wikipage: format= 'wikitext' # writing to wiki page implies wikitext format
-        global testrun
         testrun= getBoolParam(params, 'test', False)
         dprint(0, "testrun: %s" % str(testrun))
         numThreads= getParam(params, 'numthreads', 10)
+        executor= getParam(params, 'executor', 'thread')
         maxresults= int(getParam(params, 'maxresults', 0))  # this only works for csv and possibly wikitext
         
         #~ logStats({'environment': str(environ)})
         #~ if 'daemon' in environ:
             #~ logStats({'bgprocessparams': str(params)})
 
-        try:
-            gettext.translation('tlgbackend', localedir= os.path.join(sys.path[0], 'messages'), languages=[i18n]).install()
-        except:
-            # fall back to untranslated strings
-            def ident(msg): return msg
-            global _
-            _= ident
+        setRequestLanguage(i18n)
         
         if mailto or wikipage:
             if 'daemon' in environ and environ['daemon']=='True':
@@ -429,16 +490,27 @@ def generator_app(environ, start_response):
                 #~ dprint(0, 'daemon context opened')
                 logStats({'backgroundprocess_pid': os.getpid(), 'backgroundProcessOutputFormat': format})
 
+            elif persistentServer:
+                # run the query in a thread of this server, so that its actions share the worker pool with 
+                # interactive queries at lower priority
+                startBackgroundQuery(params)
+                start_response('200 OK', [('Content-Type', 'text/plain; charset=utf-8')])
+                return ( '{ "status": "background query started" }', )
+            
             else:
                 # cgi context, create background process
                 import subprocess
                 scriptname= os.path.join(sys.path[0], sys.argv[0])
                 dprint(0, "starting background process: %s" % scriptname)
-                subprocess.Popen([scriptname], env= { 'QUERY_STRING': environ['QUERY_STRING'], 'daemon': 'True' })
+                subprocess.Popen([scriptname], env= { 'QUERY_STRING': urllib.urlencode(params, True), 'daemon': 'True' })
                 start_response('200 OK', [('Content-Type', 'text/plain; charset=utf-8')])
                 return ( '{ "status": "background process started" }', )
         
-        tlg= tlgbackend.TaskListGenerator(numthreads= numThreads, testrun_= testrun)
+        if executor=='process' and not persistentServer:
+            # this process serves only this request. fork the worker processes before the query starts any threads.
+            tlgbackend.startProcessPool(max(1, int(numThreads)))
+        
+        tlg= tlgbackend.TaskListGenerator(numthreads= numThreads, testrun_= testrun, executor= executor, background= bool(mailto or wikipage))
         
         if action=='query':
             lang= getParam(params, 'lang')
@@ -446,9 +518,15 @@ def generator_app(environ, start_response):
             queryDepth= getParam(params, 'querydepth', 1)
             flaws= getParam(params, 'flaws')
             include_hidden= getBoolParam(params, 'include_hidden', False)
+            order= getParam(params, 'order', 'default')
+            limit= getParam(params, 'limit', 0)
+            nocache= getBoolParam(params, 'nocache', False)
+            maxtime= getParam(params, 'maxtime', None)
+            stats= getBoolParam(params, 'stats', False)
             if lang is None or queryString is None or flaws is None:
                 raise InputValidationError("parameters lang, query, and flaws must be given")
-            tlgResult= tlg.generateQuery(lang=lang, queryString=queryString, queryDepth=queryDepth, flaws=flaws, include_hidden=include_hidden)
+            tlgResult= tlg.generateQuery(lang=lang, queryString=queryString, queryDepth=queryDepth, flaws=flaws, include_hidden=include_hidden, 
+                order=order, limit=limit, nocache=nocache, maxtime=maxtime, stats=stats)
         elif action=='listflaws':
             tlgResult= (tlg.getFlawList(),)
         elif action=='markasdone':
@@ -491,22 +569,22 @@ def generator_app(environ, start_response):
         if mailto:      # we are in the daemon if we get here
             dprint(0, 'starting email')
             send_mail(queryString, queryDepth, flaws, lang, format, outputIterable, action, mailto, mimeSubtype)
-            dprint(0, 'mail sent, exiting.')
-            sys.exit(0)
+            dprint(0, 'mail sent.')
+            return ()
 
         elif wikipage:  # we are in the daemon if we get here, write output to wiki page
             logStats( {'backgroundprocess_wikipage': wikipage} )
             import wiki
-            wiki.SimpleMW(lang).writeToPage(queryString, queryDepth, flaws, outputIterable, action, wikipage)
+            wiki.getSimpleMW(lang).writeToPage(queryString, queryDepth, flaws, outputIterable, action, wikipage)
             dprint(0, 'finished writing to wiki page \'%s\'' % wikipage)
-            sys.exit(0)
+            return ()
 
         else:   # no email address or wiki page given. normal cgi context.
             if chunked:
                 start_response('200 OK', [('Content-Type', 'text/%s; charset=utf-8' % mimeSubtype), ('Transfer-Encoding', 'chunked')]) 
             else:
                 start_response('200 OK', [('Content-Type', 'text/%s; charset=utf-8' % mimeSubtype)])
-            return outputIterable
+            return ClosingOutput(outputIterable, tlgResult)
     
     except Exception as e:
         info= sys.exc_info()
@@ -516,6 +594,31 @@ def generator_app(environ, start_response):
 
 
 
+## run a persistent, multi-threaded HTTP server for generator_app.
+# filter modules, connection pools and memory caches are kept across requests.
+def runServer(port):
+    from SocketServer import ThreadingMixIn
+    from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+    from wsgiref.util import is_hop_by_hop
+    
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads= True
+    
+    class RequestHandler(WSGIRequestHandler):
+        def log_message(self, format, *args):
+            dprint(2, "%s - %s\n" % (self.address_string(), format % args))
+    
+    # the server does the transfer encoding itself
+    def app(environ, start_response):
+        def start_response_wrapper(status, headers, exc_info= None):
+            return start_response(status, [ (name, value) for (name, value) in headers if not is_hop_by_hop(name) ], exc_info)
+        return generator_app(environ, start_response_wrapper)
+    
+    initPersistentServer()
+    dprint(0, "serving on port %d\n" % port)
+    make_server('', port, app, ThreadingWSGIServer, RequestHandler).serve_forever()
+
+
 if __name__ == "__main__":
     getRequestID()
     
@@ -527,6 +630,18 @@ if __name__ == "__main__":
             pass
         sys.exit(0)
     
+    if len(sys.argv)>1 and sys.argv[1]=='--serve':
+        # persistent http server: tlgwsgi.py --serve [PORT]
+        runServer(int(sys.argv[2]) if len(sys.argv)>2 else 8080)
+        sys.exit(0)
+    
+    if len(sys.argv)>1 and sys.argv[1]=='--fcgi':
+        # persistent multi-threaded fastcgi server
+        from flup.server.fcgi import WSGIServer
+        initPersistentServer()
+        WSGIServer(generator_app).run()
+        sys.exit(0)
+    
     # enable pretty stack traces
     import cgitb
     cgitb.enable()
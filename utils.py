@@ -5,6 +5,7 @@ import os
 import sys
 import pwd
 import time
+import array
 import sqlite3
 import MySQLdb
 import MySQLdb.cursors 
@@ -12,6 +13,8 @@ import threading
 import getpass
 import json
 import uuid
+import gettext
+import __builtin__
 
 from beaker.cache import cache_region, cache_regions
 
@@ -34,12 +37,44 @@ else:
     
 beakerCacheDir= os.path.join(DATADIR, 'beaker-cache')
 
-#~ if not 'testrun' in globals():
-testrun= False
+# state of the request handled by the current thread: request ID, testrun flag and translation.
+# a process can serve several requests at the same time (see tlgwsgi.py --serve), so this is kept per thread.
+# threads working for a request (e. g. worker threads) take over the state of the request thread, see setRequestState().
+requestState= threading.local()
+
+## start a new request in the current thread.
+def beginRequest():
+    requestState.__dict__.clear()
+    requestState.requestID= "%017.4f:%s" % (time.time(), str(uuid.uuid4()))
+
+def getRequestState():
+    return dict(requestState.__dict__)
+
+def setRequestState(state):
+    requestState.__dict__.clear()
+    requestState.__dict__.update(state)
 
 def enableTestrun():
-    global testrun
-    testrun= True   # oh my god, the pain...
+    requestState.testrun= True
+
+def isTestrun():
+    return getattr(requestState, 'testrun', False)
+
+## set the language for messages of the current request. falls back to untranslated messages.
+def setRequestLanguage(lang):
+    try:
+        requestState.translation= gettext.translation('tlgbackend', localedir= os.path.join(sys.path[0], 'messages'), languages=[lang])
+    except IOError:
+        requestState.translation= None
+
+## translate a message into the language of the current request.
+def translate(msg):
+    translation= getattr(requestState, 'translation', None)
+    if translation==None: return msg
+    return translation.gettext(msg)
+
+if not hasattr(__builtin__, '_'):
+    __builtin__._= translate
 
 cache_regions.update({
     'mem1h': {          # cache 1 hour in memory, e. g. page ID results
@@ -82,6 +117,36 @@ NS_CATEGORY_TALK = 15
 class InputValidationError(RuntimeError):
     pass
 
+## raised by actions which notice that their query was cancelled, see CancellationToken.
+class QueryCancelled(RuntimeError):
+    pass
+
+## shared by everything working on a query. the query is cancelled explicitly (e. g. when the client disconnects), 
+# or when its deadline has passed. worker threads and long-running filters check the token regularly.
+class CancellationToken:
+    ## @param deadline unix time after which the query is cancelled, or None.
+    def __init__(self, deadline= None):
+        self.deadline= deadline
+        self.reason= None
+    
+    def cancel(self, reason):
+        if self.reason==None: self.reason= reason
+    
+    def isCancelled(self):
+        if self.reason==None and self.deadline!=None and time.time()>=self.deadline:
+            self.reason= 'deadline'
+        return self.reason!=None
+    
+    ## raise QueryCancelled if the query was cancelled.
+    def check(self):
+        if self.isCancelled():
+            raise QueryCancelled(self.reason)
+    
+    ## seconds until the deadline, or None if there is no deadline.
+    def timeLeft(self):
+        if self.deadline==None: return None
+        return max(0, self.deadline-time.time())
+
 def GetSQLDefaultFile():
     return os.path.expanduser('~')+"/.my.cnf" if TOOLSERVER else os.path.expanduser('~')+"/replica.my.cnf"
 
@@ -97,7 +162,177 @@ def GetTempCursors():
         t.cache['tempcursors']= dict()
         return t.cache['tempcursors']
 
-## a temporary cursor to be used with the 'with' statement. will pe cached per thread and automatically cleaned up.
+## a DictCursor which also takes arrays (such as slices of a PageIDSet) as query parameters.
+# they are converted to lists here, so page ID batches can stay compact until they are sent to the database.
+class ArrayDictCursor(MySQLdb.cursors.DictCursor):
+    def execute(self, query, args= None):
+        if isinstance(args, array.array): args= args.tolist()
+        return MySQLdb.cursors.DictCursor.execute(self, query, args)
+
+## raised when no database connection became available in time.
+class ConnectionPoolTimeout(RuntimeError):
+    pass
+
+## a process-wide pool of database connections, keyed by host.
+# at most maxSize connections per host are open at the same time. when all of them are checked out, 
+# checkout() waits for one to be returned, instead of failing with max_user_connections.
+# idle connections are health-checked before reuse and closed after idleTimeout seconds.
+class ConnectionPool:
+    def __init__(self, maxSize= 10, waitTimeout= 60, idleTimeout= 60, checkInterval= 10):
+        self.maxSize= maxSize
+        self.waitTimeout= waitTimeout       # max. seconds to wait for a connection
+        self.idleTimeout= idleTimeout       # idle connections are closed after this many seconds
+        self.checkInterval= checkInterval   # connections idle for longer than this are pinged before reuse
+        self.condition= threading.Condition()
+        self.idle= {}                       # host => list of (connection, time of checkin)
+        self.numOpen= {}                    # host => number of open connections, idle or checked out
+        self.stats= { 'checkouts': 0, 'waits': 0, 'wait_time': 0.0, 'max_wait_time': 0.0, 'timeouts': 0, 
+                      'connects': 0, 'reaped': 0, 'failed_health_checks': 0 }
+    
+    def connect(self, host):
+        return MySQLdb.connect( read_default_file=GetSQLDefaultFile(), host=host, use_unicode=False, cursorclass=ArrayDictCursor )
+    
+    ## get a connection to host. 
+    # @param timeout max. seconds to wait for a free connection. raises ConnectionPoolTimeout if none became available.
+    def checkout(self, host, timeout= None):
+        if timeout==None: timeout= self.waitTimeout
+        begin= time.time()
+        deadline= begin+timeout
+        while True:
+            conn, lastuse= self.reserve(host, deadline)
+            if conn:
+                if time.time()-lastuse < self.checkInterval or self.isHealthy(conn): 
+                    break
+                with self.condition: self.stats['failed_health_checks']+= 1
+                self.discard(host, conn)
+                continue
+            # we have a free slot, open a new connection outside the lock
+            try:
+                conn= self.connect(host)
+                with self.condition: self.stats['connects']+= 1
+                break
+            except MySQLdb.OperationalError as e:
+                self.discard(host, None)
+                if 'max_user_connections' in str(e) and time.time()<deadline:
+                    # the server limit was hit by other processes. retry when a connection is returned, or a bit later.
+                    dprint(0, str(e))
+                    with self.condition: self.condition.wait(min(1.0, deadline-time.time()))
+                    continue
+                raise
+        waited= time.time()-begin
+        with self.condition:
+            self.stats['checkouts']+= 1
+            self.stats['wait_time']+= waited
+            self.stats['max_wait_time']= max(self.stats['max_wait_time'], waited)
+        return conn
+    
+    # take an idle connection or reserve a slot for a new one, waiting until deadline if necessary.
+    # returns (connection, time of last use), or (None, None) if a new connection may be opened.
+    def reserve(self, host, deadline):
+        reaped= []
+        try:
+            with self.condition:
+                reaped= self.reapIdle()
+                waited= False
+                while True:
+                    idle= self.idle.get(host)
+                    if idle:
+                        return idle.pop()
+                    if self.numOpen.get(host, 0) < self.maxSize:
+                        self.numOpen[host]= self.numOpen.get(host, 0) + 1
+                        return None, None
+                    remaining= deadline-time.time()
+                    if remaining<=0:
+                        self.stats['timeouts']+= 1
+                        raise ConnectionPoolTimeout('no connection to %s became available in time' % host)
+                    if not waited: 
+                        self.stats['waits']+= 1
+                        waited= True
+                    self.condition.wait(remaining)
+        finally:
+            for conn in reaped: self.close(conn)
+    
+    # remove connections which were idle for too long. must be called with the condition held.
+    # returns the connections to close.
+    def reapIdle(self):
+        reaped= []
+        now= time.time()
+        for host in self.idle:
+            keep= [ (conn, lastuse) for (conn, lastuse) in self.idle[host] if now-lastuse < self.idleTimeout ]
+            if len(keep)!=len(self.idle[host]):
+                reaped.extend([ conn for (conn, lastuse) in self.idle[host] if now-lastuse >= self.idleTimeout ])
+                self.numOpen[host]-= len(self.idle[host])-len(keep)
+                self.idle[host]= keep
+        self.stats['reaped']+= len(reaped)
+        if reaped: self.condition.notifyAll()
+        return reaped
+    
+    def isHealthy(self, conn):
+        try:
+            conn.ping()
+            return True
+        except MySQLdb.Error:
+            return False
+    
+    def close(self, conn):
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+    
+    ## close a connection which is broken, or free a reserved slot (conn=None).
+    def discard(self, host, conn):
+        if conn: self.close(conn)
+        with self.condition:
+            self.numOpen[host]-= 1
+            self.condition.notifyAll()
+    
+    ## return a connection to the pool.
+    def checkin(self, host, conn):
+        try:
+            conn.rollback()     # don't keep old snapshots around
+        except MySQLdb.Error:
+            self.discard(host, conn)
+            return
+        with self.condition:
+            self.idle.setdefault(host, []).append( (conn, time.time()) )
+            self.condition.notifyAll()
+    
+    def getStats(self):
+        with self.condition:
+            stats= dict(self.stats)
+            stats['open']= sum(self.numOpen.values())
+            stats['idle']= sum([ len(i) for i in self.idle.values() ])
+            return stats
+
+## get the process-wide connection pool.
+def getConnectionPool():
+    return connectionPool
+
+def createConnectionPool():
+    return ConnectionPool(int(config.get('sql-pool-size', 10)), float(config.get('sql-pool-timeout', 60)))
+
+## replace the connection pool with a new, empty one and return the old one. 
+# used in forked worker processes, which must not touch the connections of their parent.
+def resetConnectionPool():
+    global connectionPool
+    old= connectionPool
+    connectionPool= createConnectionPool()
+    return old
+
+## return all connections used by the current thread to the pool. 
+# cursors obtained from getCursors() or TempCursor before this call must not be used afterwards.
+def releaseThreadConnections():
+    cache= getattr(threading.currentThread(), 'cache', {})
+    for cur in cache.pop('SQLCursors', {}).values():
+        cur.close()
+    for tc in cache.pop('tempcursors', {}).values():
+        tc.cursor.close()
+        connectionPool.checkin(tc.host, tc.conn)
+    for host, conn in cache.pop('SQLConnections', {}).items():
+        connectionPool.checkin(host, conn)
+
+## a temporary cursor to be used with the 'with' statement. will pe cached per thread and returned to the pool by releaseThreadConnections().
 class TempCursor:
     def __init__(self, host, dbname):
         self.host= host
@@ -108,52 +343,31 @@ class TempCursor:
         if self.key in GetTempCursors(): 
             return GetTempCursors()[self.key].cursor
         
-        self.conn= None
-        while self.conn==None:
-            try:
-                self.conn= MySQLdb.connect( read_default_file=GetSQLDefaultFile(), host=self.host, \
-                    use_unicode=False, cursorclass=MySQLdb.cursors.DictCursor )
-            except MySQLdb.OperationalError as e:
-                if 'max_user_connections' in str(e):
-                    dprint(0, str(e))
-                    #~ dprint(0, 'exceeded max connections, retrying...')
-                    #~ time.sleep(0.5)
-                    raise   #xxxxx
-                else:
-                    raise
-        
+        self.conn= connectionPool.checkout(self.host)
         self.cursor= self.conn.cursor()
         self.cursor.execute ("USE %s" % self.conn.escape_string(self.dbname))
         GetTempCursors()[self.key]= self
         return self.cursor
 
     def __exit__(self, exc_type, exc_value, traceback):
-        GetTempCursors()[self.key].lastuse= time.time()
+        pass
 
 
 ## get cursor for a wikipedia database ('enwiki_p' etc).
-#  cursors are created on demand and stored locally for each thread.
+#  cursors are created on demand and stored locally for each thread, until releaseThreadConnections() is called.
 #  the DictCursor class is used, i. e. you get dicts with the column names as keys in query results.
+## get the database host for a wiki database name such as 'dewiki_p'.
+def getDatabaseHost(wikidb):
+    if TOOLSERVER:
+        if wikidb in getWikiServerMap(): return getWikiServerMap()[wikidb]
+        else: return 'sql' # guess
+    else:
+        return '%s.labsdb' % (wikidb.split('_p')[0])
+
 def getCursors():
     class Cursors(DictCache):
         def createEntry(self, key):
-            if TOOLSERVER:
-                if key in getWikiServerMap(): ckey= getWikiServerMap()[key]
-                else: ckey= 'sql' # guess
-            else:
-                ckey= '%s.labsdb' % (key.split('_p')[0])
-            conn= None
-            while conn==None:
-                try:
-                    conn= getConnections()[ckey]
-                except MySQLdb.OperationalError as e:
-                    if 'max_user_connections' in str(e):
-                        dprint(0, str(e))
-                        #~ dprint(0, 'exceeded max connections, retrying...')
-                        #~ time.sleep(0.5)
-                        raise   #xxxxx
-                    else:
-                        raise
+            conn= getConnections()[getDatabaseHost(key)]
             cur= conn.cursor()
             cur.execute ("USE %s" % conn.escape_string(key))
             return cur
@@ -239,12 +453,14 @@ def logToDB(timestamp, level, requestID, *args):
     except sqlite3.OperationalError:
         pass
 
-# this returns a per-process key for logging.
+# this returns a per-request key for logging. outside of requests started with beginRequest(), a per-process key is used.
 # make sure this is called at least once in the main thread before any child thread logs anything.
 # a unix timestamp is prepended to the ID so that it can be used for sorting by time as well.
 __requestID= None
 def getRequestID():
     global __requestID
+    requestID= getattr(requestState, 'requestID', None)
+    if requestID: return requestID
     if __requestID==None:
         __requestID= "%017.4f:%s" % (time.time(), str(uuid.uuid4()))
     return __requestID
@@ -306,10 +522,11 @@ class DictCache(dict):
     def createEntry(self, key):
         raise NotImplementedError("createEntry must be reimplemented in subclasses")
 
+## get connections to database hosts, checked out from the connection pool and stored locally for each thread.
 def getConnections():
     class Connections(DictCache):
         def createEntry(self, key):
-            return MySQLdb.connect( read_default_file=GetSQLDefaultFile(), host=key, use_unicode=False, cursorclass=MySQLdb.cursors.DictCursor )
+            return connectionPool.checkout(key)
     return CachedThreadValue('SQLConnections', Connections)
 
 if TOOLSERVER and threading.currentThread().name == 'MainThread':
@@ -324,10 +541,11 @@ try:
 except Exception as ex:
     dprint(1, "exception while loading config file tlgrc: %s" % str(ex))
 
+connectionPool= createConnectionPool()
+
 
 def logStats(statDict):
-    global testrun
-    if testrun: s= 'testrunstats'
+    if isTestrun(): s= 'testrunstats'
     else: s= 'stats'
     dprint(0, '%s: %s' % (s, json.dumps(statDict)))
 
@@ -1,6 +1,8 @@
 #!/usr/bin/python
 # -*- coding:utf-8 -*-
 import os
+import time
+import hashlib
 from wikitools import wiki, api
 from utils import *
 
@@ -8,6 +10,9 @@ class SimpleMW:
     ## constructor.
     # @param lang language ('de', 'en' etc)
     def __init__(self, lang):
+        self.loginLock= threading.Lock()    # instances are shared by concurrent requests, see getSimpleMW()
+        self.watchlistLock= threading.Lock()
+        self.watchlists= {}                 # (user, token hash) => dict with the cached watchlist, see getWatchlistPages()
         try:
             if str(lang)=='commons':
                 self.site= wiki.Wiki('http://commons.wikimedia.org/w/api.php')
@@ -28,7 +33,8 @@ class SimpleMW:
         if self.site.isLoggedIn():
             return
         try:
-            self.login()
+            with self.loginLock:
+                self.login()
         except UnicodeEncodeError:  # FIXME/HACK happens for lang 'es' and possibly others. bug in wikitools?
             dprint(0, '*** FIXME UnicodeEncodeError in wikitools')
             info= sys.exc_info()
@@ -80,17 +86,17 @@ class SimpleMW:
             raise RuntimeError(str(res))
         return res
     
-    ## get complete watchlist, starting from wlstart.
+    ## get the watchlist, starting from wlstart. lists the latest change of each page, not all revisions.
     # only retrieves pages in namespace 0 (articles).
-    def getWatchlist(self, wlowner, wltoken, wlstart= None, wlend= None):
+    # @param wldir 'older' to list changes from wlstart backwards, 'newer' to list changes since wlstart.
+    def getWatchlist(self, wlowner, wltoken, wlstart= None, wlend= None, wldir= 'older'):
         self.tryLogin()
         params= {   'action': 'query',
                     'list': 'watchlist',
                     'wlowner': wlowner,
                     'wltoken': wltoken,
-                    'wlprop': 'user|timestamp|title|ids|flags',
-                    'wlallrev': 'true',
-                    'wldir': 'older',
+                    'wlprop': 'timestamp|title|ids',
+                    'wldir': wldir,
                     'wlnamespace': 0,
                 }
         
@@ -107,14 +113,44 @@ class SimpleMW:
             raise InputValidationError('%s\\n%s' % (e[0], e[1]))
     
     
-    def getWatchlistPages(self, wlowner, wltoken, wlstart= None, wlend= None):
-        self.tryLogin()
-        wl= self.getWatchlist(wlowner, wltoken, wlstart, wlend)
-        res= dict()
+    ## get the pages on a watchlist, as a dict of page ID => latest watchlist entry.
+    # watchlists are cached per user and token. within watchlist-cache-ttl seconds, the cached pages are returned.
+    # after that, only the changes since the newest cached entry are fetched and merged. the whole watchlist is 
+    # fetched again after watchlist-full-refresh seconds, which drops pages that were unwatched or got too old.
+    def getWatchlistPages(self, wlowner, wltoken):
+        if isinstance(wltoken, unicode): wltoken= wltoken.encode('utf-8')
+        key= (wlowner, hashlib.sha1(wltoken).hexdigest())
+        now= time.time()
+        with self.watchlistLock:
+            cached= self.watchlists.get(key)
+        if cached and now-cached['fetched'] < float(config.get('watchlist-cache-ttl', 60)):
+            return dict(cached['pages'])
+        if cached and now-cached['created'] < float(config.get('watchlist-full-refresh', 60*60)):
+            wl= self.getWatchlist(wlowner, wltoken, cached['newest'], None, 'newer')
+            entry= dict(cached, pages= dict(cached['pages']))
+        else:
+            wl= self.getWatchlist(wlowner, wltoken)
+            entry= { 'pages': {}, 'newest': None, 'created': now }
+        res= entry['pages']
         for p in wl['query']['watchlist']:
             if p['pageid']!=0 and (not(p['pageid'] in res) or (res[p['pageid']]['timestamp'] < p['timestamp'])):
                 res[p['pageid']]= p
-        return res
+            if entry['newest']==None or p['timestamp'] > entry['newest']:
+                entry['newest']= p['timestamp']
+        entry['fetched']= now
+        with self.watchlistLock:
+            self.watchlists[key]= entry
+        return dict(res)
+
+simpleMWs= {}
+simpleMWLock= threading.Lock()
+
+## get the process-wide SimpleMW instance for a wiki. the session and login are reused by all requests.
+def getSimpleMW(lang):
+    with simpleMWLock:
+        if not lang in simpleMWs:
+            simpleMWs[lang]= SimpleMW(lang)
+        return simpleMWs[lang]
     
         
 